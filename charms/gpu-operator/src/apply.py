@@ -0,0 +1,322 @@
+# Copyright 2024 Canonical Ltd.
+# See LICENSE file for licensing details.
+"""Apply rendered manifest resources to the cluster in dependency tiers."""
+
+import json
+import logging
+import random
+import time
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Executor,
+    Future,
+    ThreadPoolExecutor,
+    as_completed,
+    wait,
+)
+from functools import partial
+from hashlib import sha256
+from typing import (
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Mapping,
+    MutableMapping,
+    Optional,
+    Tuple,
+)
+
+from httpx import HTTPError, TransportError
+from lightkube.codecs import AnyResource
+from lightkube.core.exceptions import ApiError
+from lightkube.generic_resource import GenericGlobalResource, GenericNamespacedResource
+from lightkube.resources.apiextensions_v1 import CustomResourceDefinition
+from ops.manifests import HashableResource, ManifestClientError, Manifests, Patch
+
+from metrics import metrics
+from profiling import profiler
+
+log = logging.getLogger(__name__)
+
+# Kinds which must exist before the resources in the following tiers.
+# Workloads come after these tiers, and custom resources come last since
+# they depend on both their CRDs and the operator which reconciles them.
+APPLY_TIERS = (
+    ("CustomResourceDefinition",),
+    ("Namespace", "ServiceAccount", "ClusterRole", "ClusterRoleBinding", "Role", "RoleBinding"),
+    ("ConfigMap", "Secret"),
+)
+WORKLOAD_TIER = len(APPLY_TIERS)
+CUSTOM_RESOURCE_TIER = WORKLOAD_TIER + 1
+
+# api calls are retried within the hook, sleeping a random time up to a
+# doubling bound, before the error is left for a deferred event
+RETRIES = 4
+BACKOFF_BASE = 0.5
+BACKOFF_CAP = 8.0
+TRANSIENT_CODES = (408, 429)
+# what an operator does to recover from a permanent api error, by status code
+RECOVERY_STEPS = {
+    403: "grant the charm's credentials access",
+    404: "install the missing api",
+    409: "remove the conflicting resource",
+}
+
+# CRDs carry the digest of their rendering, so one which is already on the
+# cluster is not sent again when the charm's own record of it is lost
+DIGEST_ANNOTATION = "juju.io/manifest-digest"
+PARTIAL_METADATA = "application/json;as=PartialObjectMetadata;g=meta.k8s.io;v=v1"
+ESTABLISHED_TIMEOUT = 60.0
+ESTABLISHED_INTERVAL = 1.0
+
+
+def is_transient(error: BaseException) -> bool:
+    """Whether a failed api call may succeed when retried."""
+    cause = error.__cause__ if isinstance(error, ManifestClientError) else error
+    if isinstance(cause, ApiError):
+        code = getattr(cause.status, "code", None)
+        if isinstance(code, int):
+            return code in TRANSIENT_CODES or code >= 500
+    elif cause is not None:
+        return isinstance(cause, TransportError)
+    return True
+
+
+def blocked_message(error: ManifestClientError) -> str:
+    """Status of a permanent api error, naming the step which recovers from it."""
+    code = getattr(getattr(error.__cause__, "status", None), "code", None)
+    step = RECOVERY_STEPS.get(code, "fix the cluster")
+    return f"{error.args[0]}; to recover, {step}"
+
+
+def retry(call: Callable[[], None], verb: str, kind: str, retries: int = RETRIES) -> None:
+    """Make an api call, retrying transient errors with jittered exponential backoff."""
+    for attempt in range(retries + 1):
+        try:
+            return call()
+        except ManifestClientError as e:
+            if attempt == retries or not is_transient(e):
+                raise
+            delay = random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2**attempt))
+            metrics.inc("charm_api_retries_total", verb=verb, kind=kind)
+            log.warning(f"Retrying {verb} of {kind} in {delay:.2f}s: {e.args[0]}")
+            time.sleep(delay)
+
+
+def resource_digest(rsc: HashableResource) -> str:
+    """Stable digest of the rendered content of a resource."""
+    content = json.dumps(rsc.resource.to_dict(), sort_keys=True, default=str)
+    return sha256(content.encode()).hexdigest()
+
+
+class AnnotateCRDDigest(Patch):
+    """Annotate each CRD with the digest of its rendering, after every other patch."""
+
+    def __call__(self, obj: AnyResource) -> None:
+        """Set the digest annotation of a CustomResourceDefinition."""
+        if obj.kind != "CustomResourceDefinition":
+            return
+        annotations = dict(obj.metadata.annotations or {})
+        annotations.pop(DIGEST_ANNOTATION, None)
+        obj.metadata.annotations = annotations
+        digest = resource_digest(HashableResource(obj))
+        annotations[DIGEST_ANNOTATION] = digest
+
+
+def _installed_metadata(client, rsc: HashableResource) -> Mapping:
+    """Metadata of a resource on the cluster, requested as PartialObjectMetadata.
+
+    lightkube can't ask for PartialObjectMetadata, so the request is made
+    through its private generic client. Should that change, the whole
+    object is read instead.
+    """
+    try:
+        generic = client._client
+        request = generic.prepare_request(
+            "get",
+            res=type(rsc.resource),
+            name=rsc.name,
+            namespace=rsc.namespace,
+            headers={"Accept": PARTIAL_METADATA},
+        )
+        response = generic.send(generic.build_adapter_request(request))
+        generic.raise_for_status(response)
+    except (AttributeError, TypeError) as e:
+        log.warning(f"Reading the whole of {rsc}: {e}")
+        obj = client.get(type(rsc.resource), rsc.name, namespace=rsc.namespace)
+        return {"annotations": obj.metadata.annotations}
+    return response.json().get("metadata") or {}
+
+
+def installed_digest(manifests: Manifests, rsc: HashableResource) -> Optional[str]:
+    """Digest annotation of a resource on the cluster, reading only its metadata.
+
+    Any failure reads as no digest.
+    """
+    metrics.inc("charm_api_calls_total", verb="get", kind=rsc.kind)
+    try:
+        metadata = _installed_metadata(manifests.client, rsc)
+    except (ApiError, HTTPError) as e:
+        if not isinstance(e, ApiError) or e.status.code != 404:
+            metrics.inc("charm_api_errors_total", verb="get", kind=rsc.kind)
+            log.warning(f"Failed reading the installed digest of {rsc}: {e}")
+        return None
+    return (metadata.get("annotations") or {}).get(DIGEST_ANNOTATION)
+
+
+def _installed(manifests: Manifests, rsc: HashableResource) -> bool:
+    """Whether the cluster already holds this rendering of an annotated resource."""
+    rendered = (rsc.resource.metadata.annotations or {}).get(DIGEST_ANNOTATION)
+    return bool(rendered) and installed_digest(manifests, rsc) == rendered
+
+
+def wait_established(manifests: Manifests, names: Iterable[str]) -> None:
+    """Wait until the named CRDs are served, before applying their custom resources."""
+    pending = set(names)
+    deadline = time.monotonic() + ESTABLISHED_TIMEOUT
+
+    def get(name: str) -> CustomResourceDefinition:
+        try:
+            return manifests.client.get(CustomResourceDefinition, name)
+        except (ApiError, HTTPError) as e:
+            raise ManifestClientError(f"Failed reading CustomResourceDefinition {name}", e) from e
+
+    with profiler.span("wait established", crds=len(pending)):
+        while True:
+            for name in sorted(pending):
+                metrics.inc("charm_api_calls_total", verb="get", kind="CustomResourceDefinition")
+                conditions = getattr(get(name).status, "conditions", None) or []
+                if any(c.type == "Established" and c.status == "True" for c in conditions):
+                    pending.discard(name)
+            if not pending:
+                return
+            if time.monotonic() >= deadline:
+                raise ManifestClientError(
+                    f"Timed out waiting for CRDs to be established: {', '.join(sorted(pending))}"
+                )
+            time.sleep(ESTABLISHED_INTERVAL)
+
+
+def apply_tier(rsc: HashableResource) -> int:
+    """Dependency tier of a resource, lower tiers are applied first."""
+    if isinstance(rsc.resource, (GenericGlobalResource, GenericNamespacedResource)):
+        return CUSTOM_RESOURCE_TIER
+    for tier, kinds in enumerate(APPLY_TIERS):
+        if rsc.kind in kinds:
+            return tier
+    return WORKLOAD_TIER
+
+
+def _apply(manifests: Manifests, rsc: HashableResource) -> None:
+    metrics.inc("charm_api_calls_total", verb="apply", kind=rsc.kind)
+    try:
+        with profiler.span("apply", resource=str(rsc)):
+            retry(lambda: manifests.apply_resource(rsc), "apply", rsc.kind)
+    except Exception:
+        metrics.inc("charm_api_errors_total", verb="apply", kind=rsc.kind)
+        raise
+    metrics.inc("charm_resources_applied_total", manifest=manifests.name)
+
+
+def _bounded(
+    pool: Executor,
+    call: Callable[[HashableResource], None],
+    resources: Iterable[HashableResource],
+    limit: int,
+) -> Iterator[Tuple[HashableResource, Optional[BaseException]]]:
+    """Run a call on each resource with at most ``limit`` in flight, yielding outcomes."""
+    pending: Dict[Future, HashableResource] = {}
+    for rsc in resources:
+        pending[pool.submit(call, rsc)] = rsc
+        if len(pending) >= limit:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield pending.pop(future), future.exception()
+    for future in as_completed(pending):
+        yield pending[future], future.exception()
+
+
+def _changed_tiers(
+    manifests: Manifests,
+    render: Callable[[], Iterable[HashableResource]],
+    applied: MutableMapping[str, str],
+) -> Tuple[Dict[str, str], Dict[str, int], List[str]]:
+    """Digest every resource, assigning a tier to those which changed.
+
+    Returns the digests, the tier of each changed resource and the skipped
+    ones, dropping resources no longer rendered from ``applied``.
+    """
+    digests: Dict[str, str] = {}
+    tiers: Dict[str, int] = {}
+    skipped = []
+    for rsc in render():
+        key = str(rsc)
+        digests[key] = resource_digest(rsc)
+        if applied.get(key) == digests[key]:
+            skipped.append(key)
+        elif _installed(manifests, rsc):
+            applied[key] = digests[key]
+            skipped.append(key)
+        else:
+            tiers[key] = apply_tier(rsc)
+    for stale in set(applied) - set(digests):
+        del applied[stale]
+    return digests, tiers, skipped
+
+
+def _apply_tiers(
+    manifests: Manifests,
+    render: Callable[[], Iterable[HashableResource]],
+    applied: MutableMapping[str, str],
+    digests: Dict[str, str],
+    tiers: Dict[str, int],
+    concurrency: int,
+) -> None:
+    """Apply the changed resources tier by tier, raising a tier's first failure."""
+    manifests.client  # create the client before sharing it between threads
+    limit = max(concurrency, 1)
+    crds = []
+    with ThreadPoolExecutor(max_workers=limit) as pool:
+        for tier in sorted(set(tiers.values())):
+            if tier == CUSTOM_RESOURCE_TIER and crds:
+                wait_established(manifests, crds)
+            log.debug(f"Applying resources in tier {tier}")
+            tiered = (rsc for rsc in render() if tiers.get(str(rsc)) == tier)
+            failure: Optional[BaseException] = None
+            for rsc, error in _bounded(pool, partial(_apply, manifests), tiered, limit):
+                if error:
+                    failure = failure or error
+                else:
+                    applied[str(rsc)] = digests[str(rsc)]
+                    if rsc.kind == "CustomResourceDefinition":
+                        crds.append(rsc.name)
+            if failure:
+                raise failure
+
+
+def apply_changed(
+    manifests: Manifests,
+    render: Callable[[], Iterable[HashableResource]],
+    applied: MutableMapping[str, str],
+    concurrency: int = 1,
+) -> List[str]:
+    """Apply only the resources whose digest changed, returning the skipped ones.
+
+    Changed resources are applied tier by tier, running up to ``concurrency``
+    api calls at once within a tier, each retried while its errors are
+    transient. ``applied`` records the digest of each resource as soon as it
+    is applied, so a deferred apply resumes with the resources left over.
+
+    Rather than holding the whole release, the resources are rendered once to
+    find the changed ones and again for each tier with changes, keeping only
+    those being applied. A changed CRD whose digest annotation matches the
+    one on the cluster is recorded without being applied, and custom
+    resources wait for the CRDs applied before them to be established.
+    """
+    digests, tiers, skipped = _changed_tiers(manifests, render, applied)
+    metrics.inc("charm_resources_skipped_total", len(skipped), manifest=manifests.name)
+    if tiers:
+        _apply_tiers(manifests, render, applied, digests, tiers, concurrency)
+    return skipped
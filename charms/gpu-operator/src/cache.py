@@ -0,0 +1,146 @@
+# Copyright 2024 Canonical Ltd.
+# See LICENSE file for licensing details.
+"""Pre-parsed cache of the upstream release manifests."""
+
+import logging
+import os
+import pickle
+import tempfile
+from hashlib import sha256
+from pathlib import Path
+from typing import BinaryIO, Callable, Iterable, Iterator, List, Mapping, Optional
+
+import yaml
+
+log = logging.getLogger(__name__)
+
+try:
+    Loader = yaml.CSafeLoader
+except AttributeError:  # libyaml is unavailable
+    Loader = yaml.SafeLoader  # type: ignore
+
+Parser = Callable[[Path], Iterable[Mapping]]
+
+
+def _flatten(docs: Iterable, filepath: Path) -> Iterator[Mapping]:
+    """Yield the kubernetes objects of documents, expanding kind=*List."""
+    for doc in docs:
+        if not isinstance(doc, Mapping):
+            log.warning(f"Ignoring non-dictionary resource rsc='{doc}' in {filepath}")
+        elif not doc.get("kind") or not doc.get("apiVersion"):
+            log.warning(f"Ignoring non-kubernetes resource rsc='{doc}' in {filepath}")
+        elif doc["kind"].endswith("List"):
+            yield from _flatten(doc.get("items", []), filepath)
+        else:
+            yield doc
+
+
+def iter_documents(filepath: Path) -> Iterator[Mapping]:
+    """Parse the objects of a manifest file one document at a time.
+
+    Only the document being parsed is held in memory, rather than the
+    whole file as with ``yaml.safe_load_all``.
+    """
+    with filepath.open("rb") as f:
+        yield from _flatten(yaml.load_all(f, Loader=Loader), filepath)
+
+
+class ManifestCache:
+    """Pickled copy of parsed manifest documents keyed by the file digest.
+
+    lightkube generic resources are created dynamically from the CRDs and
+    cannot be pickled, so the cache holds the flattened documents which are
+    cheap to turn back into resources. Each document is pickled on its own
+    so they can be read back one at a time.
+    """
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+
+    @staticmethod
+    def digest(filepath: Path) -> str:
+        """Content digest of a manifest file."""
+        return sha256(filepath.read_bytes()).hexdigest()
+
+    @staticmethod
+    def _key(filepath: Path) -> str:
+        """Cache name of a manifest file, unique across the release directories."""
+        return f"{filepath.parent.name}-{filepath.stem}"
+
+    def _cached(self, filepath: Path) -> Iterator[Path]:
+        """Every cached copy of a manifest file, whatever its digest."""
+        yield from self.path.glob(f"{self._key(filepath)}-*.pickle")
+        # earlier charm revisions named the cache after the file stem alone
+        yield from self.path.glob(f"{filepath.stem}-{'[0-9a-f]' * 64}.pickle")
+
+    def load(self, filepath: Path, parser: Parser, digest: Optional[str] = None) -> List[Mapping]:
+        """Load every parsed document, see ``stream``."""
+        return list(self.stream(filepath, parser, digest))
+
+    def stream(
+        self, filepath: Path, parser: Parser, digest: Optional[str] = None
+    ) -> Iterator[Mapping]:
+        """Yield parsed documents from the cache, parsing and storing on a miss.
+
+        The digest of the file is read from it unless a known one is given.
+        """
+        cached = self.path / f"{self._key(filepath)}-{digest or self.digest(filepath)}.pickle"
+        read = 0
+        try:
+            with cached.open("rb") as f:
+                for doc in self._read(f):
+                    yield doc
+                    read += 1
+            return
+        except FileNotFoundError:
+            pass
+        except (OSError, pickle.UnpicklingError, EOFError) as e:
+            if read:  # the cache is replaced atomically, so this is not a partial write
+                raise
+            log.warning(f"Ignoring unreadable manifest cache {cached}: {e}")
+
+        yield from self._write(cached, parser(filepath), filepath)
+
+    @staticmethod
+    def _read(f: BinaryIO) -> Iterator[Mapping]:
+        while True:
+            try:
+                yield pickle.load(f)
+            except EOFError:
+                return
+
+    def _write(self, cached: Path, documents: Iterable[Mapping], filepath: Path):
+        """Yield documents while pickling them, storing the cache once all are read."""
+        try:
+            self.path.mkdir(parents=True, exist_ok=True)
+            f = tempfile.NamedTemporaryFile(dir=self.path, suffix=".tmp", delete=False)
+        except OSError as e:
+            log.warning(f"Failed to write manifest cache {cached}: {e}")
+            yield from documents
+            return
+
+        partial = Path(f.name)
+        try:
+            with f:
+                for doc in documents:
+                    if not f.closed:
+                        try:
+                            pickle.dump(doc, f, protocol=pickle.HIGHEST_PROTOCOL)
+                        except OSError as e:
+                            log.warning(f"Failed to write manifest cache {cached}: {e}")
+                            f.close()
+                    yield doc
+                written = not f.closed
+            if written:
+                self._replace(partial, cached, filepath)
+        finally:
+            partial.unlink(missing_ok=True)
+
+    def _replace(self, partial: Path, cached: Path, filepath: Path) -> None:
+        try:
+            os.replace(partial, cached)
+            for stale in list(self._cached(filepath)):
+                if stale != cached:
+                    stale.unlink()
+        except OSError as e:
+            log.warning(f"Failed to write manifest cache {cached}: {e}")
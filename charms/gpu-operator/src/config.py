@@ -2,12 +2,18 @@
 # See LICENSE file for licensing details.
 """Config Management for the nvidia-gpu-operator charm."""
 
+import json
 import logging
-from typing import Optional
+import re
+from hashlib import sha256
+from types import MappingProxyType
+from typing import Dict, List, Mapping, NamedTuple, Optional, Tuple
 
 import jsonschema
 import yaml
 
+from profiling import MODES
+
 log = logging.getLogger(__name__)
 
 NFD_SCHEMA = {
@@ -18,54 +24,248 @@ NFD_SCHEMA = {
     "required": ["sources"],
 }
 
+TIME_SLICING_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "version": {"const": "v1"},
+        "flags": {"type": "object"},
+        "sharing": {
+            "type": "object",
+            "properties": {
+                "timeSlicing": {
+                    "type": "object",
+                    "properties": {
+                        "renameByDefault": {"type": "boolean"},
+                        "failRequestsGreaterThanOne": {"type": "boolean"},
+                        "resources": {
+                            "type": "array",
+                            "minItems": 1,
+                            "items": {
+                                "type": "object",
+                                "properties": {
+                                    "name": {"type": "string", "pattern": "^nvidia\\.com/"},
+                                    "rename": {"type": "string"},
+                                    "replicas": {"type": "integer", "minimum": 2},
+                                },
+                                "required": ["name", "replicas"],
+                            },
+                        },
+                    },
+                    "required": ["resources"],
+                },
+            },
+            "required": ["timeSlicing"],
+        },
+    },
+    "required": ["sharing"],
+}
+
+MIG_CONFIG_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "version": {"const": "v1"},
+        "mig-configs": {
+            "type": "object",
+            "minProperties": 1,
+            "additionalProperties": {
+                "type": "array",
+                "minItems": 1,
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "devices": {
+                            "anyOf": [
+                                {"const": "all"},
+                                {"type": "array", "items": {"type": "integer", "minimum": 0}},
+                            ]
+                        },
+                        "mig-enabled": {"type": "boolean"},
+                        "mig-devices": {
+                            "type": "object",
+                            "additionalProperties": {"type": "integer", "minimum": 0},
+                        },
+                    },
+                    "required": ["devices", "mig-enabled"],
+                },
+            },
+        },
+    },
+    "required": ["version", "mig-configs"],
+}
+
+MIG_STRATEGIES = ("none", "single", "mixed")
+DCGM_METRIC_TYPES = ("gauge", "counter", "label")
+INTERVAL_UNITS = {"s": 1, "m": 60, "h": 3600}
+
+
+def _compile(schema: dict) -> "jsonschema.protocols.Validator":
+    """Check a schema once, returning a validator which can be reused."""
+    validator = jsonschema.validators.validator_for(schema)
+    validator.check_schema(schema)
+    return validator(schema)
+
+
+# validators for the yaml options, compiled once per process
+VALIDATORS = {
+    "nfd-worker-conf": _compile(NFD_SCHEMA),
+    "time-slicing": _compile(TIME_SLICING_SCHEMA),
+    "mig-config": _compile(MIG_CONFIG_SCHEMA),
+}
+# yaml options which may be left unset
+OPTIONAL = ("time-slicing", "mig-config")
+
+
+def interval_seconds(interval: str) -> Optional[int]:
+    """Seconds of a prometheus duration such as 30s, or None when it isn't one."""
+    match = re.fullmatch(r"([1-9]\d*)([smh])", interval)
+    return int(match[1]) * INTERVAL_UNITS[match[2]] if match else None
+
+
+def dcgm_metric_errors(metrics: str) -> List[str]:
+    """Check each line of a DCGM exporter metrics csv is a field, type and help."""
+    errors = []
+    for number, line in enumerate(metrics.splitlines(), 1):
+        if not line.strip() or line.lstrip().startswith("#"):
+            continue
+        fields = [field.strip() for field in line.split(",", 2)]
+        if len(fields) < 3 or not fields[0].startswith("DCGM_"):
+            errors.append(f"line {number} is not: DCGM field, type, help")
+        elif fields[1] not in DCGM_METRIC_TYPES:
+            errors.append(f"line {number} type must be one of: {', '.join(DCGM_METRIC_TYPES)}")
+    return errors
+
+
+class Option(NamedTuple):
+    """A yaml config option parsed and validated against its schema."""
+
+    value: Optional[dict]
+    errors: Tuple[str, ...]
+
 
 class CharmConfig:
     """Representation of the charm configuration."""
 
-    def __init__(self, charm):
+    YAML_OPTIONS = ("nfd-worker-conf", "time-slicing", "mig-config")
+    # tune how the charm runs, never what it renders
+    OPERATIONAL_OPTIONS = ("apply-concurrency", "profiling", "readiness-watch")
+
+    # options by digest of their raw value, shared by every instance in the process
+    _loaded: Dict[str, Option] = {}
+
+    def __init__(self, charm, config: Optional[Mapping] = None):
         self.charm = charm
+        # the charm's config unless rendering with other values
+        self.config = charm.config if config is None else config
+        self._parsed: Dict[str, Option] = {}
+        self._snapshot: Optional[Mapping] = None
+        self._digest: Optional[str] = None
+
+    def invalidate(self):
+        """Drop the memoized config so the next access re-reads the charm config."""
+        self._parsed.clear()
+        self._snapshot = None
+        self._digest = None
 
     @property
     def nfd_worker_conf(self) -> str:
         """Raw nfd-worker-conf config string."""
-        return self.charm.config.get("nfd-worker-conf", "")
+        return self.config.get("nfd-worker-conf", "")
 
-    def _safe_yaml(self, conf: str) -> Optional[dict]:
-        """Parse yaml config string into a dict, return None on failure."""
+    def _load(self, key: str, conf: str) -> Option:
+        """Parse a yaml config string and validate it against the option's schema."""
         try:
-            return yaml.safe_load(conf)
-        except yaml.YAMLError:
-            return None
+            value = yaml.safe_load(conf)
+        except yaml.YAMLError as e:
+            return Option(None, (f"cannot parse yaml, {getattr(e, 'problem', None) or e}",))
+        if value is None and key in OPTIONAL:
+            return Option(None, ())
+        if not (validator := VALIDATORS.get(key)):
+            return Option(value, ())
+        errors = sorted(validator.iter_errors(value), key=lambda e: e.json_path)
+        return Option(value, tuple(f"{e.json_path}: {e.message}" for e in errors))
 
-    def _is_valid(self, yaml: dict, schema: dict) -> bool:
-        """Determine if given yaml is valid against the given schema."""
-        try:
-            jsonschema.validate(yaml, schema)
-        except jsonschema.ValidationError:
-            return False
-        return True
+    def _option(self, key: str) -> Option:
+        """Load a yaml config option, only when its raw value has not been seen."""
+        if key not in self._parsed:
+            conf = self.config.get(key, "")
+            digest = sha256(f"{key}\0{conf}".encode()).hexdigest()
+            if digest not in self._loaded:
+                self._loaded[digest] = self._load(key, conf)
+            self._parsed[key] = self._loaded[digest]
+        return self._parsed[key]
+
+    def _parsed_option(self, key: str) -> Optional[dict]:
+        """Return the parsed value of a yaml config option."""
+        return self._option(key).value
 
     def evaluate(self) -> Optional[str]:
         """Determine if configuration is valid."""
-        nfd_yaml = self._safe_yaml(self.nfd_worker_conf)
-        if not (nfd_yaml and self._is_valid(nfd_yaml, NFD_SCHEMA)):
-            return "nfd-worker-conf is invalid"
+        if self.config.get("apply-concurrency", 1) < 1:
+            return "apply-concurrency must be at least 1"
+
+        if self.config.get("profiling", "") not in ("", *MODES):
+            return f"profiling must be one of: {', '.join(MODES)}"
+
+        for key in VALIDATORS:
+            if errors := self._option(key).errors:
+                return f"{key} is invalid: {'; '.join(errors)}"
 
+        return self._sharing_error() or self._driver_error() or self._metrics_error()
+
+    def _sharing_error(self) -> Optional[str]:
+        if self.config.get("mig-strategy", "") not in ("", *MIG_STRATEGIES):
+            return f"mig-strategy must be one of: {', '.join(MIG_STRATEGIES)}"
+        mig_config = self._option("mig-config").value
+        profile = self.config.get("mig-profile", "")
+        if mig_config and profile and profile not in mig_config["mig-configs"]:
+            return f"mig-profile {profile} is not one of the mig-configs of mig-config"
+        return None
+
+    def _driver_error(self) -> Optional[str]:
+        version = self.config.get("driver-version", "")
+        if self.config.get("driver-precompiled"):
+            if version and not version.isdigit():
+                return "driver-version must be a driver branch, such as 550, when precompiled"
+        elif version and not re.fullmatch(r"\d+\.\d+(\.\d+)?", version):
+            return "driver-version must be a driver version, such as 550.144.03"
+        return None
+
+    def _metrics_error(self) -> Optional[str]:
+        if interval_seconds(self.config.get("metrics-scrape-interval", "30s")) is None:
+            return "metrics-scrape-interval must be a duration, such as 30s"
+        if errors := dcgm_metric_errors(self.config.get("dcgm-metrics", "")):
+            return f"dcgm-metrics is invalid: {'; '.join(errors)}"
         return None
 
     @property
-    def available_data(self):
-        """Parse valid charm config into a dict, drop keys if unset."""
-        data = {"namespace": self.charm.stored.namespace}
-        safe_data = {
-            "nfd-worker-conf": self._safe_yaml(self.nfd_worker_conf),
-        }
-        for key, value in self.charm.config.items():
-            # use the safe value if we have one for this key
-            data[key] = safe_data.get(key, value)
-
-        for key, value in dict(**data).items():
-            if value == "" or value is None:
-                del data[key]
-
-        return data
+    def digest(self) -> str:
+        """Order independent digest of the raw rendered config values, computed once per hook."""
+        if self._digest is None:
+            raw = {k: v for k, v in self.config.items() if k not in self.OPERATIONAL_OPTIONS}
+            # the namespace is fixed at deployment time
+            raw["namespace"] = self.charm.stored.namespace
+            content = json.dumps(raw, sort_keys=True, separators=(",", ":"), default=str)
+            self._digest = sha256(content.encode()).hexdigest()
+        return self._digest
+
+    @property
+    def available_data(self) -> Mapping:
+        """Parse valid charm config into a read-only mapping, drop keys if unset.
+
+        The mapping is built once and shared by every manifest patch until
+        the config is invalidated.
+        """
+        if self._snapshot is None:
+            data = {}
+            for key, value in self.config.items():
+                # use the safe value if we have one for this key
+                data[key] = self._parsed_option(key) if key in self.YAML_OPTIONS else value
+
+            for key, value in dict(**data).items():
+                if value == "" or value is None:
+                    del data[key]
+
+            # the namespace is fixed at deployment time
+            data["namespace"] = self.charm.stored.namespace
+            self._snapshot = MappingProxyType(data)
+        return self._snapshot
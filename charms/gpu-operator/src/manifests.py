@@ -3,14 +3,60 @@
 """Implementation of nvidia-gpu-operator kubernetes manifests."""
 
 import logging
-import pickle
-from hashlib import md5
-from typing import TYPE_CHECKING, Dict, Optional
+import re
+from collections import OrderedDict
+from functools import cached_property
+from hashlib import sha256
+from itertools import chain
+from pathlib import Path
+from typing import (
+    TYPE_CHECKING,
+    Callable,
+    Dict,
+    FrozenSet,
+    Iterator,
+    KeysView,
+    List,
+    Mapping,
+    MutableMapping,
+    Optional,
+    Tuple,
+)
 
 import yaml
+from httpx import HTTPError
+from lightkube import codecs
 from lightkube.codecs import AnyResource
+from lightkube.core.exceptions import ApiError
 from lightkube.core.resource import NamespacedResource
-from ops.manifests import ConfigRegistry, ManifestLabel, Manifests, Patch
+from lightkube.generic_resource import create_resources_from_crd
+from lightkube.models.meta_v1 import ObjectMeta
+from lightkube.resources.core_v1 import ConfigMap, Node
+from ops.manifests import (
+    Addition,
+    HashableResource,
+    ManifestLabel,
+    Manifests,
+    Patch,
+)
+from ops.manifests.manipulations import Subtraction
+
+from apply import AnnotateCRDDigest, apply_changed
+from cache import ManifestCache, iter_documents
+from config import interval_seconds
+from nfd import NAME_PREFIX, is_nfd, merge_device_classes, requested_device_classes
+from profiling import profiler
+from releases import (
+    FILE_TYPES,
+    image_fields,
+    image_key,
+    index_release,
+    load_index,
+    rewrite_image,
+    set_image_registry,
+)
+from scrape import RELATION as METRICS_RELATION
+from status import listed_status
 
 if TYPE_CHECKING:
     from charm import GPUOperatorCharm
@@ -18,6 +64,72 @@ if TYPE_CHECKING:
 log = logging.getLogger(__file__)
 
 
+def _crd(name: str) -> Callable[[str, str], bool]:
+    return lambda kind, obj_name: kind == "CustomResourceDefinition" and obj_name == name
+
+
+def kernel_flavor(kernel_version: str) -> str:
+    """Flavor of an Ubuntu kernel, such as nvidia for 5.15.0-1048-nvidia."""
+    return kernel_version.split("-", 2)[-1]
+
+
+# objects of each component the disabled-components config may leave out, by kind and name
+COMPONENTS: Dict[str, Callable[[str, str], bool]] = {
+    "nfd": is_nfd,
+    "nfd-gc": lambda _, name: name.startswith(f"{NAME_PREFIX}-gc"),
+    "nfd-prune": lambda _, name: name.startswith(f"{NAME_PREFIX}-prune"),
+    "upgrade-crd": lambda _, name: name.startswith("gpu-operator-upgrade-crd"),
+    "nvidiadriver-crd": _crd("nvidiadrivers.nvidia.com"),
+}
+
+# Ubuntu kernel flavors with precompiled driver images
+PRECOMPILED_FLAVORS = ("generic", "nvidia", "aws", "azure", "oracle")
+# set by NFD on nodes with an NVIDIA pci device
+GPU_NODE_LABEL = "feature.node.kubernetes.io/pci-10de.present"
+
+# ConfigMaps generated from the GPU sharing options, and the keys of their config
+TIME_SLICING_CONFIG, TIME_SLICING_KEY = "time-slicing-config", "any"
+MIG_CONFIG, MIG_CONFIG_KEY = "custom-mig-parted-config", "config.yaml"
+DCGM_METRICS_CONFIG, DCGM_METRICS_KEY = "custom-dcgm-metrics", "dcgm-metrics.csv"
+
+
+class TalliedPatch(Patch):
+    """Tally the time spent in another patch while profiling."""
+
+    def __init__(self, patch: Patch):
+        super().__init__(patch.manifests)
+        self.patch = patch
+        self.name = f"patch {type(patch).__name__}"
+
+    def __call__(self, obj):
+        """Apply the wrapped patch."""
+        with profiler.tally(self.name):
+            self.patch(obj)
+
+
+class ImageRegistry(Patch):
+    """Point each image at the image-registry config, using the release's image index.
+
+    Only the fields indexed for the object are assigned, rather than walking
+    every object, and these include the operator component repositories of
+    custom resources which a walk of container specs misses.
+    """
+
+    def __call__(self, obj: AnyResource) -> None:
+        """Rewrite the registry of the images in an object."""
+        registry = self.manifests.config.get("image-registry")
+        if not registry:
+            return
+        release = self.manifests.release_index.get(self.manifests.current_release)
+        if release is None:  # not indexed, locate the images now
+            fields = [field for field, _ in image_fields(obj.to_dict())]
+        else:
+            fields = release["image_fields"].get(image_key(obj.kind, obj.metadata.name), [])
+        for field in fields:
+            image, rewritten = set_image_registry(obj, field, registry)
+            log.debug(f"Replacing Image: {image} with {rewritten}")
+
+
 class ApplyNFDConfigMap(Patch):
     """Update the NFD ConfigMap as a patch since the manifests include a default."""
 
@@ -32,10 +144,119 @@ class ApplyNFDConfigMap(Patch):
         if not isinstance(config, dict):
             log.error(f"nfd-worker-conf was an unexpected type: {type(config)}")
             return
+        if requested := self.manifests.nfd_device_classes:
+            # the network-operator charm shares this NFD deployment
+            config = merge_device_classes(config, requested)
         log.info("Applying Node Feature Discovery ConfigMap Data")
         obj.data["nfd-worker.conf"] = yaml.safe_dump(config)
 
 
+class DisabledComponents(Subtraction):
+    """Leave out the objects of the components named by the disabled-components config."""
+
+    def __call__(self, obj: AnyResource) -> bool:
+        """Subtract the object if it belongs to a disabled component."""
+        disabled = self.manifests.disabled_components & COMPONENTS.keys()
+        return any(COMPONENTS[name](obj.kind, obj.metadata.name) for name in disabled)
+
+
+class SharingConfigMaps(Addition):
+    """Add the ConfigMaps of the time-slicing and mig-config options."""
+
+    def __call__(self) -> List[AnyResource]:
+        """Create a ConfigMap for each GPU sharing option which is set."""
+        config = self.manifests.config
+        config_maps = []
+        if time_slicing := config.get("time-slicing"):
+            data = {TIME_SLICING_KEY: yaml.safe_dump({"version": "v1", **time_slicing})}
+            config_maps.append(ConfigMap(metadata=ObjectMeta(name=TIME_SLICING_CONFIG), data=data))
+        if mig_config := config.get("mig-config"):
+            data = {MIG_CONFIG_KEY: yaml.safe_dump(mig_config)}
+            config_maps.append(ConfigMap(metadata=ObjectMeta(name=MIG_CONFIG), data=data))
+        return config_maps
+
+
+class DCGMMetricsConfigMap(Addition):
+    """Add the ConfigMap of the dcgm-metrics option."""
+
+    def __call__(self) -> Optional[AnyResource]:
+        """Create the ConfigMap of custom DCGM metrics when they are set."""
+        if not (metrics := self.manifests.config.get("dcgm-metrics")):
+            return None
+        data = {DCGM_METRICS_KEY: metrics}
+        return ConfigMap(metadata=ObjectMeta(name=DCGM_METRICS_CONFIG), data=data)
+
+
+class PatchDCGMExporter(Patch):
+    """Configure the DCGM exporter in the ClusterPolicy, enabling it for metrics-endpoint."""
+
+    def __call__(self, obj: AnyResource) -> None:
+        """Set the exporter's collection interval and metrics."""
+        if obj.kind != "ClusterPolicy":
+            return
+        config, exporter = self.manifests.config, obj.spec["dcgmExporter"]
+        if self.manifests.metrics_related:
+            log.info("Patching dcgmExporter to enabled")
+            exporter["enabled"] = True
+        env = {var["name"]: var for var in exporter.setdefault("env", [])}
+        # collect as often as prometheus scrapes, in milliseconds
+        interval = interval_seconds(config.get("metrics-scrape-interval", "")) or 30
+        env.setdefault("DCGM_EXPORTER_INTERVAL", {"name": "DCGM_EXPORTER_INTERVAL"})
+        env["DCGM_EXPORTER_INTERVAL"]["value"] = str(interval * 1000)
+        if "dcgm-metrics" in config:
+            log.info(f"Patching dcgmExporter metrics to {DCGM_METRICS_CONFIG}")
+            exporter["config"] = {"name": DCGM_METRICS_CONFIG}
+            env.setdefault("DCGM_EXPORTER_COLLECTORS", {"name": "DCGM_EXPORTER_COLLECTORS"})
+            env["DCGM_EXPORTER_COLLECTORS"]["value"] = f"/etc/dcgm-exporter/{DCGM_METRICS_KEY}"
+        exporter["env"] = list(env.values())
+
+
+class PatchGPUSharing(Patch):
+    """Configure time-slicing and MIG in the ClusterPolicy."""
+
+    def __call__(self, obj: AnyResource) -> None:
+        """Point the device plugin and MIG manager at the sharing config."""
+        if obj.kind != "ClusterPolicy":
+            return
+        config, spec = self.manifests.config, obj.spec
+        if "time-slicing" in config:
+            log.info(f"Patching devicePlugin config to {TIME_SLICING_CONFIG}")
+            spec["devicePlugin"]["config"] = {
+                "name": TIME_SLICING_CONFIG,
+                "default": TIME_SLICING_KEY,
+            }
+        if strategy := config.get("mig-strategy"):
+            log.info(f"Patching mig strategy to {strategy}")
+            spec["mig"] = {**(spec.get("mig") or {}), "strategy": strategy}
+        mig_manager = spec["migManager"]
+        mig_manager["config"] = dict(mig_manager.get("config") or {})
+        if "mig-config" in config:
+            log.info(f"Patching migManager config to {MIG_CONFIG}")
+            mig_manager["config"]["name"] = MIG_CONFIG
+        if profile := config.get("mig-profile"):
+            log.info(f"Patching migManager default profile to {profile}")
+            mig_manager["config"]["default"] = profile
+
+
+class PatchDriver(Patch):
+    """Pin the driver version in the ClusterPolicy, and use precompiled drivers."""
+
+    def __call__(self, obj: AnyResource) -> None:
+        """Set the driver version, or branch of the precompiled driver."""
+        if obj.kind != "ClusterPolicy":
+            return
+        config, driver = self.manifests.config, obj.spec["driver"]
+        version = config.get("driver-version")
+        if config.get("driver-precompiled"):
+            # precompiled images are tagged by branch and the node's kernel
+            version = version or str(driver["version"]).split(".")[0]
+            log.info(f"Patching driver to use precompiled {version} drivers")
+            driver["usePrecompiled"] = True
+        if version:
+            log.info(f"Patching driver version to {version}")
+            driver["version"] = version
+
+
 class PatchNamespace(Patch):
     """Adjust resource namespace."""
 
@@ -63,36 +284,200 @@ class GPUOperatorManifests(Manifests):
             charm.model,
             "upstream/gpu-operator",
             [
+                SharingConfigMaps(self),
+                DCGMMetricsConfigMap(self),
                 ManifestLabel(self),
-                ConfigRegistry(self),
+                ImageRegistry(self),
+                PatchGPUSharing(self),
+                PatchDriver(self),
+                PatchDCGMExporter(self),
                 ApplyNFDConfigMap(self),
+                DisabledComponents(self),
                 PatchNamespace(self),
+                AnnotateCRDDigest(self),
             ],
         )
+        if profiler.enabled:
+            self.manipulations = [
+                TalliedPatch(m) if isinstance(m, Patch) else m for m in self.manipulations
+            ]
         self.charm = charm
         self.charm_config = charm_config
+        self.cache = ManifestCache(self.cache_dir)
+
+    @property
+    def cache_dir(self) -> Path:
+        """Directory of the pre-parsed manifest cache, kept next to the charm state."""
+        return self.charm.charm_dir / ".manifest-cache"
+
+    def _digest(self, filepath: Path) -> Optional[str]:
+        release = self.release_index.get(filepath.parent.name, {})
+        return release.get("files", {}).get(filepath.name)
+
+    def _safe_load(self, filepath: Path) -> List[Mapping]:
+        """Read parsed manifest documents from the cache when the file is unchanged."""
+        with profiler.span("manifest load", file=filepath.name):
+            return self.cache.load(filepath, iter_documents, self._digest(filepath))
+
+    def _documents(self, filepath: Path) -> Iterator[Mapping]:
+        """Yield parsed manifest documents one at a time, see ``_safe_load``."""
+        documents = self.cache.stream(filepath, iter_documents, self._digest(filepath))
+        while True:
+            with profiler.tally("manifest load"):
+                doc = next(documents, None)
+            if doc is None:
+                return
+            yield doc
+
+    def _objects(self) -> Iterator[Tuple[AnyResource, bool]]:
+        """Yield the release's objects, and whether a subtraction removes each."""
+        subtractions = [m for m in self.manipulations if isinstance(m, Subtraction)]
+        release_path = self.manifest_path / self.current_release
+        for path in sorted(p for ext in FILE_TYPES for p in release_path.glob(f"*.{ext}")):
+            for doc in self._documents(path):
+                obj = codecs.from_dict(dict(doc))
+                if obj.kind == "CustomResourceDefinition":
+                    create_resources_from_crd(obj)
+                yield obj, any(subtract(obj) for subtract in subtractions)
+
+    def _statics(self) -> Iterator[AnyResource]:
+        """Yield the release's objects which no subtraction removes."""
+        return (obj for obj, subtracted in self._objects() if not subtracted)
+
+    def iter_resources(self) -> Iterator[HashableResource]:
+        """Yield each unique resource once it is patched.
+
+        Resources come in the order of ``resources``, but are read from the
+        manifests one at a time, so a caller which drops each resource holds
+        no more than the largest object instead of the whole release.
+        """
+        additions = (add for m in self.manipulations if isinstance(m, Addition) for add in m)
+        patches = [m for m in self.manipulations if isinstance(m, Patch)]
+        seen = set()
+        for obj in chain(filter(None, additions), self._statics()):
+            for patch in patches:
+                patch(obj)
+            rsc = HashableResource(obj)
+            if str(rsc) not in seen:
+                seen.add(str(rsc))
+                yield rsc
+
+    @property
+    def resources(self) -> KeysView[HashableResource]:
+        """All unique component resources, see ``iter_resources``."""
+        return OrderedDict((rsc, None) for rsc in self.iter_resources()).keys()
+
+    def subtracted_resources(self) -> Iterator[HashableResource]:
+        """Yield the release's objects which a subtraction removes, patched like the rest."""
+        patches = [m for m in self.manipulations if isinstance(m, Patch)]
+        for obj, subtracted in self._objects():
+            if subtracted:
+                for patch in patches:
+                    patch(obj)
+                yield HashableResource(obj)
+
+    def delete_subtracted(self, applied: MutableMapping[str, str]) -> None:
+        """Delete the resources in ``applied`` which a subtraction now removes.
+
+        Leaving out a component keeps its objects from being applied again,
+        and this removes the ones already on the cluster.
+        """
+        if not applied:
+            return
+        resources = [rsc for rsc in self.subtracted_resources() if str(rsc) in applied]
+        if resources:
+            self.delete_resources(*resources, ignore_not_found=True)
+        for rsc in resources:
+            del applied[str(rsc)]
+
+    @property
+    def disabled_components(self) -> FrozenSet[str]:
+        """Components named by the disabled-components config."""
+        names = re.split(r"[\s,]+", self.config.get("disabled-components", ""))
+        return frozenset(filter(None, names))
+
+    @cached_property
+    def release_index(self) -> Mapping:
+        """Index of the shipped releases, see releases.py."""
+        return load_index(self.manifest_path)
+
+    @cached_property
+    def releases(self) -> List[str]:
+        """Shipped releases, highest first, read from the index when it exists."""
+        return list(self.release_index) or super().releases
+
+    def images(self, release: Optional[str] = None) -> List[str]:
+        """Images of a release, pulled from the image-registry config when it is set."""
+        release = release or self.current_release
+        indexed = self.release_index.get(release) or index_release(self.manifest_path / release)
+        registry = self.config.get("image-registry")
+        return sorted({rewrite_image(i, registry) if registry else i for i in indexed["images"]})
 
     @property
-    def config(self) -> Dict:
-        """Returns config mapped from charm config and joined relations."""
-        config: Dict = {}
-        config.update(**self.charm_config.available_data)
+    def config(self) -> Mapping:
+        """Returns the read-only config snapshot shared by all patches."""
+        return self.charm_config.available_data
 
-        for key, value in dict(**config).items():
-            if value == "" or value is None:
-                del config[key]
+    @property
+    def metrics_related(self) -> bool:
+        """Whether a prometheus scrapes the DCGM exporter over metrics-endpoint."""
+        return bool(self.model.relations[METRICS_RELATION])
 
-        config["namespace"] = self.charm.stored.namespace
-        return config
+    @property
+    def nfd_device_classes(self) -> List[str]:
+        """Device classes the charms sharing this NFD deployment need it to scan."""
+        return requested_device_classes(self.model)
 
-    def hash(self) -> int:
-        """Calculate a hash of the current configuration."""
-        return int(md5(pickle.dumps(self.config)).hexdigest(), 16)
+    def status(self) -> FrozenSet[HashableResource]:
+        """Installed resources with status conditions, listing each kind once."""
+        return listed_status(self)
+
+    def hash(self) -> str:
+        """Digest of the raw config and the release rendered by these manifests."""
+        content = f"{self.name}\0{self.current_release}\0{self.charm_config.digest}"
+        content += f"\0{','.join(self.nfd_device_classes)}\0{self.metrics_related}"
+        return sha256(content.encode()).hexdigest()
 
     def evaluate(self) -> Optional[str]:
         """Determine if config can be applied to manifests."""
+        release = self.config.get("release")
+        if release and release not in self.releases:
+            return f"release {release} is not one of: {', '.join(self.releases)}"
+        if unknown := self.disabled_components - COMPONENTS.keys():
+            names = ", ".join(sorted(unknown))
+            return f"disabled-components {names} not one of: {', '.join(COMPONENTS)}"
         return None
 
-    def apply_charm_manifests(self):
-        """Apply manifests from disk as well as those from charm config."""
-        self.apply_manifests()
+    def check_kernels(self) -> Optional[str]:
+        """Determine if the GPU nodes run kernels with precompiled drivers, when used."""
+        if not self.config.get("driver-precompiled"):
+            return None
+        try:
+            nodes = list(self.client.list(Node, labels={GPU_NODE_LABEL: "true"}))
+        except (ApiError, HTTPError) as e:
+            log.warning(f"Skipped checking the kernels of GPU nodes: {e}")
+            return None
+        unsupported = sorted(
+            f"{node.metadata.name} ({kernel})"
+            for node in nodes
+            if kernel_flavor(kernel := node.status.nodeInfo.kernelVersion)
+            not in PRECOMPILED_FLAVORS
+        )
+        if unsupported:
+            return f"No precompiled drivers for the kernels of: {', '.join(unsupported)}"
+        return None
+
+    def rendered_resources(self) -> Iterator[HashableResource]:
+        """Yield all resources this charm applies, in apply order."""
+        return self.iter_resources()
+
+    def apply_charm_manifests(self, applied: MutableMapping[str, str]) -> List[str]:
+        """Apply manifests from disk as well as those from charm config.
+
+        Only resources whose rendered digest differs from the one recorded
+        in ``applied`` are sent to the cluster, in dependency tiers with up to
+        ``apply-concurrency`` api calls at once. ``applied`` is updated as each
+        resource is applied, and the unchanged resources are returned.
+        """
+        concurrency = self.config.get("apply-concurrency", 1)
+        return apply_changed(self, self.rendered_resources, applied, concurrency)
@@ -0,0 +1,97 @@
+# Copyright 2024 Canonical Ltd.
+# See LICENSE file for licensing details.
+"""Reconcile metrics kept between hooks and rendered in the Prometheus text format."""
+
+import threading
+from typing import Dict, MutableMapping
+
+DEFINITIONS = {
+    "charm_hook_duration_seconds": ("histogram", "Duration of the charm's hooks."),
+    "charm_resources_applied_total": ("counter", "Resources applied to the cluster."),
+    "charm_resources_skipped_total": ("counter", "Unchanged resources which were not applied."),
+    "charm_api_calls_total": ("counter", "Kubernetes api calls made by the charm."),
+    "charm_api_errors_total": ("counter", "Kubernetes api calls which failed."),
+    "charm_api_retries_total": ("counter", "Kubernetes api calls retried after an error."),
+    "charm_manifest_client_errors_total": (
+        "counter",
+        "Hooks which failed calling the kubernetes api, by whether they deferred, blocked or retried.",
+    ),
+    "charm_unready_resources": ("gauge", "Installed resources with a condition which isn't True."),
+}
+BUCKETS = (0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+
+def _series(labels: Dict[str, str]) -> str:
+    return ",".join(f'{key}="{value}"' for key, value in sorted(labels.items()))
+
+
+def _line(name: str, series: str, value) -> str:
+    return f"{name}{{{series}}} {value}" if series else f"{name} {value}"
+
+
+class Metrics:
+    """Counters, gauges and histograms which accumulate across hooks.
+
+    Values live in a mapping from the charm's StoredState, bound at the
+    start of each hook, keyed by metric name and then by label set.
+    """
+
+    def __init__(self):
+        self._state: MutableMapping = {}
+        self._lock = threading.Lock()
+
+    def bind(self, state: MutableMapping) -> None:
+        """Record into the given persistent mapping."""
+        self._state = state
+
+    def inc(self, name: str, amount: float = 1, **labels: str) -> None:
+        """Increase a counter."""
+        key = _series(labels)
+        with self._lock:
+            values = self._state.setdefault(name, {})
+            values[key] = values.get(key, 0) + amount
+
+    def set(self, name: str, value: float, **labels: str) -> None:
+        """Set a gauge."""
+        with self._lock:
+            self._state.setdefault(name, {})[_series(labels)] = value
+
+    def observe(self, name: str, value: float, **labels: str) -> None:
+        """Add an observation to a histogram."""
+        key = _series(labels)
+        with self._lock:
+            values = self._state.setdefault(name, {})
+            histogram = values.setdefault(key, {"sum": 0.0, "count": 0})
+            for bound in [*map(str, BUCKETS), "+Inf"]:
+                if bound == "+Inf" or value <= float(bound):
+                    histogram[bound] = histogram.get(bound, 0) + 1
+            histogram["sum"] += value
+            histogram["count"] += 1
+
+    def render(self, **labels: str) -> str:
+        """Render every metric in the Prometheus text format."""
+        lines = []
+        for name, (kind, doc) in DEFINITIONS.items():
+            values = self._state.get(name)
+            if not values:
+                continue
+            lines += [f"# HELP {name} {doc}", f"# TYPE {name} {kind}"]
+            for key, value in sorted(values.items()):
+                series = dict(labels, **_parse(key))
+                if kind != "histogram":
+                    lines.append(_line(name, _series(series), value))
+                    continue
+                for bound in [*map(str, BUCKETS), "+Inf"]:
+                    le = _series(dict(series, le=bound))
+                    lines.append(_line(f"{name}_bucket", le, value.get(bound, 0)))
+                lines.append(_line(f"{name}_sum", _series(series), value["sum"]))
+                lines.append(_line(f"{name}_count", _series(series), value["count"]))
+        return "\n".join(lines) + "\n"
+
+
+def _parse(series: str) -> Dict[str, str]:
+    pairs = (pair.split("=", 1) for pair in series.split(",") if pair)
+    return {key: value.strip('"') for key, value in pairs}
+
+
+metrics = Metrics()
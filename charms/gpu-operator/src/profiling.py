@@ -0,0 +1,110 @@
+# Copyright 2024 Canonical Ltd.
+# See LICENSE file for licensing details.
+"""Opt-in timing spans and cProfile dumps for a single hook."""
+
+import cProfile
+import json
+import logging
+import time
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+from pathlib import Path
+from typing import ContextManager, Dict, List, Optional
+
+log = logging.getLogger(__name__)
+
+ENV_VAR = "CHARM_PROFILING"
+MODES = ("spans", "cprofile")
+
+_DISABLED = nullcontext()
+
+
+class Profiler:
+    """Record how long the parts of a hook take as structured log lines.
+
+    While disabled, ``span`` and ``tally`` hand back a shared no-op context
+    so instrumented code pays for little more than a method call.
+    """
+
+    def __init__(self):
+        self.mode = ""
+        self.hook = ""
+        self._started = 0.0
+        self._tallies: Dict[str, List[float]] = defaultdict(lambda: [0, 0.0])
+        self._profile: Optional[cProfile.Profile] = None
+        self._dump_dir: Optional[Path] = None
+
+    @property
+    def enabled(self) -> bool:
+        """True while a hook is being profiled."""
+        return bool(self.mode)
+
+    def start(self, mode: str, hook: str, dump_dir: Path) -> None:
+        """Begin profiling a hook, when mode is one of MODES."""
+        self.mode = mode if mode in MODES else ""
+        self.hook = hook
+        self._tallies.clear()
+        if not self.mode:
+            return
+        self._started = time.perf_counter()
+        if self.mode == "cprofile":
+            self._dump_dir = dump_dir
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+
+    def span(self, name: str, **attrs) -> ContextManager:
+        """Time a block, logging it as soon as it finishes."""
+        if not self.mode:
+            return _DISABLED
+        return self._span(name, attrs)
+
+    def tally(self, name: str) -> ContextManager:
+        """Time a block run many times, logging the total when the hook finishes."""
+        if not self.mode:
+            return _DISABLED
+        return self._tally(name)
+
+    @contextmanager
+    def _span(self, name: str, attrs: Dict):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._record(name, time.perf_counter() - start, **attrs)
+
+    @contextmanager
+    def _tally(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            tally = self._tallies[name]
+            tally[0] += 1
+            tally[1] += time.perf_counter() - start
+
+    def _record(self, name: str, seconds: float, **attrs) -> None:
+        record = {"hook": self.hook, "span": name, "ms": round(seconds * 1000, 3), **attrs}
+        log.info(json.dumps(record, sort_keys=True, default=str))
+
+    def finish(self, _event=None) -> None:
+        """Log the tallies and the whole hook, then write the cProfile dump."""
+        if not self.mode:
+            return
+        for name, (calls, seconds) in sorted(self._tallies.items()):
+            self._record(name, seconds, calls=calls)
+        self._record("hook", time.perf_counter() - self._started)
+
+        if self._profile and self._dump_dir:
+            self._profile.disable()
+            try:
+                self._dump_dir.mkdir(parents=True, exist_ok=True)
+                path = self._dump_dir / f"{self.hook or 'hook'}-{time.time_ns()}.prof"
+                self._profile.dump_stats(path)
+                log.info(f"Wrote cProfile dump {path}")
+            except OSError as e:
+                log.warning(f"Failed to write cProfile dump: {e}")
+        self._profile = None
+        self.mode = ""
+
+
+profiler = Profiler()
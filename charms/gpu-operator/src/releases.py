@@ -0,0 +1,150 @@
+# Copyright 2024 Canonical Ltd.
+# See LICENSE file for licensing details.
+"""Index of the upstream releases shipped with the charm.
+
+The index is written next to the release directories whenever a release is
+added by ``upstream/update.sh``, so hooks can list releases, key caches and
+report images without parsing any manifest:
+
+    python3 src/releases.py upstream/gpu-operator/manifests
+"""
+
+import json
+import re
+import sys
+from hashlib import sha256
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Mapping, Tuple, Union
+
+from cache import iter_documents
+
+INDEX_FILE = "index.json"
+FILE_TYPES = ("yaml", "yml")
+
+Path_ = Tuple[Union[str, int], ...]
+
+
+def _version_key(release: str):
+    parts = re.split(r"[.\-]", release.lstrip("v"))
+    return [(0, int(part), "") if part.isdigit() else (1, 0, part) for part in parts]
+
+
+def _reference(value: Any) -> bool:
+    return isinstance(value, str) and "://" not in value and ("/" in value or ":" in value)
+
+
+def image_fields(node: Any, path: Path_ = ()) -> Iterator[Tuple[Path_, str]]:
+    """Locate each image reference in an object, yielding its field path and image.
+
+    Besides container images, this finds the repository of each operator
+    component in a ClusterPolicy or NicClusterPolicy, ``*_IMAGE`` env vars and
+    the artifact urls of the kata manager.
+    """
+    if isinstance(node, Mapping):
+        image, repository, version = (node.get(k) for k in ("image", "repository", "version"))
+        if isinstance(image, str) and isinstance(repository, str) and version:
+            yield (*path, "repository"), f"{repository}/{image}:{version}"
+        elif _reference(image):
+            yield (*path, "image"), image
+        elif str(node.get("name", "")).endswith("_IMAGE") and _reference(node.get("value")):
+            yield (*path, "value"), node["value"]
+        elif _reference(node.get("url")) and "pullSecret" in node:
+            yield (*path, "url"), node["url"]
+        for key, value in node.items():
+            yield from image_fields(value, (*path, key))
+    elif isinstance(node, list):
+        for idx, value in enumerate(node):
+            yield from image_fields(value, (*path, idx))
+
+
+def rewrite_image(image: str, registry: str) -> str:
+    """Replace the registry of an image reference, or of a repository."""
+    _, sep, name = image.partition("/")
+    return f"{registry}/{name if sep else image}"
+
+
+def _get(node: Any, key: Union[str, int]) -> Any:
+    if isinstance(key, int) or isinstance(node, Mapping):
+        return node[key]
+    return getattr(node, key)
+
+
+def set_image_registry(obj: Any, path: Path_, registry: str) -> Tuple[str, str]:
+    """Rewrite the image at a field path of a resource or a dict, returning both images."""
+    *parents, field = path
+    for key in parents:
+        obj = _get(obj, key)
+    image = _get(obj, field)
+    rewritten = rewrite_image(image, registry)
+    if isinstance(obj, Mapping):
+        obj[field] = rewritten
+    else:
+        setattr(obj, field, rewritten)
+    return image, rewritten
+
+
+def image_key(kind: str, name: str) -> str:
+    """Key of an object's image fields, which the namespace patches leave unchanged."""
+    return f"{kind}/{name}"
+
+
+def _object(doc: Mapping) -> str:
+    metadata = doc.get("metadata") or {}
+    namespace = metadata.get("namespace")
+    name = metadata.get("name")
+    return "/".join(filter(None, (doc["kind"], namespace, name)))
+
+
+def index_release(release_path: Path) -> Dict:
+    """Describe the manifest files of one release."""
+    files, objects, images, fields = {}, [], set(), {}
+    for path in sorted(p for ext in FILE_TYPES for p in release_path.glob(f"*.{ext}")):
+        content = path.read_bytes()
+        files[path.name] = sha256(content).hexdigest()
+        for doc in iter_documents(path):
+            objects.append(_object(doc))
+            for field, image in image_fields(doc):
+                images.add(image)
+                key = image_key(doc["kind"], doc["metadata"]["name"])
+                fields.setdefault(key, []).append(list(field))
+    return {
+        "files": files,
+        "objects": objects,
+        "images": sorted(images),
+        "image_fields": fields,
+    }
+
+
+def build_index(manifest_path: Path) -> Dict:
+    """Describe every release below the manifest path, highest release first."""
+    releases = sorted(
+        {path.parent.name for ext in FILE_TYPES for path in manifest_path.glob(f"*/*.{ext}")},
+        key=_version_key,
+        reverse=True,
+    )
+    return {release: index_release(manifest_path / release) for release in releases}
+
+
+def load_index(manifest_path: Path) -> Dict:
+    """Read the index of a manifest path, empty when it was never built."""
+    try:
+        return json.loads((manifest_path / INDEX_FILE).read_text())
+    except FileNotFoundError:
+        return {}
+
+
+def write_index(manifest_path: Path) -> Path:
+    """Rebuild the index of a manifest path."""
+    path = manifest_path / INDEX_FILE
+    path.write_text(json.dumps(build_index(manifest_path), indent=2) + "\n")
+    return path
+
+
+def main(args: List[str]) -> None:
+    """Rebuild the index of each given manifest path."""
+    for manifest_path in args:
+        print(f"Wrote {write_index(Path(manifest_path))}")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
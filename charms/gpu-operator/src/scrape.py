@@ -0,0 +1,85 @@
+# Copyright 2024 Canonical Ltd.
+# See LICENSE file for licensing details.
+"""Publish the DCGM exporter's GPU metrics over the metrics-endpoint relation.
+
+The relation follows the prometheus_scrape interface: the app data holds the
+scrape jobs, with a static target for the exporter pod on each GPU node, and
+the juju topology which prometheus labels the metrics with. Exporter pods move
+with the nodes, so the leader refreshes the targets on update-status, which
+also retries a publish the kubernetes api failed.
+"""
+
+import json
+import logging
+from typing import Dict, List
+
+from httpx import HTTPError
+from lightkube.core.exceptions import ApiError
+from lightkube.resources.core_v1 import Pod
+from ops.charm import CharmBase
+from ops.manifests import ManifestClientError, Manifests
+
+log = logging.getLogger(__name__)
+
+RELATION = "metrics-endpoint"
+JOB_NAME = "dcgm-exporter"
+EXPORTER_LABELS = {"app": "nvidia-dcgm-exporter"}
+EXPORTER_PORT = 9400
+
+
+def exporter_targets(manifests: Manifests) -> Dict[str, str]:
+    """Address of the running exporter pod on each node, by node name."""
+    namespace = manifests.config["namespace"]
+    pods = manifests.client.list(Pod, namespace=namespace, labels=EXPORTER_LABELS)
+    return {
+        pod.spec.nodeName: f"{pod.status.podIP}:{EXPORTER_PORT}"
+        for pod in pods
+        if pod.spec.nodeName and pod.status and pod.status.podIP
+    }
+
+
+def scrape_jobs(targets: Dict[str, str], interval: str) -> List[Dict]:
+    """Scrape job of the exporters, labelling each target with its node."""
+    static_configs = [
+        {"targets": [address], "labels": {"node": node}}
+        for node, address in sorted(targets.items())
+    ]
+    return [
+        {
+            "job_name": JOB_NAME,
+            "metrics_path": "/metrics",
+            "scrape_interval": interval,
+            "static_configs": static_configs,
+        }
+    ]
+
+
+def publish_scrape_jobs(charm: CharmBase, manifests: Manifests) -> None:
+    """As the leader, publish the current scrape jobs to each related prometheus."""
+    model = charm.model
+    relations = model.relations[RELATION]
+    if not relations or not model.unit.is_leader():
+        return
+    try:
+        targets = exporter_targets(manifests)
+    except (ApiError, HTTPError, ManifestClientError) as e:
+        # update-status publishes them again
+        log.warning(f"Skipped publishing scrape jobs: {e}")
+        return
+    interval = manifests.config.get("metrics-scrape-interval", "30s")
+    jobs = json.dumps(scrape_jobs(targets, interval))
+    metadata = json.dumps(
+        {
+            "model": model.name,
+            "model_uuid": model.uuid,
+            "application": model.app.name,
+            "unit": model.unit.name,
+            "charm_name": charm.meta.name,
+        },
+        sort_keys=True,
+    )
+    for relation in relations:
+        data = relation.data[model.app]
+        if data.get("scrape_jobs") != jobs:
+            log.info(f"Publishing {len(targets)} scrape targets to {relation.app.name}")
+            data.update({"scrape_jobs": jobs, "scrape_metadata": metadata})
@@ -0,0 +1,206 @@
+# Copyright 2024 Canonical Ltd.
+# See LICENSE file for licensing details.
+"""Cluster status collection for the charm's manifests."""
+
+import logging
+import queue
+import threading
+import time
+from typing import (
+    Dict,
+    FrozenSet,
+    Iterable,
+    Iterator,
+    List,
+    Mapping,
+    MutableMapping,
+    Optional,
+    Set,
+    Tuple,
+    Type,
+)
+
+from httpx import HTTPError
+from lightkube.core.exceptions import ApiError
+from lightkube.core.resource import Resource
+from ops.manifests import HashableResource, ManifestClientError, Manifests
+
+from metrics import metrics
+from profiling import profiler
+
+log = logging.getLogger(__name__)
+
+Conditions = List[List[str]]
+Kind = Tuple[Type[Resource], Optional[str]]
+
+
+def manifest_labels(manifests: Manifests) -> Dict[str, str]:
+    """Labels which select the resources the charm installed for a manifest."""
+    return {
+        "juju.io/application": manifests.model.app.name,
+        "juju.io/manifest": manifests.name,
+    }
+
+
+def expected_kinds(manifests: Manifests) -> Dict[str, Kind]:
+    """Kind and namespace of each expected resource, keyed by ``str(HashableResource)``."""
+    return {str(rsc): (type(rsc.resource), rsc.namespace) for rsc in manifests.iter_resources()}
+
+
+def _conditions(rsc: HashableResource) -> Conditions:
+    return [[cond.type, cond.status] for cond in rsc.status_conditions]
+
+
+def listed_status(manifests: Manifests) -> FrozenSet[HashableResource]:
+    """Installed resources which have status conditions.
+
+    Rather than a GET per expected resource, each kind is listed once per
+    namespace, selected by the labels the manifests apply to every resource.
+    """
+    expected = expected_kinds(manifests)
+    kinds = set(expected.values())
+    labels = manifest_labels(manifests)
+    try:
+        client = manifests.client
+    except ManifestClientError:
+        log.exception("Cannot connect to the api endpoint, no status collected")
+        return frozenset()
+
+    found = set()
+    for kind, namespace in sorted(kinds, key=lambda k: (k[0].__name__, k[1] or "")):
+        metrics.inc("charm_api_calls_total", verb="list", kind=kind.__name__)
+        try:
+            with profiler.span("list", kind=kind.__name__, namespace=namespace):
+                listed = list(client.list(kind, namespace=namespace, labels=labels))
+        except (ApiError, HTTPError):
+            metrics.inc("charm_api_errors_total", verb="list", kind=kind.__name__)
+            log.exception(f"Failed listing {kind.__name__} resources")
+            continue
+        for obj in listed:
+            rsc = HashableResource(obj)
+            if str(rsc) in expected and rsc.status_conditions:
+                found.add(rsc)
+    return frozenset(found)
+
+
+class ReadinessIndex:
+    """Conditions of a manifest's resources, kept current from watch streams.
+
+    Each kind is listed once per namespace to seed the index. Later refreshes
+    only read the events after the stored resourceVersion, falling back to a
+    fresh listing when the apiserver has expired that version. The charm is
+    not a long running process, so each watch is drained until a deadline
+    and resumed on the next refresh.
+    """
+
+    def __init__(self, manifests: Manifests, state: MutableMapping, seconds: float = 2.0):
+        self.manifests = manifests
+        self.state = state
+        self.seconds = seconds
+        state.setdefault("versions", {})
+        state.setdefault("conditions", {})
+
+    @property
+    def conditions(self) -> Iterator[Tuple[str, str, str]]:
+        """Indexed (resource, condition type, condition status) triples."""
+        for by_rsc in self.state["conditions"].values():
+            for rsc, conditions in sorted(by_rsc.items()):
+                for cond_type, cond_status in conditions:
+                    yield rsc, cond_type, cond_status
+
+    def refresh(self) -> None:
+        """Update the index from the cluster, keeping the last known state on failure."""
+        try:
+            self._refresh()
+        except (ManifestClientError, ApiError, HTTPError):
+            log.exception("Failed refreshing the readiness index")
+
+    def _refresh(self) -> None:
+        expected = expected_kinds(self.manifests)
+        kinds = set(expected.values())
+        labels = manifest_labels(self.manifests)
+        client = self.manifests.client
+        deadline = time.monotonic() + self.seconds
+        streams = {}
+        for kind, namespace in kinds:
+            key = f"{kind.__name__}/{namespace or ''}"
+            if version := self.state["versions"].get(key):
+                metrics.inc("charm_api_calls_total", verb="watch", kind=kind.__name__)
+                streams[key] = client.watch(
+                    kind, namespace=namespace, labels=labels, resource_version=version
+                )
+
+        with profiler.span("watch", streams=len(streams)):
+            for key, event in _until(_drain(streams), set(streams), deadline):
+                if isinstance(event, ApiError) and event.status.code == 410:
+                    log.info(f"Watch of {key} expired, listing it again")
+                    self.state["versions"][key] = None
+                elif isinstance(event, Exception):
+                    raise event
+                else:
+                    self._apply_event(key, expected, *event)
+
+        for kind, namespace in kinds:
+            key = f"{kind.__name__}/{namespace or ''}"
+            if not self.state["versions"].get(key):
+                self._seed(key, kind, namespace, expected)
+
+    def _seed(self, key, kind, namespace, expected):
+        metrics.inc("charm_api_calls_total", verb="list", kind=kind.__name__)
+        with profiler.span("list", kind=kind.__name__, namespace=namespace):
+            listing = self.manifests.client.list(
+                kind, namespace=namespace, labels=manifest_labels(self.manifests)
+            )
+        found = [rsc for rsc in map(HashableResource, listing) if str(rsc) in expected]
+        self.state["conditions"][key] = {str(rsc): _conditions(rsc) for rsc in found}
+        self.state["versions"][key] = listing.resourceVersion
+
+    def _apply_event(self, key, expected, event_type, obj):
+        rsc = HashableResource(obj)
+        self.state["versions"][key] = obj.metadata.resourceVersion
+        if str(rsc) not in expected:
+            return
+        by_rsc = self.state["conditions"].setdefault(key, {})
+        if event_type == "DELETED":
+            by_rsc.pop(str(rsc), None)
+        else:
+            by_rsc[str(rsc)] = _conditions(rsc)
+
+
+_DONE = object()
+
+
+def _drain(streams: Mapping[str, Iterable]) -> "queue.Queue":
+    """Read each watch stream on a daemon thread into one queue of (key, event).
+
+    The streams block between events, so reading them concurrently lets every
+    stream deliver its events before the shared deadline.
+    """
+    events: "queue.Queue" = queue.Queue()
+
+    def read(key, stream):
+        try:
+            for event in stream:
+                events.put((key, event))
+        except Exception as e:  # surfaced to the reader
+            events.put((key, e))
+        events.put((key, _DONE))
+
+    for key, stream in streams.items():
+        threading.Thread(target=read, args=(key, stream), daemon=True).start()
+    return events
+
+
+def _until(
+    events: "queue.Queue", pending: Set[str], deadline: float
+) -> Iterator[Tuple[str, object]]:
+    """Yield drained (key, event) pairs until every stream ends or the deadline passes."""
+    while pending and (remaining := deadline - time.monotonic()) > 0:
+        try:
+            key, event = events.get(timeout=remaining)
+        except queue.Empty:
+            return
+        if event is _DONE:
+            pending.discard(key)
+        elif key in pending:
+            yield key, event
@@ -0,0 +1,76 @@
+# Copyright 2024 Canonical Ltd.
+# See LICENSE file for licensing details.
+#
+# Learn more about testing at: https://juju.is/docs/sdk/testing
+
+import shutil
+import unittest.mock as mock
+from collections import deque
+
+import pytest
+from ops.manifests import Patch
+from ops.testing import Harness
+
+from apply import resource_digest
+from manifests import GPUOperatorManifests
+
+RELEASE = "v24.9.2"
+
+
+@pytest.fixture
+def manifests(harness: Harness):
+    with mock.patch.object(GPUOperatorManifests, "current_release", RELEASE):
+        yield harness.charm.collector.manifests["gpu-operator"]
+
+
+def _renamed(doc, copy: int):
+    metadata = doc["metadata"]
+    return {**doc, "metadata": {**metadata, "name": f"{metadata['name']}-{copy}"}}
+
+
+def test_render_stages(harness: Harness, bench, manifests, manifest_cache):
+    config = harness.charm.charm_config
+    path = manifests.manifest_path / RELEASE / "manifest.yaml"
+
+    def fresh():
+        return GPUOperatorManifests(harness.charm, config)
+
+    bench(
+        "parse release",
+        lambda: fresh()._safe_load(path),
+        setup=lambda: shutil.rmtree(manifest_cache, ignore_errors=True),
+    )
+    bench("load cached release", lambda: fresh()._safe_load(path))
+    objs = manifests._resource_from_yaml(path)
+    bench("build objects", lambda: manifests._resource_from_yaml(path))
+    for patch in manifests.manipulations:
+        if isinstance(patch, Patch):
+            bench(f"patch {type(patch).__name__}", lambda: [patch(obj) for obj in objs])
+    rendered = bench("render resources", lambda: list(manifests.resources))
+    bench("stream resources", lambda: deque(manifests.iter_resources(), maxlen=0))
+    bench("config hash", manifests.hash, setup=config.invalidate)
+    resources = list(manifests.resources)
+    bench("resource digests", lambda: [resource_digest(rsc) for rsc in resources])
+
+    assert len(resources) == len(objs)
+    assert rendered.seconds > 0
+
+
+def test_render_scaling(bench, manifests):
+    path = manifests.manifest_path / RELEASE / "manifest.yaml"
+    docs = manifests._safe_load(path)
+    crds = [doc for doc in docs if doc["kind"] == "CustomResourceDefinition"]
+    others = [doc for doc in docs if doc["kind"] != "CustomResourceDefinition"]
+
+    per_object = {}
+    for factor in (1, 10, 100):
+        scaled = crds + [_renamed(doc, copy) for copy in range(factor) for doc in others]
+        with mock.patch.object(GPUOperatorManifests, "_documents", lambda *_: iter(scaled)):
+            stage = bench(
+                f"render resources x{factor}", lambda: list(manifests.resources), rounds=1
+            )
+            assert len(manifests.resources) == len(scaled)
+        per_object[factor] = stage.seconds / len(scaled)
+
+    # rendering should stay linear in the number of objects
+    assert per_object[100] < 5 * per_object[10]
@@ -3,10 +3,15 @@
 #
 # Learn more about testing at: https://juju.is/docs/sdk/testing
 
+import json
+import os
+import subprocess
+import sys
 import unittest.mock as mock
 
 import ops.testing
 import pytest
+import yaml
 from ops.model import ActiveStatus, BlockedStatus, MaintenanceStatus, WaitingStatus
 from ops.testing import Harness
 
@@ -52,7 +57,9 @@ def test_check_config(harness: Harness, lk_client):
             "nfd-worker-conf": "foo: '",
         }
     )
-    assert harness.charm.unit.status == BlockedStatus("nfd-worker-conf is invalid")
+    assert harness.charm.unit.status == BlockedStatus(
+        "nfd-worker-conf is invalid: cannot parse yaml, found unexpected end of stream"
+    )
 
 
 def test_waits_for_config(harness: Harness, lk_client, caplog):
@@ -68,6 +75,46 @@ def test_waits_for_config(harness: Harness, lk_client, caplog):
     assert "Applying Node Feature Discovery ConfigMap Data" in messages
 
 
+def test_shares_nfd(harness: Harness, lk_client):
+    harness.set_leader(is_leader=True)
+    harness.begin_with_initial_hooks()
+    rel_id = harness.add_relation("node-feature-discovery", "nvidia-network-operator")
+    harness.add_relation_unit(rel_id, "nvidia-network-operator/0")
+    assert harness.get_relation_data(rel_id, harness.charm.app.name) == {"namespace": "default"}
+
+    def applied():
+        objs = [call.args[0] for call in lk_client.apply.call_args_list]
+        lk_client.apply.reset_mock()
+        return {f"{obj.kind}/{obj.metadata.name}": obj for obj in objs}
+
+    applied()
+    classes = json.dumps(["0207", "0b40"])
+    harness.update_relation_data(rel_id, "nvidia-network-operator", {"device-classes": classes})
+    objs = applied()
+    # the requirer's NFD resources may have shared names, so they're all applied again
+    assert "DaemonSet/nvidia-charm-node-feature-discovery-worker" in objs
+    assert "Deployment/gpu-operator" not in objs
+    conf = yaml.safe_load(
+        objs["ConfigMap/nvidia-charm-node-feature-discovery-worker-conf"].data["nfd-worker.conf"]
+    )
+    assert conf["sources"]["pci"]["deviceClassWhitelist"] == [
+        "02",
+        "0200",
+        "0207",
+        "0300",
+        "0302",
+        "0b40",
+    ]
+
+    harness.remove_relation(rel_id)
+    conf = yaml.safe_load(
+        applied()["ConfigMap/nvidia-charm-node-feature-discovery-worker-conf"].data[
+            "nfd-worker.conf"
+        ]
+    )
+    assert "0b40" not in conf["sources"]["pci"]["deviceClassWhitelist"]
+
+
 def test_install_or_upgrade_apierror(harness: Harness, lk_client, api_error_klass):
     lk_client.apply.side_effect = api_error_klass
     harness.begin_with_initial_hooks()
@@ -77,3 +124,65 @@ def test_install_or_upgrade_apierror(harness: Harness, lk_client, api_error_klas
     charm._install_or_upgrade(mock_event)
     mock_event.defer.assert_called_once()
     assert isinstance(charm.unit.status, WaitingStatus)
+
+
+LAZY_MODULES = ("lightkube", "ops.manifests", "manifests")
+IMPORT_PROBE = """
+import json, sys
+import charm
+print(json.dumps([m for m in sys.argv[1:] if m in sys.modules]))
+"""
+
+
+def test_charm_import_is_lazy():
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+    cmd = [sys.executable, "-c", IMPORT_PROBE, *LAZY_MODULES]
+    out = subprocess.run(cmd, env=env, capture_output=True, check=True)
+    assert json.loads(out.stdout) == []
+
+
+@pytest.mark.parametrize("hook", ["update_status", "stop"])
+def test_short_circuit_hook_loads_no_manifests(harness: Harness, hook):
+    harness.begin()
+    with mock.patch("cache.ManifestCache.stream") as stream:
+        getattr(harness.charm.on, hook).emit()
+    stream.assert_not_called()
+    assert "collector" not in vars(harness.charm)
+
+
+def test_config_change_applies_only_changed(harness: Harness, lk_client):
+    harness.begin_with_initial_hooks()
+    assert lk_client.apply.call_count > 1
+
+    lk_client.apply.reset_mock()
+    harness.update_config({"nfd-worker-conf": "sources: {pci: {}}"})
+    applied = [(c.args[0].kind, c.args[0].metadata.name) for c in lk_client.apply.call_args_list]
+    assert applied == [("ConfigMap", "nvidia-charm-node-feature-discovery-worker-conf")]
+
+    lk_client.apply.reset_mock()
+    harness.charm.on.upgrade_charm.emit()
+    assert lk_client.apply.call_count == sum(len(d) for d in harness.charm.stored.applied.values())
+
+
+def test_leader_publishes_status(harness: Harness, lk_client):
+    harness.set_leader(is_leader=True)
+    rel_id = harness.add_relation("cluster", "nvidia-gpu-operator")
+    harness.begin_with_initial_hooks()
+    harness.charm.on.update_status.emit()
+    published = json.loads(harness.get_relation_data(rel_id, "nvidia-gpu-operator")["status"])
+    assert published["unready"] == []
+    assert published["short-version"] == harness.charm.collector.short_version
+
+
+def test_follower_renders_leader_status(harness: Harness, lk_client):
+    harness.set_leader(is_leader=False)
+    rel_id = harness.add_relation("cluster", "nvidia-gpu-operator")
+    harness.begin_with_initial_hooks()
+    harness.charm.on.update_status.emit()
+    assert harness.charm.unit.status == WaitingStatus("Waiting for leader to report status")
+
+    lk_client.list.reset_mock()
+    summary = {"unready": ["gpu-operator: Deployment/x is not Available"], "short-version": "v1"}
+    harness.update_relation_data(rel_id, "nvidia-gpu-operator", {"status": json.dumps(summary)})
+    assert harness.charm.unit.status == WaitingStatus(summary["unready"][0])
+    lk_client.list.assert_not_called()
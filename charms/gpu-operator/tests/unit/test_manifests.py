@@ -3,12 +3,24 @@
 #
 # Learn more about testing at: https://juju.is/docs/sdk/testing
 
+import pickle
+import tracemalloc
+import unittest.mock as mock
+from collections import deque
 
 import ops.testing
 import pytest
-from ops.testing import Harness
+import yaml
+from lightkube import codecs
+from ops.manifests import Patch
+from ops.model import BlockedStatus
+from ops.testing import ActionFailed, Harness
 
+from cache import ManifestCache, iter_documents
 from charm import GPUOperatorCharm
+from config import VALIDATORS
+from manifests import GPUOperatorManifests
+from releases import build_index, image_fields, load_index
 
 ops.testing.SIMULATE_CAN_CONNECT = True
 
@@ -33,3 +45,407 @@ def test_waits_for_config(harness: Harness, lk_client, caplog):
 
     messages = {r.message for r in caplog.records if "manifests" in r.filename}
     assert "Applying Node Feature Discovery ConfigMap Data" in messages
+
+
+def test_config_parsed_once_per_hook(harness: Harness, lk_client):
+    harness.begin_with_initial_hooks()
+    harness.charm.charm_config.invalidate()
+    harness.charm.charm_config._loaded.clear()
+    manifests = harness.charm.collector.manifests["gpu-operator"]
+
+    with mock.patch("config.yaml.safe_load", wraps=yaml.safe_load) as safe_load:
+        resources = manifests.resources
+        # render the release a few more times, growing the number of patched objects
+        for _ in range(3):
+            patches = [m for m in manifests.manipulations if isinstance(m, Patch)]
+            for rsc in resources:
+                for patch in patches:
+                    patch(rsc.resource)
+        manifests.hash()
+        harness.charm.charm_config.evaluate()
+
+    assert len(resources) > len(harness.charm.charm_config.YAML_OPTIONS)
+    assert safe_load.call_count == len(harness.charm.charm_config.YAML_OPTIONS)
+
+
+def test_config_hash_is_canonical(harness: Harness, lk_client):
+    harness.begin_with_initial_hooks()
+    config = harness.charm.charm_config
+    manifests = harness.charm.collector.manifests["gpu-operator"]
+    before = manifests.hash()
+    assert len(before) == 64
+
+    # the same values in another order hash the same
+    reordered = dict(reversed(list(harness.charm.config.items())))
+    with mock.patch.object(type(harness.charm), "config", new=reordered):
+        config.invalidate()
+        assert manifests.hash() == before
+
+    config.invalidate()
+    with mock.patch.object(type(manifests), "current_release", new="v0.0.1"):
+        assert manifests.hash() != before
+
+    # operational options leave the rendered manifests alone
+    harness.update_config({"profiling": "spans", "readiness-watch": True, "apply-concurrency": 2})
+    assert manifests.hash() == before
+
+    harness.update_config({"nfd-worker-conf": "sources: {}\n# changed"})
+    assert manifests.hash() != before
+
+
+def test_config_snapshot_invalidated(harness: Harness, lk_client):
+    harness.begin_with_initial_hooks()
+    config = harness.charm.charm_config
+    snapshot = config.available_data
+    assert config.available_data is snapshot
+    with pytest.raises(TypeError):
+        snapshot["namespace"] = "other"  # type: ignore
+
+    harness.update_config({"image-registry": "my.registry"})
+    assert config.available_data is not snapshot
+    assert config.available_data["image-registry"] == "my.registry"
+
+
+def test_config_validated_once_per_value(harness: Harness, lk_client):
+    harness.begin_with_initial_hooks()
+    config = harness.charm.charm_config
+    validator = VALIDATORS["nfd-worker-conf"]
+    harness.update_config({"nfd-worker-conf": "sources: {}"})
+
+    with mock.patch("config.yaml.safe_load", wraps=yaml.safe_load) as safe_load, mock.patch.object(
+        validator, "iter_errors", wraps=validator.iter_errors
+    ) as iter_errors:
+        config.invalidate()
+        assert config.evaluate() is None
+        assert safe_load.call_count == iter_errors.call_count == 0
+
+        harness.update_config({"nfd-worker-conf": "sources: []\ncore: 1"})
+        assert safe_load.call_count == iter_errors.call_count == 1
+        assert harness.charm.unit.status == BlockedStatus(
+            "nfd-worker-conf is invalid: $.sources: [] is not of type 'object'"
+        )
+
+
+def test_manifest_cache_hit(harness: Harness, manifest_cache):
+    harness.begin()
+
+    def hook_start():
+        return GPUOperatorManifests(harness.charm, harness.charm.charm_config).resources
+
+    with mock.patch("manifests.iter_documents", side_effect=iter_documents) as parser:
+        cold = hook_start()
+    parser.assert_called()
+    assert list(manifest_cache.glob("*.pickle"))
+    with mock.patch("manifests.iter_documents") as parser:
+        cached = hook_start()
+    parser.assert_not_called()
+    assert [str(r) for r in cached] == [str(r) for r in cold]
+
+
+def test_manifest_cache_keyed_by_release(tmp_path, manifest_cache):
+    cache = ManifestCache(manifest_cache)
+    manifest_cache.mkdir(parents=True, exist_ok=True)
+    unkeyed = manifest_cache / f"manifest-{'0' * 64}.pickle"
+    unkeyed.write_bytes(pickle.dumps([{"kind": "A", "apiVersion": "v1"}]))
+    for release in ("v1", "v2"):
+        path = tmp_path / release / "manifest.yaml"
+        path.parent.mkdir()
+        path.write_text(f"kind: A\napiVersion: v1\nmetadata: {{name: {release}}}")
+        cache.load(path, iter_documents)
+    assert {p.name.split("-")[0] for p in manifest_cache.glob("*.pickle")} == {"v1", "v2"}
+    assert not unkeyed.exists()
+    with mock.patch("cache.yaml.load_all") as load_all:
+        assert cache.load(path, iter_documents)[0]["metadata"]["name"] == "v2"
+    load_all.assert_not_called()
+
+
+def test_manifest_cache_streams(tmp_path, manifest_cache):
+    path = tmp_path / "manifest.yaml"
+    documents = ["kind: List\napiVersion: v1\nitems: [{kind: A, apiVersion: v1}]", "null"]
+    path.write_text("\n---\n".join([*documents, "kind: B\napiVersion: v1"]))
+    cache = ManifestCache(manifest_cache)
+
+    # an abandoned stream stores nothing
+    next(cache.stream(path, iter_documents))
+    assert not list(manifest_cache.iterdir())
+
+    assert [doc["kind"] for doc in cache.stream(path, iter_documents)] == ["A", "B"]
+    with mock.patch("cache.yaml.load_all") as load_all:
+        assert [doc["kind"] for doc in cache.stream(path, iter_documents)] == ["A", "B"]
+    load_all.assert_not_called()
+    assert [p.suffix for p in manifest_cache.iterdir()] == [".pickle"]
+
+
+def test_streamed_resources_memory(harness: Harness, manifest_cache):
+    harness.begin()
+    manifests = GPUOperatorManifests(harness.charm, harness.charm.charm_config)
+    path = manifests.manifest_path / manifests.current_release / "manifest.yaml"
+    blobs = [pickle.dumps(doc) for doc in manifests._safe_load(path)]
+
+    def peak(render):
+        tracemalloc.start()
+        try:
+            render()
+            return tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    deque(manifests.iter_resources(), maxlen=0)  # import models before tracing
+
+    def render_one(blob):
+        obj = codecs.from_dict(pickle.loads(blob))
+        for patch in manifests.manipulations:
+            if isinstance(patch, Patch):
+                patch(obj)
+
+    largest = max(peak(lambda: render_one(blob)) for blob in blobs)
+    streamed = peak(lambda: deque(manifests.iter_resources(), maxlen=0))
+    whole = peak(lambda: manifests.resources)
+    assert streamed < whole
+    assert streamed < 2 * largest
+
+
+def test_release_index_is_current(harness: Harness):
+    harness.begin()
+    manifests = harness.charm.collector.manifests["gpu-operator"]
+    # rebuild with: python3 src/releases.py upstream/gpu-operator/manifests
+    assert load_index(manifests.manifest_path) == build_index(manifests.manifest_path)
+    assert manifests.releases == list(manifests.release_index)
+
+
+def test_release_index_keys_cache(harness: Harness, manifest_cache):
+    harness.begin()
+    manifests = GPUOperatorManifests(harness.charm, harness.charm.charm_config)
+    with mock.patch.object(ManifestCache, "digest") as digest:
+        assert manifests.resources
+    digest.assert_not_called()
+    release = manifests.release_index[manifests.current_release]
+    pickles = {path.name for path in manifest_cache.glob("*.pickle")}
+    assert pickles == {
+        f"{manifests.current_release}-manifest-{digest}.pickle"
+        for digest in release["files"].values()
+    }
+
+
+def test_release_config(harness: Harness, lk_client):
+    harness.begin_with_initial_hooks()
+    manifests = harness.charm.collector.manifests["gpu-operator"]
+    harness.update_config({"release": "v0.0.0"})
+    assert harness.charm.unit.status == BlockedStatus(
+        f"release v0.0.0 is not one of: {', '.join(manifests.releases)}"
+    )
+
+    harness.update_config({"release": "v24.9.2"})
+    assert manifests.current_release == "v24.9.2"
+    assert not isinstance(harness.charm.unit.status, BlockedStatus)
+
+
+def test_image_registry(harness: Harness, lk_client):
+    harness.begin()
+    harness.update_config({"image-registry": "registry.local"})
+    manifests = GPUOperatorManifests(harness.charm, harness.charm.charm_config)
+    objs = [rsc.resource.to_dict() for rsc in manifests.rendered_resources()]
+    images = [image for obj in objs for _, image in image_fields(obj)]
+    assert images and all(image.startswith("registry.local/") for image in images)
+    policy = next(obj for obj in objs if obj["kind"] == "ClusterPolicy")
+    assert policy["spec"]["driver"]["repository"] == "registry.local/nvidia"
+    env = {e["name"]: e["value"] for e in policy["spec"]["driver"]["manager"]["env"]}
+    assert env.get("DRIVER_MANAGER_IMAGE", "registry.local/").startswith("registry.local/")
+
+    # the release index locates the same fields as walking each object
+    with mock.patch.object(GPUOperatorManifests, "release_index", {}):
+        manifests = GPUOperatorManifests(harness.charm, harness.charm.charm_config)
+        assert [rsc.resource.to_dict() for rsc in manifests.rendered_resources()] == objs
+
+
+def test_list_images_action(harness: Harness, lk_client):
+    harness.begin()
+    manifests = harness.charm.collector.manifests["gpu-operator"]
+    output = harness.run_action("list-images")
+    images = output.results["images"].splitlines()
+    assert len(images) == len(manifests.release_index[manifests.current_release]["images"])
+
+    harness.update_config({"image-registry": "registry.local"})
+    output = harness.run_action("list-images", {"release": manifests.releases[-1]})
+    images = output.results["images"].splitlines()
+    assert images and all(image.startswith("registry.local/") for image in images)
+
+    with pytest.raises(ActionFailed):
+        harness.run_action("list-images", {"release": "v0.0.0"})
+
+
+def test_disabled_components(harness: Harness, lk_client):
+    harness.begin_with_initial_hooks()
+    manifests = harness.charm.collector.manifests["gpu-operator"]
+    applied = harness.charm.stored.applied["gpu-operator"]
+    before = set(applied)
+    lk_client.list.reset_mock()
+    harness.update_config({"disabled-components": "upgrade-crd, nvidiadriver-crd"})
+
+    names = {
+        "gpu-operator-upgrade-crd",
+        "gpu-operator-upgrade-crd-hook-sa",
+        "gpu-operator-upgrade-crd-hook-role",
+        "gpu-operator-upgrade-crd-hook-binding",
+        "nvidiadrivers.nvidia.com",
+    }
+    assert {rsc.name for rsc in manifests.rendered_resources()}.isdisjoint(names)
+    # the resources already applied are deleted
+    deleted = {
+        call.kwargs["fields"]["metadata.name"]
+        for call in lk_client.list.call_args_list
+        if "fields" in call.kwargs
+    }
+    assert deleted == names
+    assert {key.rsplit("/", 1)[-1] for key in before - set(applied)} == names
+
+    harness.update_config({"disabled-components": "drivers"})
+    assert harness.charm.unit.status == BlockedStatus(
+        "disabled-components drivers not one of: nfd, nfd-gc, nfd-prune, upgrade-crd, nvidiadriver-crd"
+    )
+
+
+TIME_SLICING = """
+sharing:
+  timeSlicing:
+    resources:
+    - {name: nvidia.com/gpu, replicas: 4}
+"""
+MIG_CONFIG = """
+version: v1
+mig-configs:
+  all-disabled:
+  - {devices: all, mig-enabled: false}
+  all-3g.40gb:
+  - {devices: all, mig-enabled: true, mig-devices: {3g.40gb: 2}}
+"""
+
+
+def test_gpu_sharing(harness: Harness, lk_client):
+    harness.begin_with_initial_hooks()
+    harness.update_config(
+        {
+            "time-slicing": TIME_SLICING,
+            "mig-config": MIG_CONFIG,
+            "mig-profile": "all-3g.40gb",
+            "mig-strategy": "mixed",
+        }
+    )
+    assert not isinstance(harness.charm.unit.status, BlockedStatus)
+    manifests = harness.charm.collector.manifests["gpu-operator"]
+    objs = {str(rsc): rsc.resource for rsc in manifests.rendered_resources()}
+
+    time_slicing = objs["ConfigMap/default/time-slicing-config"]
+    assert yaml.safe_load(time_slicing.data["any"]) == {
+        "version": "v1",
+        **yaml.safe_load(TIME_SLICING),
+    }
+    mig_config = objs["ConfigMap/default/custom-mig-parted-config"]
+    assert yaml.safe_load(mig_config.data["config.yaml"]) == yaml.safe_load(MIG_CONFIG)
+
+    spec = objs["ClusterPolicy/cluster-policy"].spec
+    assert spec["devicePlugin"]["config"] == {"name": "time-slicing-config", "default": "any"}
+    assert spec["mig"]["strategy"] == "mixed"
+    assert spec["migManager"]["config"] == {
+        "name": "custom-mig-parted-config",
+        "default": "all-3g.40gb",
+    }
+
+
+@pytest.mark.parametrize(
+    "config, message",
+    [
+        (
+            {"time-slicing": "sharing: {timeSlicing: {resources: [{name: gpu, replicas: 1}]}}"},
+            "time-slicing is invalid: $.sharing.timeSlicing.resources[0].name: "
+            "'gpu' does not match '^nvidia\\\\.com/'; "
+            "$.sharing.timeSlicing.resources[0].replicas: 1 is less than the minimum of 2",
+        ),
+        ({"mig-strategy": "all"}, "mig-strategy must be one of: none, single, mixed"),
+        (
+            {"mig-config": MIG_CONFIG, "mig-profile": "all-1g.10gb"},
+            "mig-profile all-1g.10gb is not one of the mig-configs of mig-config",
+        ),
+    ],
+)
+def test_gpu_sharing_invalid(harness: Harness, lk_client, config, message):
+    harness.begin_with_initial_hooks()
+    harness.update_config(config)
+    assert harness.charm.unit.status == BlockedStatus(message)
+
+
+def test_driver_precompiled(harness: Harness, lk_client):
+    harness.begin_with_initial_hooks()
+    manifests = harness.charm.collector.manifests["gpu-operator"]
+
+    def driver():
+        rendered = manifests.rendered_resources()
+        return next(rsc.resource for rsc in rendered if rsc.kind == "ClusterPolicy").spec["driver"]
+
+    harness.update_config({"driver-version": "550.127.05"})
+    assert driver()["version"] == "550.127.05" and not driver()["usePrecompiled"]
+
+    harness.update_config(
+        {"driver-precompiled": True, "driver-version": "", "image-registry": "registry.local"}
+    )
+    assert driver()["usePrecompiled"] and driver()["version"] == "550"
+    assert driver()["repository"] == "registry.local/nvidia"
+
+    harness.update_config({"driver-version": "535"})
+    assert driver()["version"] == "535"
+
+
+@pytest.mark.parametrize(
+    "config, message",
+    [
+        ({"driver-version": "550"}, "driver-version must be a driver version, such as 550.144.03"),
+        (
+            {"driver-precompiled": True, "driver-version": "550.144.03"},
+            "driver-version must be a driver branch, such as 550, when precompiled",
+        ),
+    ],
+)
+def test_driver_version_invalid(harness: Harness, lk_client, config, message):
+    harness.begin_with_initial_hooks()
+    harness.update_config(config)
+    assert harness.charm.unit.status == BlockedStatus(message)
+
+
+def test_precompiled_kernels(harness: Harness, lk_client):
+    harness.begin_with_initial_hooks()
+    node = mock.MagicMock()
+    node.metadata.name = "gpu-0"
+    node.status.nodeInfo.kernelVersion = "6.8.0-1008-lowlatency"
+    lk_client.list.return_value = [node]
+
+    harness.update_config({"driver-precompiled": True})
+    assert harness.charm.unit.status == BlockedStatus(
+        "No precompiled drivers for the kernels of: gpu-0 (6.8.0-1008-lowlatency)"
+    )
+    node_labels = lk_client.list.call_args.kwargs["labels"]
+    assert node_labels == {"feature.node.kubernetes.io/pci-10de.present": "true"}
+
+    node.status.nodeInfo.kernelVersion = "5.15.0-1048-nvidia"
+    harness.update_config({"driver-version": "535"})
+    assert not isinstance(harness.charm.unit.status, BlockedStatus)
+
+
+def test_status_lists_each_kind_once(harness: Harness, lk_client):
+    harness.begin()
+    manifests = harness.charm.collector.manifests["gpu-operator"]
+    expected = {rsc.kind: rsc for rsc in manifests.resources}["ClusterPolicy"]
+    status = {"conditions": [{"type": "Ready", "status": "False"}]}
+    installed = codecs.from_dict({**expected.resource.to_dict(), "status": status})
+
+    def list_kind(kind, namespace=None, labels=None):
+        return [installed] if labels and kind is type(installed) else []
+
+    lk_client.list.side_effect = list_kind
+    assert harness.charm.collector.unready == [
+        "gpu-operator: ClusterPolicy/cluster-policy is not Ready"
+    ]
+    kinds = {(type(rsc.resource), rsc.namespace) for rsc in manifests.resources}
+    labelled = [c for c in lk_client.list.call_args_list if c.kwargs.get("labels")]
+    assert len(labelled) == len(kinds)
+    assert all(c.kwargs["labels"]["juju.io/manifest"] == manifests.name for c in labelled)
+    lk_client.get.assert_not_called()
@@ -0,0 +1,83 @@
+# Copyright 2024 Canonical Ltd.
+# See LICENSE file for licensing details.
+#
+# Learn more about testing at: https://juju.is/docs/sdk/testing
+
+import ops.testing
+import pytest
+from ops.testing import Harness
+
+from charm import GPUOperatorCharm
+from metrics import Metrics
+
+ops.testing.SIMULATE_CAN_CONNECT = True
+
+
+@pytest.fixture
+def harness():
+    harness = Harness(GPUOperatorCharm)
+    try:
+        yield harness
+    finally:
+        harness.cleanup()
+
+
+def scrape(text: str):
+    """Parse the Prometheus text format like a scraper, by name and label set."""
+    samples = {}
+    for line in text.splitlines():
+        if not line or line.startswith("#"):
+            continue
+        series, value = line.rsplit(" ", 1)
+        name, _, labels = series.partition("{")
+        pairs = (pair.split("=", 1) for pair in labels.rstrip("}").split(",") if pair)
+        samples[(name, frozenset((k, v.strip('"')) for k, v in pairs))] = float(value)
+    return samples
+
+
+def test_metrics_render():
+    state: dict = {}
+    metrics = Metrics()
+    metrics.bind(state)
+    metrics.inc("charm_api_calls_total", verb="list", kind="Pod")
+    metrics.inc("charm_api_calls_total", 2, verb="list", kind="Pod")
+    metrics.set("charm_unready_resources", 3)
+    metrics.observe("charm_hook_duration_seconds", 0.7, hook="install")
+
+    samples = scrape(metrics.render(juju_unit="app/0"))
+    unit = ("juju_unit", "app/0")
+    calls = frozenset({unit, ("verb", "list"), ("kind", "Pod")})
+    assert samples[("charm_api_calls_total", calls)] == 3
+    assert samples[("charm_unready_resources", frozenset({unit}))] == 3
+    bucket = frozenset({unit, ("hook", "install"), ("le", "0.5")})
+    assert samples[("charm_hook_duration_seconds_bucket", bucket)] == 0
+    bucket = frozenset({unit, ("hook", "install"), ("le", "1.0")})
+    assert samples[("charm_hook_duration_seconds_bucket", bucket)] == 1
+    count = frozenset({unit, ("hook", "install")})
+    assert samples[("charm_hook_duration_seconds_count", count)] == 1
+
+
+def test_metrics_action(harness: Harness, lk_client, monkeypatch):
+    monkeypatch.setenv("JUJU_DISPATCH_PATH", "hooks/config-changed")
+    harness.begin()
+    harness.set_leader(True)
+    harness.update_config({"nfd-worker-conf": "sources: {}"})
+    harness.charm.framework.on.pre_commit.emit()
+
+    samples = scrape(harness.run_action("metrics").results["metrics"])
+    unit = ("juju_unit", harness.charm.unit.name)
+    manifest = frozenset({unit, ("manifest", "gpu-operator")})
+    applied = samples[("charm_resources_applied_total", manifest)]
+    assert applied == len(harness.charm.stored.applied["gpu-operator"])
+    hook = frozenset({unit, ("hook", "config-changed")})
+    assert samples[("charm_hook_duration_seconds_count", hook)] == 1
+
+    # unchanged resources are counted as skipped on the next apply
+    harness.charm.stored.config_hash = None
+    harness.update_config({"image-registry": "my.registry"})
+    harness.charm.on.update_status.emit()
+    harness.charm.framework.on.pre_commit.emit()
+    samples = scrape(harness.run_action("metrics").results["metrics"])
+    assert samples[("charm_resources_skipped_total", manifest)] > 0
+    assert ("charm_unready_resources", frozenset({unit})) in samples
+    assert samples[("charm_hook_duration_seconds_count", hook)] == 2
@@ -0,0 +1,127 @@
+# Copyright 2024 Canonical Ltd.
+# See LICENSE file for licensing details.
+#
+# Learn more about testing at: https://juju.is/docs/sdk/testing
+
+import json
+import unittest.mock as mock
+
+import ops.testing
+import pytest
+from lightkube.resources.core_v1 import Pod
+from ops.manifests import ManifestClientError
+from ops.model import BlockedStatus
+from ops.testing import Harness
+
+from charm import GPUOperatorCharm
+
+ops.testing.SIMULATE_CAN_CONNECT = True
+METRICS = "DCGM_FI_DEV_GPU_UTIL, gauge, GPU utilization (in %).\n"
+
+
+@pytest.fixture
+def harness():
+    harness = Harness(GPUOperatorCharm)
+    try:
+        yield harness
+    finally:
+        harness.cleanup()
+
+
+def exporter_pod(node: str, ip: str) -> mock.MagicMock:
+    pod = mock.MagicMock()
+    pod.spec.nodeName, pod.status.podIP = node, ip
+    return pod
+
+
+def cluster_policy(harness: Harness):
+    manifests = harness.charm.collector.manifests["gpu-operator"]
+    return next(
+        rsc.resource for rsc in manifests.rendered_resources() if rsc.kind == "ClusterPolicy"
+    )
+
+
+def test_metrics_endpoint(harness: Harness, lk_client):
+    pods = [exporter_pod("gpu-0", "10.1.0.5")]
+    lk_client.list.side_effect = lambda kind, **_: pods if kind is Pod else []
+    harness.set_leader(is_leader=True)
+    harness.begin_with_initial_hooks()
+    rel_id = harness.add_relation("metrics-endpoint", "prometheus")
+    harness.add_relation_unit(rel_id, "prometheus/0")
+
+    data = harness.get_relation_data(rel_id, harness.charm.app.name)
+    (job,) = json.loads(data["scrape_jobs"])
+    assert job["scrape_interval"] == "30s"
+    assert job["static_configs"] == [{"targets": ["10.1.0.5:9400"], "labels": {"node": "gpu-0"}}]
+    assert json.loads(data["scrape_metadata"])["charm_name"] == "nvidia-gpu-operator"
+    pod_list = next(c for c in lk_client.list.call_args_list if c.args[0] is Pod)
+    assert pod_list.kwargs == {"namespace": "default", "labels": {"app": "nvidia-dcgm-exporter"}}
+
+    exporter = cluster_policy(harness).spec["dcgmExporter"]
+    assert exporter["enabled"]
+    env = {var["name"]: var["value"] for var in exporter["env"]}
+    assert env["DCGM_EXPORTER_INTERVAL"] == "30000"
+
+    # targets follow the exporter pods
+    pods.append(exporter_pod("gpu-1", "10.1.0.6"))
+    harness.charm.on.update_status.emit()
+    data = harness.get_relation_data(rel_id, harness.charm.app.name)
+    (job,) = json.loads(data["scrape_jobs"])
+    assert [config["labels"]["node"] for config in job["static_configs"]] == ["gpu-0", "gpu-1"]
+
+
+def test_metrics_endpoint_api_unreachable(harness: Harness, lk_client):
+    unreachable = {"pods": True}
+
+    def list_kind(kind, **_):
+        if kind is Pod and unreachable["pods"]:
+            raise ManifestClientError("Failed to load in cluster CRDs")
+        return [exporter_pod("gpu-0", "10.1.0.5")] if kind is Pod else []
+
+    lk_client.list.side_effect = list_kind
+    harness.set_leader(is_leader=True)
+    harness.begin_with_initial_hooks()
+    rel_id = harness.add_relation("metrics-endpoint", "prometheus")
+    harness.add_relation_unit(rel_id, "prometheus/0")
+    assert "scrape_jobs" not in harness.get_relation_data(rel_id, harness.charm.app.name)
+
+    unreachable["pods"] = False
+    harness.charm.on.update_status.emit()
+    assert "scrape_jobs" in harness.get_relation_data(rel_id, harness.charm.app.name)
+
+
+def test_dcgm_metrics(harness: Harness, lk_client):
+    harness.begin_with_initial_hooks()
+    harness.update_config({"dcgm-metrics": METRICS, "metrics-scrape-interval": "1m"})
+    manifests = harness.charm.collector.manifests["gpu-operator"]
+    objs = {str(rsc): rsc.resource for rsc in manifests.rendered_resources()}
+    assert objs["ConfigMap/default/custom-dcgm-metrics"].data == {"dcgm-metrics.csv": METRICS}
+
+    exporter = objs["ClusterPolicy/cluster-policy"].spec["dcgmExporter"]
+    assert exporter["config"] == {"name": "custom-dcgm-metrics"}
+    env = {var["name"]: var["value"] for var in exporter["env"]}
+    assert env["DCGM_EXPORTER_COLLECTORS"] == "/etc/dcgm-exporter/dcgm-metrics.csv"
+    assert env["DCGM_EXPORTER_INTERVAL"] == "60000"
+    assert env["DCGM_EXPORTER_LISTEN"] == ":9400"
+
+
+@pytest.mark.parametrize(
+    "config, message",
+    [
+        (
+            {"metrics-scrape-interval": "30"},
+            "metrics-scrape-interval must be a duration, such as 30s",
+        ),
+        (
+            {
+                "dcgm-metrics": "# fields\nDCGM_FI_DEV_GPU_UTIL, gauge\nDCGM_FI_DEV_SM_CLOCK, int, x"
+            },
+            "dcgm-metrics is invalid: line 2 is not: DCGM field, type, help; "
+            "line 3 type must be one of: gauge, counter, label",
+        ),
+    ],
+)
+def test_metrics_config_invalid(harness: Harness, lk_client, config, message):
+    harness.begin_with_initial_hooks()
+    harness.update_config(config)
+    assert harness.charm.unit.status == BlockedStatus(message)
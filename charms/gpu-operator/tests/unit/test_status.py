@@ -0,0 +1,156 @@
+# Copyright 2024 Canonical Ltd.
+# See LICENSE file for licensing details.
+#
+# Learn more about testing at: https://juju.is/docs/sdk/testing
+
+import threading
+import unittest.mock as mock
+
+import ops.testing
+import pytest
+from lightkube import codecs
+from ops.model import ActiveStatus, WaitingStatus
+from ops.testing import Harness
+
+from charm import GPUOperatorCharm
+from status import ReadinessIndex, expected_kinds
+
+ops.testing.SIMULATE_CAN_CONNECT = True
+MANIFEST = "gpu-operator"
+KIND = "ClusterPolicy"
+
+
+class FakeListing(list):
+    def __init__(self, items, version):
+        super().__init__(items)
+        self.resourceVersion = version
+
+
+@pytest.fixture
+def harness():
+    harness = Harness(GPUOperatorCharm)
+    try:
+        yield harness
+    finally:
+        harness.cleanup()
+
+
+@pytest.fixture
+def installed(harness: Harness):
+    """Build an installed copy of the watched resource with a given readiness."""
+    harness.begin()
+    manifests = harness.charm.collector.manifests[MANIFEST]
+    expected = {rsc.kind: rsc for rsc in manifests.resources}[KIND]
+
+    def _installed(ready: str, version: str):
+        data = expected.resource.to_dict()
+        data["metadata"] = {**data["metadata"], "resourceVersion": version}
+        data["status"] = {"conditions": [{"type": "Ready", "status": ready}]}
+        return codecs.from_dict(data)
+
+    return _installed
+
+
+def test_index_seeds_then_watches(harness: Harness, lk_client, installed):
+    manifests = harness.charm.collector.manifests[MANIFEST]
+
+    def list_kind(kind, namespace=None, labels=None):
+        return FakeListing([installed("False", "1")] if kind.__name__ == KIND else [], "1")
+
+    lk_client.list.side_effect = list_kind
+    state: dict = {}
+    ReadinessIndex(manifests, state).refresh()
+    assert [c[1:] for c in ReadinessIndex(manifests, state).conditions] == [("Ready", "False")]
+    assert lk_client.watch.call_count == 0
+
+    lk_client.list.reset_mock()
+    lk_client.watch.side_effect = lambda kind, **kw: iter(
+        [("MODIFIED", installed("True", "2"))] if kind.__name__ == KIND else []
+    )
+    index = ReadinessIndex(manifests, state, seconds=1)
+    index.refresh()
+    assert [c[1:] for c in index.conditions] == [("Ready", "True")]
+    resumed = {c.kwargs["resource_version"] for c in lk_client.watch.call_args_list}
+    assert resumed == {"1"}
+    assert state["versions"][f"{KIND}/"] == "2"
+    assert not [c for c in lk_client.list.call_args_list if c.kwargs.get("labels")]
+
+
+def test_index_drains_blocking_watches_together(harness: Harness, lk_client, installed):
+    manifests = harness.charm.collector.manifests[MANIFEST]
+    released = threading.Event()
+
+    def watch(kind, **_):
+        yield "MODIFIED", installed("True", "2")
+        released.wait()  # an idle watch blocks until the server closes it
+
+    lk_client.watch.side_effect = watch
+    kinds = {f"{kind.__name__}/{ns or ''}" for kind, ns in expected_kinds(manifests).values()}
+    state = {"versions": dict.fromkeys(kinds, "1"), "conditions": {}}
+    try:
+        ReadinessIndex(manifests, state, seconds=0.5).refresh()
+    finally:
+        released.set()
+    assert len(kinds) > 1
+    assert state["versions"] == dict.fromkeys(kinds, "2")
+    assert {c[1:] for c in ReadinessIndex(manifests, state).conditions} == {("Ready", "True")}
+
+
+def test_index_relists_expired_watch(harness: Harness, lk_client, installed, api_error_klass):
+    manifests = harness.charm.collector.manifests[MANIFEST]
+    key = f"{KIND}/"
+    expired = api_error_klass()
+    expired.status.code = 410
+
+    def watch(kind, **_):
+        if kind.__name__ == KIND:
+            raise expired
+        yield from ()
+
+    lk_client.watch.side_effect = watch
+    lk_client.list.side_effect = lambda kind, **_: FakeListing(
+        [installed("True", "5")] if kind.__name__ == KIND else [], "5"
+    )
+    state = {"versions": {key: "1"}, "conditions": {}}
+    ReadinessIndex(manifests, state, seconds=1).refresh()
+    assert state["versions"][key] == "5"
+    assert state["conditions"][key] == {f"{KIND}/cluster-policy": [["Ready", "True"]]}
+
+
+def test_readiness_changed_event(harness: Harness, lk_client, installed):
+    current = {"ready": "False"}
+    lk_client.list.side_effect = lambda kind, **kw: FakeListing(
+        ([installed(current["ready"], "1")] if kind.__name__ == KIND and kw.get("labels") else []),
+        "1",
+    )
+    lk_client.watch.side_effect = lambda kind, **kw: iter(
+        [("MODIFIED", installed(current["ready"], "2"))] if kind.__name__ == KIND else []
+    )
+    harness.set_leader(True)
+    harness.update_config({"readiness-watch": True})
+    harness.charm.on.config_changed.emit()
+
+    with mock.patch.object(GPUOperatorCharm, "_on_readiness_changed") as on_changed:
+        harness.charm.on.update_status.emit()
+        assert isinstance(harness.charm.unit.status, WaitingStatus)
+
+        current["ready"] = "True"
+        harness.charm.on.update_status.emit()
+        assert harness.charm.unit.status == ActiveStatus("Ready")
+
+    assert [call.args[0].ready for call in on_changed.call_args_list] == [False, True]
+    assert harness.charm.stored.ready is True
+
+
+@pytest.mark.parametrize("watch", [False, True])
+def test_status_reads_every_condition(harness: Harness, lk_client, installed, watch):
+    data = installed("False", "1").to_dict()
+    data["status"]["conditions"].append({"type": "Progressing", "status": "True"})
+    lk_client.list.side_effect = lambda kind, **kw: FakeListing(
+        [codecs.from_dict(data)] if kind.__name__ == KIND and kw.get("labels") else [], "1"
+    )
+    harness.set_leader(True)
+    harness.update_config({"readiness-watch": watch})
+    harness.charm.on.update_status.emit()
+    assert isinstance(harness.charm.unit.status, WaitingStatus)
+    assert harness.charm.unit.status.message.endswith(" is not Ready")
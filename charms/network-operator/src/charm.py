@@ -12,36 +12,84 @@ develop a new k8s charm using the Operator Framework:
 https://discourse.charmhub.io/t/4208
 """
 
+import json
 import logging
+import os
+import time
+from functools import cached_property
+from hashlib import sha256
+from pathlib import Path
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple
 
-from ops.charm import CharmBase
-from ops.framework import StoredState
+import yaml
+from ops.charm import ActionEvent, CharmBase, CharmEvents
+from ops.framework import EventBase, EventSource, StoredState
 from ops.main import main
-from ops.manifests import Collector, ManifestClientError
 from ops.model import ActiveStatus, BlockedStatus, MaintenanceStatus, WaitingStatus
 
 from config import CharmConfig
-from manifests import NetworkOperatorManifests
+from metrics import metrics
+from nfd import RELATION, device_classes, publish_device_classes
+from profiling import ENV_VAR, profiler
+
+if TYPE_CHECKING:
+    from ops.manifests import Collector
 
 log = logging.getLogger(__name__)
 
 
+class ReadinessChangedEvent(EventBase):
+    """Emitted by the leader when the readiness of the cluster workload flips."""
+
+    def __init__(self, handle, ready: bool):
+        super().__init__(handle)
+        self.ready = ready
+
+    def snapshot(self) -> Dict:
+        """Save the readiness of the event."""
+        return {"ready": self.ready}
+
+    def restore(self, snapshot: Dict) -> None:
+        """Restore the readiness of the event."""
+        self.ready = snapshot["ready"]
+
+
+class NetworkOperatorCharmEvents(CharmEvents):
+    """Charm events including the readiness of the cluster workload."""
+
+    readiness_changed = EventSource(ReadinessChangedEvent)
+
+
 class NetworkOperatorCharm(CharmBase):
     """Charm the service."""
 
+    on = NetworkOperatorCharmEvents()
+
     stored = StoredState()
 
     def __init__(self, *args):
         super().__init__(*args)
+        self._started = time.perf_counter()
+        self._hook = os.environ.get("JUJU_DISPATCH_PATH", "").rpartition("/")[2]
+        profiler.start(
+            os.environ.get(ENV_VAR) or self.config.get("profiling", ""),
+            self._hook,
+            self.profile_dir,
+        )
 
         # Config Validator and datastore
         self.charm_config = CharmConfig(self)
         self.stored.set_default(
             config_hash=None,  # hashed value of the applied config once valid
             deployed=False,  # True if the config has been applied after new hash
-        )
-        self.collector = Collector(
-            NetworkOperatorManifests(self, self.charm_config),
+            applied={},  # digests of the resources last applied, by manifest
+            resuming=False,  # True while a deferred install or upgrade has resources left
+            deleted={},  # kinds deleted by an interrupted cleanup, by manifest
+            readiness={},  # watched resource conditions, by manifest
+            ready=None,  # readiness of the workload last seen by the leader
+            metrics={},  # reconcile metrics accumulated across hooks
+            api_blocked=False,  # True while blocked by a permanent api error
+            nfd_shared=False,  # True once NFD is shared and this charm's own is deleted
         )
 
         self.framework.observe(self.on.update_status, self._update_status)
@@ -49,72 +97,271 @@ class NetworkOperatorCharm(CharmBase):
         self.framework.observe(self.on.upgrade_charm, self._install_or_upgrade)
         self.framework.observe(self.on.config_changed, self._merge_config)
         self.framework.observe(self.on.stop, self._cleanup)
+        self.framework.observe(self.on.cluster_relation_changed, self._on_peer_changed)
+        self.framework.observe(self.on.readiness_changed, self._on_readiness_changed)
+        self.framework.observe(self.on.render_action, self._on_render_action)
+        self.framework.observe(self.on.list_images_action, self._on_list_images_action)
+        self.framework.observe(self.on.metrics_action, self._on_metrics_action)
+        nfd_relation = self.on[RELATION]
+        self.framework.observe(nfd_relation.relation_joined, self._merge_config)
+        self.framework.observe(nfd_relation.relation_changed, self._merge_config)
+        self.framework.observe(nfd_relation.relation_broken, self._merge_config)
+        self.framework.observe(self.framework.on.pre_commit, self._on_pre_commit)
+        self.framework.observe(self.framework.on.commit, self._on_commit)
+        metrics.bind(self.stored.metrics)
+
+    @cached_property
+    def collector(self) -> "Collector":
+        """Manifest collector, loaded on first use so short-circuited hooks skip it."""
+        from ops.manifests import Collector
+
+        from manifests import NetworkOperatorManifests
+
+        return Collector(NetworkOperatorManifests(self, self.charm_config))
+
+    @property
+    def profile_dir(self) -> Path:
+        """Directory of the cProfile dumps written when profiling."""
+        return self.charm_dir / ".profiles"
+
+    def _on_pre_commit(self, _):
+        # StoredState is saved on commit, so record before it
+        elapsed = time.perf_counter() - self._started
+        metrics.observe("charm_hook_duration_seconds", elapsed, hook=self._hook)
 
-    def _update_status(self, _):
+    def _on_commit(self, _):
+        profiler.finish()
+
+    def _update_status(self, event):
+        if self.stored.api_blocked:
+            # retry once the step named in the blocked status may be done, without
+            # deferring since update-status runs again anyway
+            self._merge_config(None)
         if not self.stored.deployed:
             return
 
-        unready = self.collector.unready
+        with profiler.span("status collection"):
+            summary = self._cluster_status()
+        if summary is None:
+            self.unit.status = WaitingStatus("Waiting for leader to report status")
+            return
+
+        unready = summary["unready"]
         if unready:
             self.unit.status = WaitingStatus(", ".join(unready))
         else:
             self.unit.status = ActiveStatus("Ready")
-            self.unit.set_workload_version(self.collector.short_version)
-            self.app.status = ActiveStatus(self.collector.long_version)
+            self.unit.set_workload_version(summary["short-version"])
+            if self.unit.is_leader():
+                self.app.status = ActiveStatus(summary["long-version"])
+
+    def _cluster_status(self) -> Optional[Dict]:
+        """Status of the cluster-scoped workload.
+
+        Only the leader queries the cluster, publishing the summary in the
+        peer relation's app data for the other units to render.
+        """
+        peers = self.model.get_relation("cluster")
+        if not self.unit.is_leader():
+            published = peers and peers.data[self.app].get("status")
+            return json.loads(published) if published else None
+
+        unready = sorted(
+            f"{name}: {obj} is not {cond_type}"
+            for name, obj, cond_type, cond_status in self._conditions()
+            if cond_status != "True"
+        )
+        metrics.set("charm_unready_resources", len(unready))
+        summary = {
+            "unready": unready,
+            "short-version": self.collector.short_version,
+            "long-version": self.collector.long_version,
+        }
+        if peers:
+            peers.data[self.app]["status"] = json.dumps(summary, sort_keys=True)
+        if self.stored.ready != (ready := not unready):
+            self.stored.ready = ready
+            self.on.readiness_changed.emit(ready)
+        return summary
+
+    def _conditions(self) -> List[Tuple[str, str, str, str]]:
+        """Conditions of the installed resources of each manifest.
+
+        With readiness-watch enabled, conditions come from an index kept
+        current by watch streams rather than listing every kind.
+        """
+        if not self.config.get("readiness-watch"):
+            return [
+                (name, str(obj), cond.type, cond.status)
+                for name, obj, cond in self.collector.all_conditions
+            ]
+
+        from status import ReadinessIndex
+
+        conditions = []
+        for name, manifests in self.collector.manifests.items():
+            index = ReadinessIndex(manifests, self.stored.readiness.setdefault(name, {}))
+            index.refresh()
+            conditions += [(name, *condition) for condition in index.conditions]
+        return conditions
+
+    def _on_readiness_changed(self, event: ReadinessChangedEvent):
+        log.info(f"Workload readiness changed to {'ready' if event.ready else 'not ready'}")
+
+    def _on_render_action(self, event: ActionEvent):
+        from manifests import NetworkOperatorManifests
+        from render import check_overrides, diff_applied, load_overrides, render_resources
+
+        try:
+            overrides = check_overrides(load_overrides(event.params["config"]), self.config)
+        except (ValueError, yaml.YAMLError) as e:
+            event.fail(f"Invalid config: {e}")
+            return
+        config = CharmConfig(self, {**self.config, **overrides})
+        manifests = NetworkOperatorManifests(self, config)
+        if evaluation := config.evaluate() or manifests.evaluate():
+            event.fail(evaluation)
+            return
+        diff = diff_applied(manifests, self.stored.applied.get(manifests.name, {}))
+        event.set_results(
+            {
+                manifests.name: {
+                    "resources": render_resources(
+                        manifests.rendered_resources(), event.params["format"]
+                    ),
+                    **{change: "\n".join(keys) for change, keys in diff.items()},
+                }
+            }
+        )
+
+    def _on_metrics_action(self, event: ActionEvent):
+        event.set_results({"metrics": metrics.render(juju_unit=self.unit.name)})
+
+    def _on_list_images_action(self, event: ActionEvent):
+        manifests = next(iter(self.collector.manifests.values()))
+        release = event.params["release"]
+        if release and release not in manifests.releases:
+            event.fail(f"release {release} is not one of: {', '.join(manifests.releases)}")
+            return
+        event.set_results({"images": "\n".join(manifests.images(release or None))})
+
+    def _on_peer_changed(self, event):
+        if not self.unit.is_leader():
+            self._update_status(event)
 
     def _check_config(self):
         self.unit.status = MaintenanceStatus("Evaluating charm config.")
-        evaluation = self.charm_config.evaluate()
+        with profiler.span("config evaluation"):
+            evaluation = self.charm_config.evaluate()
         if evaluation:
             self.unit.status = BlockedStatus(evaluation)
             return False
         return True
 
     def _merge_config(self, event):
+        self.charm_config.invalidate()
         if not self._check_config():
             return
 
         self.unit.status = MaintenanceStatus("Evaluating Manifests")
-        new_hash = 0
+        hashes = {}
         for controller in self.collector.manifests.values():
             evaluation = controller.evaluate()
             if evaluation:
                 self.unit.status = BlockedStatus(evaluation)
                 return
-            new_hash += controller.hash()
+            with profiler.span("manifest hash", manifest=controller.name):
+                hashes[controller.name] = controller.hash()
+        new_hash = sha256(json.dumps(hashes, sort_keys=True).encode()).hexdigest()
 
         self.stored.deployed = False
         if self._install_or_upgrade(event, config_hash=new_hash):
             self.stored.config_hash = new_hash
             self.stored.deployed = True
+            # only ask the provider to scan for these once our own NFD is gone
+            classes = device_classes(self.charm_config.available_data.get("nfd-worker-conf"))
+            publish_device_classes(self.model, classes if self.stored.nfd_shared else None)
 
     def _install_or_upgrade(self, event, config_hash=None):
         if self.stored.config_hash == config_hash:
             log.info("Skipping until the config is evaluated.")
             return True
 
+        from ops.manifests import ManifestClientError
+
+        from apply import blocked_message, is_transient
+
         self.unit.status = MaintenanceStatus("Deploying NVIDIA Network Operator")
         self.unit.set_workload_version("")
+        if config_hash is None and not self.stored.resuming:
+            # install and upgrade-charm re-apply every resource
+            self.stored.applied.clear()
+        self.stored.resuming = config_hash is None
+        # resources applied again must be deleted again by the next cleanup
+        self.stored.deleted.clear()
         for controller in self.collector.manifests.values():
+            applied = self.stored.applied.setdefault(controller.name, {})
+            log.info(f"Applying {controller.name} version: {controller.current_release}")
             try:
-                controller.apply_charm_manifests()
+                with profiler.span("apply manifests", manifest=controller.name):
+                    controller.delete_subtracted(applied)
+                    skipped = controller.apply_charm_manifests(applied)
+                # with NFD shared, the subtracted NFD resources are now deleted
+                self.stored.nfd_shared = bool(controller.shared_nfd)
             except ManifestClientError as e:
+                transient = is_transient(e)
+                outcome = ("deferred" if event else "retried") if transient else "blocked"
+                metrics.inc("charm_manifest_client_errors_total", hook=self._hook, outcome=outcome)
+                # without an event to defer, update-status retries
+                self.stored.api_blocked = not transient or not event
+                if not transient:
+                    self.unit.status = BlockedStatus(blocked_message(e))
+                    log.error(f"Encountered permanent installation error: {e}")
+                    return False
                 self.unit.status = WaitingStatus("Waiting for kube-apiserver")
                 log.warning(f"Encountered retryable installation error: {e}")
-                event.defer()
+                if event:
+                    event.defer()
                 return False
+            if skipped:
+                log.info(
+                    f"Skipped {len(skipped)} unchanged resources: {', '.join(map(str, skipped))}"
+                )
+        self.stored.resuming = False
+        self.stored.api_blocked = False
         return True
 
     def _cleanup(self, event):
         if self.stored.config_hash:
+            from ops.manifests import ManifestClientError
+
+            from apply import blocked_message, is_transient
+            from cleanup import delete_collections
+
             self.unit.status = MaintenanceStatus("Cleaning up NVIDIA Network Operator")
+            concurrency = self.config.get("apply-concurrency", 1)
             for controller in self.collector.manifests.values():
+                deleted = self.stored.deleted.setdefault(controller.name, {})
                 try:
-                    controller.delete_manifests(ignore_unauthorized=True)
-                except ManifestClientError:
-                    self.unit.status = WaitingStatus("Waiting for kube-apiserver")
+                    with profiler.span("delete manifests", manifest=controller.name):
+                        delete_collections(controller, deleted, concurrency)
+                except ManifestClientError as e:
+                    transient = is_transient(e)
+                    metrics.inc(
+                        "charm_manifest_client_errors_total",
+                        hook=self._hook,
+                        outcome="deferred" if transient else "blocked",
+                    )
+                    if not transient:
+                        # no update-status follows stop, so retry on the next hook
+                        self.unit.status = BlockedStatus(blocked_message(e))
+                        log.error(f"Encountered permanent cleanup error: {e}")
+                    else:
+                        self.unit.status = WaitingStatus("Waiting for kube-apiserver")
                     event.defer()
                     return
+                # completed, so a later cleanup deletes every kind again
+                del self.stored.deleted[controller.name]
         self.unit.status = MaintenanceStatus("Shutting down")
 
 
@@ -0,0 +1,107 @@
+# Copyright 2024 Canonical Ltd.
+# See LICENSE file for licensing details.
+"""Remove the charm's resources from the cluster a kind at a time."""
+
+import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from itertools import groupby
+from typing import Dict, MutableMapping, Optional
+
+from httpx import HTTPError
+from lightkube.core.exceptions import ApiError
+from lightkube.core.resource import api_info
+from lightkube.core.selector import build_selector
+from ops.manifests import ManifestClientError, Manifests
+
+from apply import apply_tier, retry
+from metrics import metrics
+from profiling import profiler
+from status import Kind, manifest_labels
+
+log = logging.getLogger(__name__)
+
+# kinds already gone, or which the charm may no longer access
+IGNORED_CODES = (401, 404)
+
+
+def _key(kind: Kind) -> str:
+    resource, namespace = kind
+    return f"{resource.__name__}/{namespace or ''}"
+
+
+def _delete_collection(client, kind: Kind, labels: Dict[str, str]) -> bool:
+    """Delete the labelled objects of a kind with one request, if lightkube can.
+
+    lightkube's deletecollection takes no label selector, so the request is
+    made through its private generic client. Should that change, the caller
+    falls back to deleting each object.
+    """
+    resource, namespace = kind
+    params = {"labelSelector": build_selector(labels)}
+    try:
+        client._client.request(
+            "deletecollection", res=resource, namespace=namespace, params=params
+        )
+    except (AttributeError, TypeError) as e:
+        log.warning(f"Deleting {_key(kind)} resources one at a time: {e}")
+        return False
+    return True
+
+
+def _delete_kind(manifests: Manifests, kind: Kind) -> None:
+    resource, namespace = kind
+    client = manifests.client
+    labels = manifest_labels(manifests)
+
+    def delete():
+        try:
+            collection = "deletecollection" in api_info(resource).verbs
+            if not (collection and _delete_collection(client, kind, labels)):
+                for obj in client.list(resource, namespace=namespace, labels=labels):
+                    client.delete(resource, obj.metadata.name, namespace=namespace)
+        except (ApiError, HTTPError) as e:
+            if isinstance(e, ApiError) and e.status.code in IGNORED_CODES:
+                log.warning(f"Ignored failed delete of {_key(kind)} resources: {e}")
+                return
+            metrics.inc("charm_api_errors_total", verb="deletecollection", kind=resource.__name__)
+            raise ManifestClientError(f"Failed deleting {_key(kind)} resources", e) from e
+
+    metrics.inc("charm_api_calls_total", verb="deletecollection", kind=resource.__name__)
+    with profiler.span("deletecollection", kind=resource.__name__, namespace=namespace):
+        retry(delete, "deletecollection", resource.__name__)
+    log.info(f"Deleted {_key(kind)} resources")
+
+
+def delete_collections(
+    manifests: Manifests, deleted: MutableMapping[str, bool], concurrency: int = 1
+) -> None:
+    """Delete the labelled resources of each kind and namespace with one call.
+
+    Kinds are deleted in the reverse of their apply tiers, so custom resources
+    go first and CRDs last, running up to ``concurrency`` deletions at once
+    within a tier. ``deleted`` records each kind as soon as it is deleted, so an
+    interrupted cleanup resumes with the kinds left over.
+    """
+    tiers: Dict[Kind, int] = {}
+    for rsc in manifests.iter_resources():
+        tiers.setdefault((type(rsc.resource), rsc.namespace), apply_tier(rsc))
+    pending = sorted(
+        (kind for kind in tiers if _key(kind) not in deleted),
+        key=lambda kind: (-tiers[kind], _key(kind)),
+    )
+    if not pending:
+        return
+
+    manifests.client  # create the client before sharing it between threads
+    with ThreadPoolExecutor(max_workers=max(concurrency, 1)) as pool:
+        for tier, kinds in groupby(pending, key=tiers.__getitem__):
+            log.debug(f"Deleting resources in tier {tier}")
+            futures = {pool.submit(_delete_kind, manifests, kind): kind for kind in kinds}
+            failure: Optional[BaseException] = None
+            for future in as_completed(futures):
+                if future.exception():
+                    failure = failure or future.exception()
+                else:
+                    deleted[_key(futures[future])] = True
+            if failure:
+                raise failure
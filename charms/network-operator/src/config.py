@@ -2,12 +2,17 @@
 # See LICENSE file for licensing details.
 """Config Management for the nvidia-network-operator charm."""
 
+import json
 import logging
-from typing import Optional
+from hashlib import sha256
+from types import MappingProxyType
+from typing import Dict, Mapping, NamedTuple, Optional, Tuple
 
 import jsonschema
 import yaml
 
+from profiling import MODES
+
 log = logging.getLogger(__name__)
 
 NFD_SCHEMA = dict(
@@ -28,63 +33,125 @@ POLICY_SCHEMA = dict(
 )
 
 
+def _compile(schema: dict) -> "jsonschema.protocols.Validator":
+    """Check a schema once, returning a validator which can be reused."""
+    validator = jsonschema.validators.validator_for(schema)
+    validator.check_schema(schema)
+    return validator(schema)
+
+
+# validators for the yaml options, compiled once per process
+VALIDATORS = {
+    "nfd-worker-conf": _compile(NFD_SCHEMA),
+    "nic-cluster-policy": _compile(POLICY_SCHEMA),
+}
+
+
+class Option(NamedTuple):
+    """A yaml config option parsed and validated against its schema."""
+
+    value: Optional[dict]
+    errors: Tuple[str, ...]
+
+
 class CharmConfig:
     """Representation of the charm configuration."""
 
-    def __init__(self, charm):
+    YAML_OPTIONS = ("nfd-worker-conf", "nic-cluster-policy")
+    # tune how the charm runs, never what it renders
+    OPERATIONAL_OPTIONS = ("apply-concurrency", "profiling", "readiness-watch")
+
+    # options by digest of their raw value, shared by every instance in the process
+    _loaded: Dict[str, Option] = {}
+
+    def __init__(self, charm, config: Optional[Mapping] = None):
         self.charm = charm
+        # the charm's config unless rendering with other values
+        self.config = charm.config if config is None else config
+        self._parsed: Dict[str, Option] = {}
+        self._snapshot: Optional[Mapping] = None
+        self._digest: Optional[str] = None
+
+    def invalidate(self):
+        """Drop the memoized config so the next access re-reads the charm config."""
+        self._parsed.clear()
+        self._snapshot = None
+        self._digest = None
 
     @property
     def nfd_worker_conf(self) -> str:
         """Raw nfd-worker-conf config string."""
-        return self.charm.config.get("nfd-worker-conf", "")
+        return self.config.get("nfd-worker-conf", "")
 
     @property
     def nic_cluster_policy(self) -> str:
         """Raw nic-cluster-policy config string."""
-        return self.charm.config.get("nic-cluster-policy", "")
-
-    def _safe_yaml(self, conf: str) -> Optional[dict]:
-        """Parse yaml config string into a dict, return None on failure."""
-        try:
-            return yaml.safe_load(conf)
-        except yaml.YAMLError:
-            return None
+        return self.config.get("nic-cluster-policy", "")
 
-    def _is_valid(self, yaml: dict, schema: dict) -> bool:
-        """Determine if given yaml is valid against the given schema."""
+    def _load(self, key: str, conf: str) -> Option:
+        """Parse a yaml config string and validate it against the option's schema."""
         try:
-            jsonschema.validate(yaml, schema)
-        except jsonschema.ValidationError:
-            return False
-        return True
+            value = yaml.safe_load(conf)
+        except yaml.YAMLError as e:
+            return Option(None, (f"cannot parse yaml, {getattr(e, 'problem', None) or e}",))
+        if not (validator := VALIDATORS.get(key)):
+            return Option(value, ())
+        errors = sorted(validator.iter_errors(value), key=lambda e: e.json_path)
+        return Option(value, tuple(f"{e.json_path}: {e.message}" for e in errors))
+
+    def _option(self, key: str) -> Option:
+        """Load a yaml config option, only when its raw value has not been seen."""
+        if key not in self._parsed:
+            conf = self.config.get(key, "")
+            digest = sha256(f"{key}\0{conf}".encode()).hexdigest()
+            if digest not in self._loaded:
+                self._loaded[digest] = self._load(key, conf)
+            self._parsed[key] = self._loaded[digest]
+        return self._parsed[key]
+
+    def _parsed_option(self, key: str) -> Optional[dict]:
+        """Return the parsed value of a yaml config option."""
+        return self._option(key).value
 
     def evaluate(self) -> Optional[str]:
         """Determine if configuration is valid."""
-        nfd_yaml = self._safe_yaml(self.nfd_worker_conf)
-        if not (nfd_yaml and self._is_valid(nfd_yaml, NFD_SCHEMA)):
-            return "nfd-worker-conf is invalid"
+        if self.config.get("apply-concurrency", 1) < 1:
+            return "apply-concurrency must be at least 1"
 
-        nic_policy = self._safe_yaml(self.nic_cluster_policy)
-        if not (nic_policy and self._is_valid(nic_policy, POLICY_SCHEMA)):
-            return "nic-cluster-policy is invalid"
+        if self.config.get("profiling", "") not in ("", *MODES):
+            return f"profiling must be one of: {', '.join(MODES)}"
+
+        for key in VALIDATORS:
+            if errors := self._option(key).errors:
+                return f"{key} is invalid: {'; '.join(errors)}"
 
         return None
 
     @property
-    def available_data(self):
-        """Parse valid charm config into a dict, drop keys if unset."""
-        data = {}
-        safe_data = {
-            "nfd-worker-conf": self._safe_yaml(self.nfd_worker_conf),
-            "nic-cluster-policy": self._safe_yaml(self.nic_cluster_policy),
-        }
-        for key, value in self.charm.config.items():
-            # use the safe value if we have one for this key
-            data[key] = safe_data.get(key, value)
-
-        for key, value in dict(**data).items():
-            if value == "" or value is None:
-                del data[key]
-
-        return data
+    def digest(self) -> str:
+        """Order independent digest of the raw rendered config values, computed once per hook."""
+        if self._digest is None:
+            raw = {k: v for k, v in self.config.items() if k not in self.OPERATIONAL_OPTIONS}
+            content = json.dumps(raw, sort_keys=True, separators=(",", ":"), default=str)
+            self._digest = sha256(content.encode()).hexdigest()
+        return self._digest
+
+    @property
+    def available_data(self) -> Mapping:
+        """Parse valid charm config into a read-only mapping, drop keys if unset.
+
+        The mapping is built once and shared by every manifest patch until
+        the config is invalidated.
+        """
+        if self._snapshot is None:
+            data = {}
+            for key, value in self.config.items():
+                # use the safe value if we have one for this key
+                data[key] = self._parsed_option(key) if key in self.YAML_OPTIONS else value
+
+            for key, value in dict(**data).items():
+                if value == "" or value is None:
+                    del data[key]
+
+            self._snapshot = MappingProxyType(data)
+        return self._snapshot
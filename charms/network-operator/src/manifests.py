@@ -3,18 +3,102 @@
 """Implementation of nvidia-network-operator kubernetes manifests."""
 
 import logging
-import pickle
-from hashlib import md5
-from typing import Dict, Optional
+import re
+from collections import OrderedDict
+from copy import deepcopy
+from functools import cached_property
+from hashlib import sha256
+from itertools import chain
+from pathlib import Path
+from typing import (
+    Callable,
+    Dict,
+    FrozenSet,
+    Iterator,
+    KeysView,
+    List,
+    Mapping,
+    MutableMapping,
+    Optional,
+    Tuple,
+)
 
 import yaml
+from lightkube import codecs
 from lightkube.codecs import AnyResource, from_dict
-from ops.manifests import ConfigRegistry, ManifestLabel, Manifests, Patch
-from ops.manifests.manipulations import HashableResource
+from lightkube.generic_resource import create_resources_from_crd
+from ops.manifests import Addition, ManifestLabel, Manifests, Patch
+from ops.manifests.manipulations import HashableResource, Subtraction
+
+from apply import AnnotateCRDDigest, apply_changed
+from cache import ManifestCache, iter_documents
+from nfd import is_nfd, shared_namespace
+from profiling import profiler
+from releases import (
+    FILE_TYPES,
+    image_fields,
+    image_key,
+    index_release,
+    load_index,
+    rewrite_image,
+    set_image_registry,
+)
+from status import listed_status
 
 log = logging.getLogger(__file__)
 
 
+def _crd(name: str) -> Callable[[str, str], bool]:
+    return lambda kind, obj_name: kind == "CustomResourceDefinition" and obj_name == name
+
+
+# objects of each component the disabled-components config may leave out, by kind and name
+COMPONENTS: Dict[str, Callable[[str, str], bool]] = {
+    "nfd": is_nfd,
+    "hostdevice-network-crd": _crd("hostdevicenetworks.mellanox.com"),
+    "ipoib-network-crd": _crd("ipoibnetworks.mellanox.com"),
+    "macvlan-network-crd": _crd("macvlannetworks.mellanox.com"),
+    "network-attachment-definition-crd": _crd("network-attachment-definitions.k8s.cni.cncf.io"),
+}
+
+
+class TalliedPatch(Patch):
+    """Tally the time spent in another patch while profiling."""
+
+    def __init__(self, patch: Patch):
+        super().__init__(patch.manifests)
+        self.patch = patch
+        self.name = f"patch {type(patch).__name__}"
+
+    def __call__(self, obj):
+        """Apply the wrapped patch."""
+        with profiler.tally(self.name):
+            self.patch(obj)
+
+
+class ImageRegistry(Patch):
+    """Point each image at the image-registry config, using the release's image index.
+
+    Only the fields indexed for the object are assigned, rather than walking
+    every object, and these include the operator component repositories of
+    custom resources which a walk of container specs misses.
+    """
+
+    def __call__(self, obj: AnyResource) -> None:
+        """Rewrite the registry of the images in an object."""
+        registry = self.manifests.config.get("image-registry")
+        if not registry:
+            return
+        release = self.manifests.release_index.get(self.manifests.current_release)
+        if release is None:  # not indexed, locate the images now
+            fields = [field for field, _ in image_fields(obj.to_dict())]
+        else:
+            fields = release["image_fields"].get(image_key(obj.kind, obj.metadata.name), [])
+        for field in fields:
+            image, rewritten = set_image_registry(obj, field, registry)
+            log.debug(f"Replacing Image: {image} with {rewritten}")
+
+
 class ApplyNFDConfigMap(Patch):
     """Update the NFD ConfigMap as a patch since the manifests include a default."""
 
@@ -33,6 +117,23 @@ class ApplyNFDConfigMap(Patch):
         obj.data["nfd-worker.conf"] = yaml.safe_dump(config)
 
 
+class DisabledComponents(Subtraction):
+    """Leave out the objects of the components named by the disabled-components config."""
+
+    def __call__(self, obj: AnyResource) -> bool:
+        """Subtract the object if it belongs to a disabled component."""
+        disabled = self.manifests.disabled_components & COMPONENTS.keys()
+        return any(COMPONENTS[name](obj.kind, obj.metadata.name) for name in disabled)
+
+
+class SharedNFD(Subtraction):
+    """Leave out the NFD stack while the gpu-operator charm shares its own."""
+
+    def __call__(self, obj: AnyResource) -> bool:
+        """Subtract the NFD objects once the related NFD is deployed."""
+        return bool(self.manifests.shared_nfd) and is_nfd(obj.kind, obj.metadata.name)
+
+
 class NetworkOperatorManifests(Manifests):
     """Deployment details for nvidia-network-operator."""
 
@@ -43,45 +144,196 @@ class NetworkOperatorManifests(Manifests):
             "upstream/network-operator",
             [
                 ManifestLabel(self),
-                ConfigRegistry(self),
+                ImageRegistry(self),
                 ApplyNFDConfigMap(self),
+                DisabledComponents(self),
+                SharedNFD(self),
+                AnnotateCRDDigest(self),
             ],
         )
+        if profiler.enabled:
+            self.manipulations = [
+                TalliedPatch(m) if isinstance(m, Patch) else m for m in self.manipulations
+            ]
+        self.charm = charm
         self.charm_config = charm_config
+        self.cache = ManifestCache(self.cache_dir)
 
     @property
-    def config(self) -> Dict:
-        """Returns config mapped from charm config and joined relations."""
-        config: Dict = {}
-        config.update(**self.charm_config.available_data)
+    def cache_dir(self) -> Path:
+        """Directory of the pre-parsed manifest cache, kept next to the charm state."""
+        return self.charm.charm_dir / ".manifest-cache"
+
+    def _digest(self, filepath: Path) -> Optional[str]:
+        release = self.release_index.get(filepath.parent.name, {})
+        return release.get("files", {}).get(filepath.name)
+
+    def _safe_load(self, filepath: Path) -> List[Mapping]:
+        """Read parsed manifest documents from the cache when the file is unchanged."""
+        with profiler.span("manifest load", file=filepath.name):
+            return self.cache.load(filepath, iter_documents, self._digest(filepath))
 
-        for key, value in dict(**config).items():
-            if value == "" or value is None:
-                del config[key]
+    def _documents(self, filepath: Path) -> Iterator[Mapping]:
+        """Yield parsed manifest documents one at a time, see ``_safe_load``."""
+        documents = self.cache.stream(filepath, iter_documents, self._digest(filepath))
+        while True:
+            with profiler.tally("manifest load"):
+                doc = next(documents, None)
+            if doc is None:
+                return
+            yield doc
 
-        return config
+    def _objects(self) -> Iterator[Tuple[AnyResource, bool]]:
+        """Yield the release's objects, and whether a subtraction removes each."""
+        subtractions = [m for m in self.manipulations if isinstance(m, Subtraction)]
+        release_path = self.manifest_path / self.current_release
+        for path in sorted(p for ext in FILE_TYPES for p in release_path.glob(f"*.{ext}")):
+            for doc in self._documents(path):
+                obj = codecs.from_dict(dict(doc))
+                if obj.kind == "CustomResourceDefinition":
+                    create_resources_from_crd(obj)
+                yield obj, any(subtract(obj) for subtract in subtractions)
+
+    def _statics(self) -> Iterator[AnyResource]:
+        """Yield the release's objects which no subtraction removes."""
+        return (obj for obj, subtracted in self._objects() if not subtracted)
+
+    def iter_resources(self) -> Iterator[HashableResource]:
+        """Yield each unique resource once it is patched.
+
+        Resources come in the order of ``resources``, but are read from the
+        manifests one at a time, so a caller which drops each resource holds
+        no more than the largest object instead of the whole release.
+        """
+        additions = (add for m in self.manipulations if isinstance(m, Addition) for add in m)
+        patches = [m for m in self.manipulations if isinstance(m, Patch)]
+        seen = set()
+        for obj in chain(filter(None, additions), self._statics()):
+            for patch in patches:
+                patch(obj)
+            rsc = HashableResource(obj)
+            if str(rsc) not in seen:
+                seen.add(str(rsc))
+                yield rsc
+
+    @property
+    def resources(self) -> KeysView[HashableResource]:
+        """All unique component resources, see ``iter_resources``."""
+        return OrderedDict((rsc, None) for rsc in self.iter_resources()).keys()
+
+    def subtracted_resources(self) -> Iterator[HashableResource]:
+        """Yield the release's objects which a subtraction removes, patched like the rest."""
+        patches = [m for m in self.manipulations if isinstance(m, Patch)]
+        for obj, subtracted in self._objects():
+            if subtracted:
+                for patch in patches:
+                    patch(obj)
+                yield HashableResource(obj)
+
+    def delete_subtracted(self, applied: MutableMapping[str, str]) -> None:
+        """Delete the resources in ``applied`` which a subtraction now removes.
+
+        Leaving out a component keeps its objects from being applied again,
+        and this removes the ones already on the cluster.
+        """
+        if not applied:
+            return
+        resources = [rsc for rsc in self.subtracted_resources() if str(rsc) in applied]
+        if resources:
+            self.delete_resources(*resources, ignore_not_found=True)
+        for rsc in resources:
+            del applied[str(rsc)]
+
+    @property
+    def disabled_components(self) -> FrozenSet[str]:
+        """Components named by the disabled-components config."""
+        names = re.split(r"[\s,]+", self.config.get("disabled-components", ""))
+        return frozenset(filter(None, names))
+
+    @cached_property
+    def release_index(self) -> Mapping:
+        """Index of the shipped releases, see releases.py."""
+        return load_index(self.manifest_path)
+
+    @cached_property
+    def releases(self) -> List[str]:
+        """Shipped releases, highest first, read from the index when it exists."""
+        return list(self.release_index) or super().releases
+
+    def images(self, release: Optional[str] = None) -> List[str]:
+        """Images of a release and the nic-cluster-policy, as pulled once rewritten."""
+        release = release or self.current_release
+        indexed = self.release_index.get(release) or index_release(self.manifest_path / release)
+        registry = self.config.get("image-registry")
+        images = {rewrite_image(i, registry) if registry else i for i in indexed["images"]}
+        if conf := self.config.get("nic-cluster-policy"):
+            policy = (image for _, image in image_fields(conf))
+            if registry and self.config.get("nic-cluster-policy-registry"):
+                policy = (rewrite_image(image, registry) for image in policy)
+            images.update(policy)
+        return sorted(images)
+
+    @property
+    def config(self) -> Mapping:
+        """Returns the read-only config snapshot shared by all patches."""
+        return self.charm_config.available_data
+
+    @property
+    def shared_nfd(self) -> Optional[str]:
+        """Namespace of the related gpu-operator's NFD, which replaces this charm's."""
+        return shared_namespace(self.model)
 
     @property
     def nic_policy(self) -> Optional[AnyResource]:
         """Returns the nic-cluster-policy config manifest as a resource."""
         conf = self.config.get("nic-cluster-policy")
-        return HashableResource(from_dict(conf)) if conf else None
+        if not conf:
+            return None
+        registry = self.config.get("image-registry")
+        if registry and self.config.get("nic-cluster-policy-registry"):
+            conf = deepcopy(conf)  # the parsed config is shared
+            for field, _ in image_fields(conf):
+                image, rewritten = set_image_registry(conf, field, registry)
+                log.debug(f"Replacing Image: {image} with {rewritten}")
+        return HashableResource(from_dict(conf))
+
+    def status(self) -> FrozenSet[HashableResource]:
+        """Installed resources with status conditions, listing each kind once."""
+        return listed_status(self)
 
-    def hash(self) -> int:
-        """Calculate a hash of the current configuration."""
-        return int(md5(pickle.dumps(self.config)).hexdigest(), 16)
+    def hash(self) -> str:
+        """Digest of the raw config and the release rendered by these manifests."""
+        content = f"{self.name}\0{self.current_release}\0{self.charm_config.digest}"
+        content += f"\0{self.shared_nfd or ''}"
+        return sha256(content.encode()).hexdigest()
 
     def evaluate(self) -> Optional[str]:
         """Determine if config can be applied to manifests."""
+        release = self.config.get("release")
+        if release and release not in self.releases:
+            return f"release {release} is not one of: {', '.join(self.releases)}"
+        if unknown := self.disabled_components - COMPONENTS.keys():
+            names = ", ".join(sorted(unknown))
+            return f"disabled-components {names} not one of: {', '.join(COMPONENTS)}"
         if not self.config.get("nic-cluster-policy"):
             return "Manifests waiting for nic-cluster-policy config"
         return None
 
-    def apply_charm_manifests(self):
-        """Apply manifests from disk as well as those from charm config."""
-        self.apply_manifests()
-
+    def rendered_resources(self) -> Iterator[HashableResource]:
+        """Yield all resources this charm applies, in apply order."""
+        yield from self.iter_resources()
         # nic-cluster-policy will be a CR based on a CRD from disk and therefore
-        # needs to be applied after apply_manifests() has completed.
-        if self.nic_policy:
-            self.apply_resource(self.nic_policy)
+        # needs to be applied after the release manifests.
+        if policy := self.nic_policy:
+            yield policy
+
+    def apply_charm_manifests(self, applied: MutableMapping[str, str]) -> List[str]:
+        """Apply manifests from disk as well as those from charm config.
+
+        Only resources whose rendered digest differs from the one recorded
+        in ``applied`` are sent to the cluster, in dependency tiers with up to
+        ``apply-concurrency`` api calls at once. ``applied`` is updated as each
+        resource is applied, and the unchanged resources are returned.
+        """
+        concurrency = self.config.get("apply-concurrency", 1)
+        return apply_changed(self, self.rendered_resources, applied, concurrency)
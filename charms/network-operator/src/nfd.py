@@ -0,0 +1,88 @@
+# Copyright 2024 Canonical Ltd.
+# See LICENSE file for licensing details.
+"""Share one node-feature-discovery deployment between the nvidia charms.
+
+nvidia-gpu-operator provides the ``node-feature-discovery`` relation and
+keeps deploying its NFD stack once it is related. nvidia-network-operator
+requires it, drops its own NFD stack while the provider has one deployed, and
+then publishes the pci device classes of its worker config, which the
+provider merges into the shared worker config.
+"""
+
+import json
+from copy import deepcopy
+from typing import Dict, Iterable, List, Mapping, Optional
+
+from ops.model import Model
+
+RELATION = "node-feature-discovery"
+NAME_PREFIX = "nvidia-charm-node-feature-discovery"
+CRD_GROUP = "nfd.k8s-sigs.io"
+# wokeignore:rule=whitelist
+WORKER_CLASSES = "deviceClassWhitelist"
+
+# app data set by the provider once NFD is deployed
+NAMESPACE_KEY = "namespace"
+# app data set by the requirer once its own NFD stack is removed
+DEVICE_CLASSES_KEY = "device-classes"
+
+
+def is_nfd(kind: str, name: str) -> bool:
+    """Whether a manifest object belongs to the node-feature-discovery stack."""
+    if kind == "CustomResourceDefinition":
+        return name.endswith(f".{CRD_GROUP}")
+    return name == "node-feature-discovery" or name.startswith(NAME_PREFIX)
+
+
+def device_classes(conf: Optional[Mapping]) -> List[str]:
+    """PCI device classes scanned by an NFD worker config."""
+    pci = ((conf or {}).get("sources") or {}).get("pci") or {}
+    return [str(device_class) for device_class in pci.get(WORKER_CLASSES) or []]
+
+
+def merge_device_classes(conf: Mapping, extra: Iterable[str]) -> Dict:
+    """Copy an NFD worker config, adding the pci device classes it lacks."""
+    merged = deepcopy(dict(conf))
+    sources = merged["sources"] = merged.get("sources") or {}
+    pci = sources["pci"] = sources.get("pci") or {}
+    classes = pci[WORKER_CLASSES] = device_classes(merged)
+    classes += [device_class for device_class in extra if device_class not in classes]
+    return merged
+
+
+def _publish(model: Model, key: str, value: Optional[str]) -> None:
+    if not model.unit.is_leader():
+        return
+    for relation in model.relations[RELATION]:
+        data = relation.data[model.app]
+        if value is None:
+            data.pop(key, None)
+        elif data.get(key) != value:
+            data[key] = value
+
+
+def publish_namespace(model: Model, namespace: Optional[str]) -> None:
+    """As the provider, publish where NFD is deployed, or None while it isn't."""
+    _publish(model, NAMESPACE_KEY, namespace)
+
+
+def publish_device_classes(model: Model, classes: Optional[List[str]]) -> None:
+    """As the requirer, publish the device classes to scan, or None to withdraw them."""
+    _publish(model, DEVICE_CLASSES_KEY, None if classes is None else json.dumps(classes))
+
+
+def requested_device_classes(model: Model) -> List[str]:
+    """As the provider, the device classes requested by every related app."""
+    classes = set()
+    for relation in model.relations[RELATION]:
+        if relation.app and (data := relation.data[relation.app].get(DEVICE_CLASSES_KEY)):
+            classes.update(json.loads(data))
+    return sorted(classes)
+
+
+def shared_namespace(model: Model) -> Optional[str]:
+    """As the requirer, the namespace of the provider's NFD once it is deployed."""
+    for relation in model.relations[RELATION]:
+        if relation.app and (namespace := relation.data[relation.app].get(NAMESPACE_KEY)):
+            return namespace
+    return None
@@ -0,0 +1,134 @@
+# Copyright 2024 Canonical Ltd.
+# See LICENSE file for licensing details.
+"""Render the resources the charm would apply, without contacting the cluster.
+
+Used by the ``render`` action, and runnable from the charm directory to
+check a config change before it is rolled out:
+
+    python3 src/render.py -c image-registry=registry.local --config-file nic-policy.yaml
+"""
+
+import argparse
+import json
+import sys
+from collections import defaultdict
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Dict, Iterable, List, Mapping, Optional
+
+import yaml
+from lightkube import codecs
+from ops.manifests import HashableResource, Manifests
+
+from apply import resource_digest
+
+FORMATS = ("yaml", "json")
+CHARM_DIR = Path(__file__).resolve().parent.parent
+
+
+def render_resources(resources: Iterable[HashableResource], fmt: str = "yaml") -> str:
+    """Serialize resources as a yaml document stream or a json list."""
+    objs = [rsc.resource for rsc in resources]
+    if fmt == "json":
+        return json.dumps([obj.to_dict() for obj in objs], indent=2, sort_keys=True)
+    return codecs.dump_all_yaml(objs)
+
+
+def diff_applied(manifests: Manifests, applied: Mapping[str, str]) -> Dict[str, List[str]]:
+    """Compare the rendered resources with the digests recorded when last applied."""
+    rendered = {str(rsc): resource_digest(rsc) for rsc in manifests.rendered_resources()}
+    return {
+        "added": sorted(set(rendered) - set(applied)),
+        "changed": sorted(k for k in set(rendered) & set(applied) if rendered[k] != applied[k]),
+        "removed": sorted(set(applied) - set(rendered)),
+    }
+
+
+def load_overrides(text: str) -> Dict:
+    """Parse a yaml mapping of config options."""
+    overrides = yaml.safe_load(text)
+    if overrides is None:
+        return {}
+    if not isinstance(overrides, dict):
+        raise ValueError("config must be a yaml mapping of options")
+    return overrides
+
+
+def check_overrides(overrides: Mapping, current: Mapping) -> Mapping:
+    """Check config options against the names and types of the current config."""
+    for key, value in overrides.items():
+        if key not in current:
+            raise ValueError(f"{key} is not a config option")
+        if type(value) is not type(current[key]):
+            raise ValueError(f"{key} must be a {type(current[key]).__name__}")
+    return overrides
+
+
+def _coerce(option: str, value: str, current: Mapping):
+    """Convert a command line value to the type of the config option."""
+    default = current.get(option)
+    if isinstance(default, bool):
+        return value.lower() in ("true", "yes", "1")
+    if isinstance(default, int):
+        return int(value)
+    return value
+
+
+class _OfflineCharm:
+    """The parts of the charm which its config and manifests read, without juju.
+
+    The config holds the defaults of config.yaml and the app has the charm's
+    name and no relations.
+    """
+
+    def __init__(self, charm_dir: Path = CHARM_DIR):
+        self.charm_dir = charm_dir
+        meta = yaml.safe_load((charm_dir / "metadata.yaml").read_text())
+        options = yaml.safe_load((charm_dir / "config.yaml").read_text())["options"]
+        self.config = {key: opt["default"] for key, opt in options.items() if "default" in opt}
+        app = SimpleNamespace(name=meta["name"])
+        self.model = SimpleNamespace(app=app, relations=defaultdict(list))
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    """Print the rendered resources or their difference from the applied digests."""
+    from config import CharmConfig
+    from manifests import NetworkOperatorManifests
+
+    parser = argparse.ArgumentParser(description="Render the charm's resources offline.")
+    parser.add_argument(
+        "-c", "--config", action="append", default=[], metavar="KEY=VALUE", help="config option"
+    )
+    parser.add_argument("--config-file", type=Path, help="yaml mapping of config options")
+    parser.add_argument("--format", choices=FORMATS, default="yaml")
+    parser.add_argument("--applied", type=Path, help="json of the digests last applied")
+    args = parser.parse_args(argv)
+
+    charm = _OfflineCharm()
+    try:
+        current = dict(charm.config)
+        config = load_overrides(args.config_file.read_text()) if args.config_file else {}
+        for option in args.config:
+            key, _, value = option.partition("=")
+            config[key] = _coerce(key, value, current)
+        charm.config.update(check_overrides(config, current))
+        charm_config = CharmConfig(charm)
+        manifests = NetworkOperatorManifests(charm, charm_config)
+
+        if evaluation := charm_config.evaluate() or manifests.evaluate():
+            print(evaluation, file=sys.stderr)
+            return 1
+
+        if args.applied is None:
+            print(render_resources(manifests.rendered_resources(), args.format))
+        else:
+            applied = json.loads(args.applied.read_text()).get(manifests.name, {})
+            print(json.dumps({manifests.name: diff_applied(manifests, applied)}, indent=2))
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,97 @@
+# Copyright 2024 Canonical Ltd.
+# See LICENSE file for licensing details.
+#
+# Learn more about testing at: https://juju.is/docs/sdk/testing
+
+import math
+import os
+import time
+import tracemalloc
+import unittest.mock as mock
+from typing import Callable, List, NamedTuple, Optional
+
+import ops.testing
+import pytest
+from ops.testing import Harness
+
+from charm import NetworkOperatorCharm
+from manifests import NetworkOperatorManifests
+
+ops.testing.SIMULATE_CAN_CONNECT = True
+ROUNDS = int(os.environ.get("BENCHMARK_ROUNDS", "3"))
+
+
+class Stage(NamedTuple):
+    name: str
+    seconds: float
+    peak_kib: float
+
+
+RESULTS: List[Stage] = []
+
+
+class Bench:
+    """Time the best of a few rounds of a stage, then trace its peak allocation."""
+
+    def __call__(
+        self, name: str, fn: Callable, setup: Optional[Callable] = None, rounds: int = ROUNDS
+    ) -> Stage:
+        best = math.inf
+        for _ in range(rounds):
+            if setup:
+                setup()
+            start = time.perf_counter()
+            fn()
+            best = min(best, time.perf_counter() - start)
+
+        if setup:
+            setup()
+        tracemalloc.start()
+        try:
+            fn()
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+
+        stage = Stage(name, best, peak / 1024)
+        RESULTS.append(stage)
+        return stage
+
+
+@pytest.fixture
+def bench():
+    return Bench()
+
+
+@pytest.fixture(autouse=True)
+def lk_client():
+    with mock.patch("ops.manifests.manifest.Client", autospec=True) as mock_lightkube:
+        yield mock_lightkube.return_value
+
+
+@pytest.fixture(autouse=True)
+def manifest_cache(tmp_path):
+    cache_dir = tmp_path / "manifest-cache"
+    with mock.patch.object(NetworkOperatorManifests, "cache_dir", cache_dir):
+        yield cache_dir
+
+
+@pytest.fixture
+def harness():
+    harness = Harness(NetworkOperatorCharm)
+    try:
+        harness.begin()
+        yield harness
+    finally:
+        harness.cleanup()
+
+
+def pytest_terminal_summary(terminalreporter):
+    if not RESULTS:
+        return
+    terminalreporter.write_sep("-", "manifest rendering benchmark")
+    terminalreporter.write_line(f"{'stage':<48}{'best ms':>12}{'peak KiB':>12}")
+    for stage in RESULTS:
+        terminalreporter.write_line(
+            f"{stage.name:<48}{stage.seconds * 1000:>12.2f}{stage.peak_kib:>12.1f}"
+        )
@@ -8,6 +8,8 @@ import unittest.mock as mock
 import pytest
 from lightkube import ApiError
 
+from manifests import NetworkOperatorManifests
+
 
 @pytest.fixture()
 def api_error_klass():
@@ -23,4 +25,24 @@ def api_error_klass():
 @pytest.fixture(autouse=True)
 def lk_client():
     with mock.patch("ops.manifests.manifest.Client", autospec=True) as mock_lightkube:
-        yield mock_lightkube.return_value
+        client = mock_lightkube.return_value
+        # lightkube's generic client, for requests its Client can't make
+        client._client = mock.MagicMock()
+        client._client.send.return_value.json.return_value = {"metadata": {}}
+        client.get.return_value.status.conditions = [
+            mock.MagicMock(type="Established", status="True")
+        ]
+        yield client
+
+
+@pytest.fixture(autouse=True)
+def manifest_cache(tmp_path):
+    cache_dir = tmp_path / "manifest-cache"
+    with mock.patch.object(NetworkOperatorManifests, "cache_dir", cache_dir):
+        yield cache_dir
+
+
+@pytest.fixture(autouse=True)
+def backoff():
+    with mock.patch("apply.time.sleep") as sleep:
+        yield sleep
@@ -0,0 +1,298 @@
+# Copyright 2024 Canonical Ltd.
+# See LICENSE file for licensing details.
+#
+# Learn more about testing at: https://juju.is/docs/sdk/testing
+
+import threading
+import unittest.mock as mock
+
+import ops.testing
+import pytest
+from httpx import ConnectError
+from ops.charm import UpdateStatusEvent
+from ops.manifests import HashableResource
+from ops.model import BlockedStatus, WaitingStatus
+from ops.testing import Harness
+
+from apply import (
+    BACKOFF_BASE,
+    CUSTOM_RESOURCE_TIER,
+    DIGEST_ANNOTATION,
+    PARTIAL_METADATA,
+    RETRIES,
+    WORKLOAD_TIER,
+    apply_tier,
+    is_transient,
+    resource_digest,
+)
+from charm import NetworkOperatorCharm
+
+ops.testing.SIMULATE_CAN_CONNECT = True
+
+
+@pytest.fixture
+def harness():
+    harness = Harness(NetworkOperatorCharm)
+    try:
+        yield harness
+    finally:
+        harness.cleanup()
+
+
+def test_apply_tiers(harness: Harness):
+    harness.begin()
+    resources = harness.charm.collector.manifests["network-operator"].rendered_resources()
+    tiers = {rsc.kind: apply_tier(rsc) for rsc in resources}
+    assert tiers["CustomResourceDefinition"] < tiers["ServiceAccount"] < tiers["ConfigMap"]
+    assert tiers["ConfigMap"] < tiers["DaemonSet"] == tiers["Deployment"]
+    assert tiers["NicClusterPolicy"] == CUSTOM_RESOURCE_TIER
+
+
+@pytest.mark.parametrize("concurrency", [1, 4])
+def test_apply_in_tier_order(harness: Harness, lk_client, concurrency):
+    calls = []
+    lk_client.apply.side_effect = lambda obj, **_: calls.append(obj)
+    harness.update_config({"apply-concurrency": concurrency})
+    harness.begin_with_initial_hooks()
+
+    manifests = harness.charm.collector.manifests["network-operator"]
+    by_name = {str(rsc): rsc for rsc in manifests.rendered_resources()}
+    tiers = [apply_tier(by_name[str(HashableResource(obj))]) for obj in calls]
+    assert len(calls) == len(by_name)
+    assert tiers == sorted(tiers)
+
+
+def test_apply_concurrently(harness: Harness, lk_client):
+    # both ServiceAccounts must be in flight at once to pass the barrier
+    barrier = threading.Barrier(2, timeout=5)
+
+    def apply(obj, **_):
+        if obj.kind == "ServiceAccount":
+            barrier.wait()
+
+    lk_client.apply.side_effect = apply
+    harness.update_config({"apply-concurrency": 2})
+    harness.begin_with_initial_hooks()
+    assert not barrier.broken
+
+
+def test_invalid_concurrency(harness: Harness):
+    harness.begin_with_initial_hooks()
+    harness.update_config({"apply-concurrency": 0})
+    assert harness.charm.unit.status == BlockedStatus("apply-concurrency must be at least 1")
+
+
+def status_error(api_error_klass, code):
+    error = api_error_klass()
+    error.status = mock.MagicMock(code=code)
+    return error
+
+
+@pytest.mark.parametrize("code, transient", [(429, True), (503, True), (404, False), (422, False)])
+def test_is_transient(api_error_klass, code, transient):
+    assert is_transient(status_error(api_error_klass, code)) is transient
+
+
+def test_is_transient_connection():
+    assert is_transient(ConnectError("refused"))
+    assert not is_transient(ValueError("bad object"))
+
+
+def test_retries_transient_errors(harness: Harness, lk_client, api_error_klass, backoff):
+    failures = [status_error(api_error_klass, 503), status_error(api_error_klass, 429)]
+
+    def apply(obj, **_):
+        if obj.kind == "ServiceAccount" and failures:
+            raise failures.pop()
+
+    lk_client.apply.side_effect = apply
+    harness.begin_with_initial_hooks()
+
+    assert not failures
+    delays = [c.args[0] for c in backoff.call_args_list]
+    assert len(delays) == 2
+    assert all(0 <= delay <= BACKOFF_BASE * 2**attempt for attempt, delay in enumerate(delays))
+    assert harness.charm.stored.deployed
+
+
+def test_permanent_error_blocks(harness: Harness, lk_client, api_error_klass, backoff):
+    lk_client.apply.side_effect = status_error(api_error_klass, 422)
+    harness.begin()
+    harness.charm.stored.config_hash = "mock_hash"
+    event = mock.MagicMock()
+    harness.charm._install_or_upgrade(event)
+
+    event.defer.assert_not_called()
+    backoff.assert_not_called()
+    assert isinstance(harness.charm.unit.status, BlockedStatus)
+    errors = harness.charm.stored.metrics["charm_manifest_client_errors_total"]
+    assert errors and all('outcome="blocked"' in key for key in errors)
+
+
+def test_permanent_error_retried_on_update_status(
+    harness: Harness, lk_client, api_error_klass, backoff
+):
+    lk_client.apply.side_effect = status_error(api_error_klass, 403)
+    harness.begin_with_initial_hooks()
+    assert isinstance(harness.charm.unit.status, BlockedStatus)
+    assert harness.charm.unit.status.message.endswith("grant the charm's credentials access")
+    assert not harness.charm.stored.deployed
+
+    lk_client.apply.side_effect = None
+    harness.charm.on.update_status.emit()
+    assert harness.charm.stored.deployed
+    assert not harness.charm.stored.api_blocked
+
+
+def test_update_status_retry_not_deferred(harness: Harness, lk_client, api_error_klass, backoff):
+    lk_client.apply.side_effect = status_error(api_error_klass, 403)
+    harness.begin_with_initial_hooks()
+    assert harness.charm.stored.api_blocked
+
+    lk_client.apply.side_effect = status_error(api_error_klass, 503)
+    with mock.patch.object(UpdateStatusEvent, "defer") as defer:
+        harness.charm.on.update_status.emit()
+    defer.assert_not_called()
+    assert isinstance(harness.charm.unit.status, WaitingStatus)
+    # the next update-status retries again
+    assert harness.charm.stored.api_blocked
+    errors = harness.charm.stored.metrics["charm_manifest_client_errors_total"]
+    assert any('outcome="retried"' in key for key in errors)
+
+    lk_client.apply.side_effect = None
+    harness.charm.on.update_status.emit()
+    assert harness.charm.stored.deployed
+    assert not harness.charm.stored.api_blocked
+
+
+def test_deferred_apply_resumes(harness: Harness, lk_client, api_error_klass, backoff):
+    down = {"DaemonSet"}
+    calls = []
+
+    def apply(obj, **_):
+        if obj.kind in down:
+            raise status_error(api_error_klass, 503)
+        calls.append(obj)
+
+    lk_client.apply.side_effect = apply
+    harness.begin()
+    harness.charm.stored.config_hash = "mock_hash"
+    event = mock.MagicMock()
+    harness.charm._install_or_upgrade(event)
+    event.defer.assert_called_once()
+    assert isinstance(harness.charm.unit.status, WaitingStatus)
+    assert backoff.call_count == RETRIES * sum(
+        rsc.kind in down
+        for rsc in harness.charm.collector.manifests["network-operator"].rendered_resources()
+    )
+
+    # the deferred install only sends what has not been applied yet
+    first = {str(HashableResource(obj)) for obj in calls}
+    down.clear()
+    calls.clear()
+    harness.charm._install_or_upgrade(event)
+    resumed = {str(HashableResource(obj)) for obj in calls}
+    assert resumed and not resumed & first
+    assert "DaemonSet" in {obj.kind for obj in calls}
+    tiers = {apply_tier(HashableResource(obj)) for obj in calls}
+    assert tiers <= {WORKLOAD_TIER, CUSTOM_RESOURCE_TIER}
+    assert not harness.charm.stored.resuming
+
+
+def crd_digests(harness: Harness):
+    manifests = harness.charm.collector.manifests["network-operator"]
+    return {
+        rsc.name: rsc.resource.metadata.annotations
+        for rsc in manifests.rendered_resources()
+        if rsc.kind == "CustomResourceDefinition"
+    }
+
+
+def test_crds_annotated_with_digest(harness: Harness):
+    harness.begin()
+    annotations = crd_digests(harness)
+    assert annotations and all(DIGEST_ANNOTATION in a for a in annotations.values())
+    assert crd_digests(harness) == annotations
+
+    for rsc in harness.charm.collector.manifests["network-operator"].rendered_resources():
+        annotations = rsc.resource.metadata.annotations or {}
+        if rsc.kind != "CustomResourceDefinition":
+            assert DIGEST_ANNOTATION not in annotations
+        else:
+            # the digest covers the rendering without the annotation itself
+            digest = annotations.pop(DIGEST_ANNOTATION)
+            assert resource_digest(rsc) == digest
+
+
+def test_installed_crds_not_reapplied(harness: Harness, lk_client):
+    harness.begin()
+    installed = {name: a[DIGEST_ANNOTATION] for name, a in crd_digests(harness).items()}
+    installed[next(iter(installed))] = "outdated"
+    generic = lk_client._client
+    generic.prepare_request.side_effect = lambda verb, **kw: (kw["name"], kw["headers"])
+    generic.build_adapter_request.side_effect = lambda request: request
+    generic.send.side_effect = lambda request: mock.MagicMock(
+        json=lambda: {"metadata": {"annotations": {DIGEST_ANNOTATION: installed[request[0]]}}}
+    )
+    harness.charm.stored.config_hash = "mock_hash"
+    harness.charm._install_or_upgrade(mock.MagicMock())
+
+    applied = [call.args[0].metadata.name for call in lk_client.apply.call_args_list]
+    assert [name for name in installed if name in applied] == [next(iter(installed))]
+    requests = [call.args[0] for call in generic.send.call_args_list]
+    assert sorted(name for name, _ in requests) == sorted(installed)
+    assert all(headers == {"Accept": PARTIAL_METADATA} for _, headers in requests)
+    stored = harness.charm.stored.applied["network-operator"]
+    assert all(f"CustomResourceDefinition/{name}" in stored for name in installed)
+
+
+def test_installed_crds_read_without_generic_client(harness: Harness, lk_client):
+    harness.begin()
+    installed = {name: a[DIGEST_ANNOTATION] for name, a in crd_digests(harness).items()}
+    del lk_client._client
+    lk_client.get.side_effect = lambda res, name, **_: mock.MagicMock(
+        metadata=mock.MagicMock(annotations={DIGEST_ANNOTATION: installed[name]})
+    )
+    harness.charm.stored.config_hash = "mock_hash"
+    harness.charm._install_or_upgrade(mock.MagicMock())
+
+    applied = [call.args[0].metadata.name for call in lk_client.apply.call_args_list]
+    assert not [name for name in installed if name in applied]
+    assert sorted(call.args[1] for call in lk_client.get.call_args_list) == sorted(installed)
+
+
+def test_custom_resources_wait_for_established(harness: Harness, lk_client, backoff):
+    calls = []
+    established = mock.MagicMock(type="Established", status="True")
+    conditions = iter([[]])  # the first read finds a CRD not yet established
+
+    def get(*_, **__):
+        calls.append("get")
+        crd = mock.MagicMock()
+        crd.status.conditions = next(conditions, [established])
+        return crd
+
+    lk_client.get.side_effect = get
+    lk_client.apply.side_effect = lambda obj, **_: calls.append(apply_tier(HashableResource(obj)))
+    harness.begin_with_initial_hooks()
+
+    waited = [i for i, call in enumerate(calls) if call == "get"]
+    first_cr = calls.index(CUSTOM_RESOURCE_TIER)
+    assert waited and max(waited) < first_cr
+    assert backoff.call_count == 1
+    assert harness.charm.stored.deployed
+
+
+def test_established_timeout_defers(harness: Harness, lk_client):
+    lk_client.get.return_value.status.conditions = []
+    applied = []
+    lk_client.apply.side_effect = lambda obj, **_: applied.append(HashableResource(obj))
+    harness.begin()
+    harness.charm.stored.config_hash = "mock_hash"
+    event = mock.MagicMock()
+    with mock.patch("apply.ESTABLISHED_TIMEOUT", 0):
+        harness.charm._install_or_upgrade(event)
+
+    event.defer.assert_called_once()
+    assert isinstance(harness.charm.unit.status, WaitingStatus)
+    assert CUSTOM_RESOURCE_TIER not in map(apply_tier, applied)
@@ -0,0 +1,134 @@
+# Copyright 2024 Canonical Ltd.
+# See LICENSE file for licensing details.
+#
+# Learn more about testing at: https://juju.is/docs/sdk/testing
+
+import unittest.mock as mock
+
+import ops.testing
+import pytest
+from ops.model import BlockedStatus, MaintenanceStatus, WaitingStatus
+from ops.testing import Harness
+
+from apply import apply_tier
+from charm import NetworkOperatorCharm
+
+ops.testing.SIMULATE_CAN_CONNECT = True
+MANIFEST = "network-operator"
+SELECTOR = f"juju.io/application=nvidia-network-operator,juju.io/manifest={MANIFEST}"
+
+
+@pytest.fixture
+def harness():
+    harness = Harness(NetworkOperatorCharm)
+    try:
+        yield harness
+    finally:
+        harness.cleanup()
+
+
+@pytest.fixture
+def requests(lk_client):
+    lk_client._client = mock.MagicMock()
+    yield lk_client._client.request
+
+
+def deleted_kinds(requests):
+    return [
+        (c.kwargs["res"].__name__, c.kwargs["namespace"])
+        for c in requests.call_args_list
+        if c.args == ("deletecollection",)
+    ]
+
+
+def test_cleanup_deletes_collections(harness: Harness, lk_client, requests):
+    harness.begin_with_initial_hooks()
+    lk_client.delete.reset_mock()
+    harness.charm.on.stop.emit()
+
+    kinds = deleted_kinds(requests)
+    manifests = harness.charm.collector.manifests[MANIFEST]
+    tiers = {
+        (type(rsc.resource).__name__, rsc.namespace): apply_tier(rsc)
+        for rsc in manifests.resources
+    }
+    assert sorted(kinds, key=str) == sorted(tiers, key=str)
+    # custom resources first and CRDs last
+    assert [tiers[kind] for kind in kinds] == sorted(tiers.values(), reverse=True)
+    assert kinds[-1] == ("CustomResourceDefinition", None)
+    assert {c.kwargs["params"]["labelSelector"] for c in requests.call_args_list} == {SELECTOR}
+    lk_client.delete.assert_not_called()
+    assert harness.charm.unit.status == MaintenanceStatus("Shutting down")
+
+
+def test_cleanup_without_generic_client(harness: Harness, lk_client, requests):
+    harness.begin_with_initial_hooks()
+    lk_client.list.return_value = [mock.MagicMock()]
+    del lk_client._client
+    harness.charm.on.stop.emit()
+
+    manifests = harness.charm.collector.manifests[MANIFEST]
+    listed = {(c.args[0], c.kwargs.get("namespace")) for c in lk_client.list.call_args_list}
+    kinds = {(type(rsc.resource), rsc.namespace) for rsc in manifests.resources}
+    assert kinds <= listed
+    assert lk_client.delete.call_count >= len(kinds)
+    assert harness.charm.unit.status == MaintenanceStatus("Shutting down")
+
+
+def test_cleanup_after_reinstall(harness: Harness, lk_client, requests):
+    harness.begin_with_initial_hooks()
+    harness.charm.on.stop.emit()
+    first = deleted_kinds(requests)
+    assert first and not harness.charm.stored.deleted
+
+    requests.reset_mock()
+    harness.update_config({"image-registry": "my.registry"})
+    harness.charm.on.stop.emit()
+    assert sorted(deleted_kinds(requests), key=str) == sorted(first, key=str)
+
+
+def test_cleanup_resumes(harness: Harness, lk_client, requests, api_error_klass):
+    unavailable = api_error_klass()
+    unavailable.status = mock.MagicMock(code=503)
+
+    def request(method, res, **_):
+        if res.__name__ == "ServiceAccount":
+            raise unavailable
+
+    requests.side_effect = request
+    harness.begin_with_initial_hooks()
+    event = mock.MagicMock()
+    harness.charm._cleanup(event)
+    event.defer.assert_called_once()
+    assert isinstance(harness.charm.unit.status, WaitingStatus)
+    first = {kind for kind in deleted_kinds(requests) if kind[0] != "ServiceAccount"}
+    assert ("CustomResourceDefinition", None) not in first
+
+    requests.reset_mock(side_effect=True)
+    harness.charm._cleanup(event)
+    resumed = set(deleted_kinds(requests))
+    assert ("ServiceAccount", "default") in resumed
+    assert ("CustomResourceDefinition", None) in resumed
+    assert not resumed & first
+    assert harness.charm.unit.status == MaintenanceStatus("Shutting down")
+
+
+def test_cleanup_ignores_missing_kinds(harness: Harness, lk_client, requests, api_error_klass):
+    missing = api_error_klass()
+    missing.status = mock.MagicMock(code=404)
+    requests.side_effect = missing
+    harness.begin_with_initial_hooks()
+    harness.charm.on.stop.emit()
+    assert harness.charm.unit.status == MaintenanceStatus("Shutting down")
+
+
+def test_cleanup_permanent_error_defers(harness: Harness, lk_client, requests, api_error_klass):
+    forbidden = api_error_klass()
+    forbidden.status = mock.MagicMock(code=403)
+    requests.side_effect = forbidden
+    harness.begin_with_initial_hooks()
+    event = mock.MagicMock()
+    harness.charm._cleanup(event)
+    event.defer.assert_called_once()
+    assert isinstance(harness.charm.unit.status, BlockedStatus)
+    assert "to recover, grant the charm's credentials access" in harness.charm.unit.status.message
@@ -0,0 +1,358 @@
+# Copyright 2024 Canonical Ltd.
+# See LICENSE file for licensing details.
+#
+# Learn more about testing at: https://juju.is/docs/sdk/testing
+
+import pickle
+import tracemalloc
+import unittest.mock as mock
+from collections import deque
+
+import ops.testing
+import pytest
+import yaml
+from lightkube import codecs
+from ops.manifests import Patch
+from ops.model import BlockedStatus
+from ops.testing import ActionFailed, Harness
+
+from cache import ManifestCache, iter_documents
+from charm import NetworkOperatorCharm
+from config import VALIDATORS
+from manifests import NetworkOperatorManifests
+from releases import build_index, image_fields, load_index
+
+ops.testing.SIMULATE_CAN_CONNECT = True
+
+
+@pytest.fixture
+def harness():
+    harness = Harness(NetworkOperatorCharm)
+    try:
+        yield harness
+    finally:
+        harness.cleanup()
+
+
+def test_waits_for_config(harness: Harness, lk_client, caplog):
+    harness.begin_with_initial_hooks()
+    caplog.clear()
+    harness.update_config(
+        {
+            "nfd-worker-conf": "sources: {}",
+            "nic-cluster-policy": "apiVersion: mellanox.com/v1alpha1\nkind: NicClusterPolicy\nmetadata: {}",
+        }
+    )
+
+    messages = {r.message for r in caplog.records if "manifests" in r.filename}
+    assert "Applying Node Feature Discovery ConfigMap Data" in messages
+
+
+def test_config_parsed_once_per_hook(harness: Harness, lk_client):
+    harness.begin_with_initial_hooks()
+    harness.charm.charm_config.invalidate()
+    harness.charm.charm_config._loaded.clear()
+    manifests = harness.charm.collector.manifests["network-operator"]
+
+    with mock.patch("config.yaml.safe_load", wraps=yaml.safe_load) as safe_load:
+        resources = manifests.resources
+        # render the release a few more times, growing the number of patched objects
+        for _ in range(3):
+            for rsc in resources:
+                for patch in manifests.manipulations:
+                    patch(rsc.resource)
+        manifests.hash()
+        assert manifests.nic_policy
+        manifests.evaluate()
+        harness.charm.charm_config.evaluate()
+
+    assert len(resources) > len(harness.charm.charm_config.YAML_OPTIONS)
+    assert safe_load.call_count == len(harness.charm.charm_config.YAML_OPTIONS)
+
+
+def test_config_hash_is_canonical(harness: Harness, lk_client):
+    harness.begin_with_initial_hooks()
+    config = harness.charm.charm_config
+    manifests = harness.charm.collector.manifests["network-operator"]
+    before = manifests.hash()
+    assert len(before) == 64
+
+    # the same values in another order hash the same
+    reordered = dict(reversed(list(harness.charm.config.items())))
+    with mock.patch.object(type(harness.charm), "config", new=reordered):
+        config.invalidate()
+        assert manifests.hash() == before
+
+    config.invalidate()
+    with mock.patch.object(type(manifests), "current_release", new="v0.0.1"):
+        assert manifests.hash() != before
+
+    # operational options leave the rendered manifests alone
+    harness.update_config({"profiling": "spans", "readiness-watch": True, "apply-concurrency": 2})
+    assert manifests.hash() == before
+
+    harness.update_config({"nfd-worker-conf": "sources: {}\n# changed"})
+    assert manifests.hash() != before
+
+
+def test_config_snapshot_invalidated(harness: Harness, lk_client):
+    harness.begin_with_initial_hooks()
+    config = harness.charm.charm_config
+    snapshot = config.available_data
+    assert config.available_data is snapshot
+    with pytest.raises(TypeError):
+        snapshot["image-registry"] = "other"  # type: ignore
+
+    harness.update_config({"image-registry": "my.registry"})
+    assert config.available_data is not snapshot
+    assert config.available_data["image-registry"] == "my.registry"
+
+
+def test_config_validated_once_per_value(harness: Harness, lk_client):
+    harness.begin_with_initial_hooks()
+    config = harness.charm.charm_config
+    validator = VALIDATORS["nic-cluster-policy"]
+    harness.update_config({"nfd-worker-conf": "sources: {}", "nic-cluster-policy": "kind: Nic"})
+
+    with mock.patch("config.yaml.safe_load", wraps=yaml.safe_load) as safe_load, mock.patch.object(
+        validator, "iter_errors", wraps=validator.iter_errors
+    ) as iter_errors:
+        config.invalidate()
+        assert config.evaluate().startswith("nic-cluster-policy is invalid")
+        assert safe_load.call_count == iter_errors.call_count == 0
+
+        harness.update_config({"nic-cluster-policy": "kind: NicClusterPolicy\nmetadata: []"})
+        assert safe_load.call_count == iter_errors.call_count == 1
+        assert harness.charm.unit.status == BlockedStatus(
+            "nic-cluster-policy is invalid: "
+            "$: 'apiVersion' is a required property; "
+            "$.metadata: [] is not of type 'object'"
+        )
+
+
+def test_manifest_cache_hit(harness: Harness, manifest_cache):
+    harness.begin()
+
+    def hook_start():
+        return NetworkOperatorManifests(harness.charm, harness.charm.charm_config).resources
+
+    with mock.patch("manifests.iter_documents", side_effect=iter_documents) as parser:
+        cold = hook_start()
+    parser.assert_called()
+    assert list(manifest_cache.glob("*.pickle"))
+    with mock.patch("manifests.iter_documents") as parser:
+        cached = hook_start()
+    parser.assert_not_called()
+    assert [str(r) for r in cached] == [str(r) for r in cold]
+
+
+def test_manifest_cache_keyed_by_release(tmp_path, manifest_cache):
+    cache = ManifestCache(manifest_cache)
+    manifest_cache.mkdir(parents=True, exist_ok=True)
+    unkeyed = manifest_cache / f"manifest-{'0' * 64}.pickle"
+    unkeyed.write_bytes(pickle.dumps([{"kind": "A", "apiVersion": "v1"}]))
+    for release in ("v1", "v2"):
+        path = tmp_path / release / "manifest.yaml"
+        path.parent.mkdir()
+        path.write_text(f"kind: A\napiVersion: v1\nmetadata: {{name: {release}}}")
+        cache.load(path, iter_documents)
+    assert {p.name.split("-")[0] for p in manifest_cache.glob("*.pickle")} == {"v1", "v2"}
+    assert not unkeyed.exists()
+    with mock.patch("cache.yaml.load_all") as load_all:
+        assert cache.load(path, iter_documents)[0]["metadata"]["name"] == "v2"
+    load_all.assert_not_called()
+
+
+def test_manifest_cache_streams(tmp_path, manifest_cache):
+    path = tmp_path / "manifest.yaml"
+    documents = ["kind: List\napiVersion: v1\nitems: [{kind: A, apiVersion: v1}]", "null"]
+    path.write_text("\n---\n".join([*documents, "kind: B\napiVersion: v1"]))
+    cache = ManifestCache(manifest_cache)
+
+    # an abandoned stream stores nothing
+    next(cache.stream(path, iter_documents))
+    assert not list(manifest_cache.iterdir())
+
+    assert [doc["kind"] for doc in cache.stream(path, iter_documents)] == ["A", "B"]
+    with mock.patch("cache.yaml.load_all") as load_all:
+        assert [doc["kind"] for doc in cache.stream(path, iter_documents)] == ["A", "B"]
+    load_all.assert_not_called()
+    assert [p.suffix for p in manifest_cache.iterdir()] == [".pickle"]
+
+
+def test_streamed_resources_memory(harness: Harness, manifest_cache):
+    harness.begin()
+    manifests = NetworkOperatorManifests(harness.charm, harness.charm.charm_config)
+    path = manifests.manifest_path / manifests.current_release / "manifest.yaml"
+    blobs = [pickle.dumps(doc) for doc in manifests._safe_load(path)]
+
+    def peak(render):
+        tracemalloc.start()
+        try:
+            render()
+            return tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    deque(manifests.iter_resources(), maxlen=0)  # import models before tracing
+
+    def render_one(blob):
+        obj = codecs.from_dict(pickle.loads(blob))
+        for patch in manifests.manipulations:
+            if isinstance(patch, Patch):
+                patch(obj)
+
+    largest = max(peak(lambda: render_one(blob)) for blob in blobs)
+    streamed = peak(lambda: deque(manifests.iter_resources(), maxlen=0))
+    whole = peak(lambda: manifests.resources)
+    assert streamed < whole
+    assert streamed < 2 * largest
+
+
+def test_release_index_is_current(harness: Harness):
+    harness.begin()
+    manifests = harness.charm.collector.manifests["network-operator"]
+    # rebuild with: python3 src/releases.py upstream/network-operator/manifests
+    assert load_index(manifests.manifest_path) == build_index(manifests.manifest_path)
+    assert manifests.releases == list(manifests.release_index)
+
+
+def test_release_index_keys_cache(harness: Harness, manifest_cache):
+    harness.begin()
+    manifests = NetworkOperatorManifests(harness.charm, harness.charm.charm_config)
+    with mock.patch.object(ManifestCache, "digest") as digest:
+        assert manifests.resources
+    digest.assert_not_called()
+    release = manifests.release_index[manifests.current_release]
+    pickles = {path.name for path in manifest_cache.glob("*.pickle")}
+    assert pickles == {
+        f"{manifests.current_release}-manifest-{digest}.pickle"
+        for digest in release["files"].values()
+    }
+
+
+def test_release_config(harness: Harness, lk_client):
+    harness.begin_with_initial_hooks()
+    manifests = harness.charm.collector.manifests["network-operator"]
+    harness.update_config({"release": "v0.0.0"})
+    assert harness.charm.unit.status == BlockedStatus(
+        f"release v0.0.0 is not one of: {', '.join(manifests.releases)}"
+    )
+
+    harness.update_config({"release": "v23.1.0"})
+    assert manifests.current_release == "v23.1.0"
+    assert not isinstance(harness.charm.unit.status, BlockedStatus)
+
+
+def test_image_registry(harness: Harness, lk_client):
+    harness.begin()
+    policy = yaml.safe_load(harness.charm.config["nic-cluster-policy"])
+    policy["spec"] = {
+        "ofedDriver": {"image": "doca-driver", "repository": "nvcr.io/nvidia", "version": "1.0"}
+    }
+    harness.update_config(
+        {
+            "image-registry": "registry.local",
+            "nic-cluster-policy": yaml.safe_dump(policy),
+            "nic-cluster-policy-registry": True,
+        }
+    )
+    manifests = NetworkOperatorManifests(harness.charm, harness.charm.charm_config)
+    objs = [rsc.resource.to_dict() for rsc in manifests.rendered_resources()]
+    images = [image for obj in objs for _, image in image_fields(obj)]
+    assert images and all(image.startswith("registry.local/") for image in images)
+    nic_policy = next(obj for obj in objs if obj["kind"] == "NicClusterPolicy")
+    assert nic_policy["spec"]["ofedDriver"]["repository"] == "registry.local/nvidia"
+    assert "registry.local/nvidia/doca-driver:1.0" in manifests.images()
+
+    # the release index locates the same fields as walking each object
+    with mock.patch.object(NetworkOperatorManifests, "release_index", {}):
+        manifests = NetworkOperatorManifests(harness.charm, harness.charm.charm_config)
+        assert [rsc.resource.to_dict() for rsc in manifests.rendered_resources()] == objs
+
+
+def test_nic_policy_registry_opt_in(harness: Harness, lk_client):
+    harness.begin()
+    policy = yaml.safe_load(harness.charm.config["nic-cluster-policy"])
+    policy["spec"] = {
+        "ofedDriver": {"image": "doca-driver", "repository": "nvcr.io/nvidia", "version": "1.0"}
+    }
+    harness.update_config({"nic-cluster-policy": yaml.safe_dump(policy)})
+    manifests = NetworkOperatorManifests(harness.charm, harness.charm.charm_config)
+    assert manifests.config["image-registry"] == "rocks.canonical.com/cdk"
+    assert manifests.nic_policy.resource.to_dict()["spec"] == policy["spec"]
+    assert "nvcr.io/nvidia/doca-driver:1.0" in manifests.images()
+
+    harness.update_config({"nic-cluster-policy-registry": True})
+    manifests = NetworkOperatorManifests(harness.charm, harness.charm.charm_config)
+    spec = manifests.nic_policy.resource.to_dict()["spec"]
+    assert spec["ofedDriver"]["repository"] == "rocks.canonical.com/cdk/nvidia"
+    assert "rocks.canonical.com/cdk/nvidia/doca-driver:1.0" in manifests.images()
+
+
+def test_list_images_action(harness: Harness, lk_client):
+    harness.begin()
+    manifests = harness.charm.collector.manifests["network-operator"]
+    output = harness.run_action("list-images")
+    images = output.results["images"].splitlines()
+    assert len(images) == len(manifests.release_index[manifests.current_release]["images"])
+
+    harness.update_config({"image-registry": "registry.local"})
+    output = harness.run_action("list-images", {"release": manifests.releases[-1]})
+    images = output.results["images"].splitlines()
+    assert images and all(image.startswith("registry.local/") for image in images)
+
+    with pytest.raises(ActionFailed):
+        harness.run_action("list-images", {"release": "v0.0.0"})
+
+
+def test_disabled_components(harness: Harness, lk_client):
+    harness.begin_with_initial_hooks()
+    manifests = harness.charm.collector.manifests["network-operator"]
+    applied = harness.charm.stored.applied["network-operator"]
+    before = set(applied)
+    lk_client.list.reset_mock()
+    harness.update_config({"disabled-components": "nfd ipoib-network-crd"})
+
+    names = {
+        "nvidia-charm-node-feature-discovery",
+        "nvidia-charm-node-feature-discovery-worker-conf",
+        "nvidia-charm-node-feature-discovery-master",
+        "nvidia-charm-node-feature-discovery-worker",
+        "ipoibnetworks.mellanox.com",
+    }
+    assert {rsc.name for rsc in manifests.rendered_resources()}.isdisjoint(names)
+    # the resources already applied are deleted
+    deleted = {
+        call.kwargs["fields"]["metadata.name"]
+        for call in lk_client.list.call_args_list
+        if "fields" in call.kwargs
+    }
+    assert deleted == names
+    assert {key.rsplit("/", 1)[-1] for key in before - set(applied)} == names
+
+    harness.update_config({"disabled-components": "drivers"})
+    assert harness.charm.unit.status == BlockedStatus(
+        "disabled-components drivers not one of: nfd, hostdevice-network-crd, ipoib-network-crd, macvlan-network-crd, network-attachment-definition-crd"
+    )
+
+
+def test_status_lists_each_kind_once(harness: Harness, lk_client):
+    harness.begin()
+    manifests = harness.charm.collector.manifests["network-operator"]
+    expected = {rsc.kind: rsc for rsc in manifests.resources}["Deployment"]
+    status = {"conditions": [{"type": "Ready", "status": "False"}]}
+    installed = codecs.from_dict({**expected.resource.to_dict(), "status": status})
+
+    def list_kind(kind, namespace=None, labels=None):
+        return [installed] if labels and kind is type(installed) else []
+
+    lk_client.list.side_effect = list_kind
+    assert harness.charm.collector.unready == [
+        "network-operator: Deployment/default/nvidia-charm-network-operator is not Ready"
+    ]
+    kinds = {(type(rsc.resource), rsc.namespace) for rsc in manifests.resources}
+    labelled = [c for c in lk_client.list.call_args_list if c.kwargs.get("labels")]
+    assert len(labelled) == len(kinds)
+    assert all(c.kwargs["labels"]["juju.io/manifest"] == manifests.name for c in labelled)
+    lk_client.get.assert_not_called()
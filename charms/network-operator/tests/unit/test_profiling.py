@@ -0,0 +1,73 @@
+# Copyright 2024 Canonical Ltd.
+# See LICENSE file for licensing details.
+#
+# Learn more about testing at: https://juju.is/docs/sdk/testing
+
+import json
+import unittest.mock as mock
+
+import ops.testing
+import pytest
+from ops.model import BlockedStatus
+from ops.testing import Harness
+
+from charm import NetworkOperatorCharm
+from profiling import ENV_VAR, profiler
+
+ops.testing.SIMULATE_CAN_CONNECT = True
+
+
+@pytest.fixture
+def harness(tmp_path):
+    harness = Harness(NetworkOperatorCharm)
+    with mock.patch.object(NetworkOperatorCharm, "profile_dir", tmp_path / "profiles"):
+        try:
+            yield harness
+        finally:
+            harness.cleanup()
+            profiler.finish()
+
+
+def spans(caplog):
+    records = [r.message for r in caplog.records if r.name == "profiling"]
+    return [json.loads(message) for message in records if message.startswith("{")]
+
+
+def test_profiling_disabled(harness: Harness, lk_client, caplog):
+    harness.begin_with_initial_hooks()
+    harness.charm.framework.on.commit.emit()
+
+    assert not profiler.enabled
+    assert profiler.span("config evaluation") is profiler.tally("patch")
+    assert spans(caplog) == []
+    assert not harness.charm.profile_dir.exists()
+
+
+def test_profiling_from_env(harness: Harness, lk_client, caplog, monkeypatch):
+    monkeypatch.setenv(ENV_VAR, "cprofile")
+    monkeypatch.setenv("JUJU_DISPATCH_PATH", "hooks/config-changed")
+    harness.begin()
+    harness.update_config(
+        {
+            "nfd-worker-conf": "sources: {}",
+            "nic-cluster-policy": "apiVersion: mellanox.com/v1alpha1\nkind: NicClusterPolicy\nmetadata: {}",
+        }
+    )
+    harness.charm.framework.on.commit.emit()
+
+    recorded = {span["span"]: span for span in spans(caplog)}
+    assert {"config evaluation", "manifest hash", "apply manifests", "apply", "hook"} <= set(
+        recorded
+    )
+    assert recorded["patch ApplyNFDConfigMap"]["calls"] > 0
+    assert all(span["hook"] == "config-changed" for span in recorded.values())
+    assert [p.name.split("-")[:2] for p in harness.charm.profile_dir.iterdir()] == [
+        ["config", "changed"]
+    ]
+    assert not profiler.enabled
+
+
+def test_profiling_invalid(harness: Harness, lk_client):
+    harness.begin_with_initial_hooks()
+    harness.update_config({"profiling": "everything"})
+    assert harness.charm.unit.status == BlockedStatus("profiling must be one of: spans, cprofile")
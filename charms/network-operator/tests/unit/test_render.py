@@ -0,0 +1,116 @@
+# Copyright 2024 Canonical Ltd.
+# See LICENSE file for licensing details.
+#
+# Learn more about testing at: https://juju.is/docs/sdk/testing
+
+import json
+import sys
+import unittest.mock as mock
+
+import ops.testing
+import pytest
+import yaml
+from ops.testing import ActionFailed, Harness
+
+from charm import NetworkOperatorCharm
+from render import main
+
+ops.testing.SIMULATE_CAN_CONNECT = True
+MANIFEST = "network-operator"
+POLICY = "apiVersion: mellanox.com/v1alpha1\nkind: NicClusterPolicy\nmetadata: {name: policy}"
+
+
+@pytest.fixture
+def harness():
+    harness = Harness(NetworkOperatorCharm)
+    try:
+        yield harness
+    finally:
+        harness.cleanup()
+
+
+def test_render_action_offline(harness: Harness, lk_client):
+    harness.update_config({"nic-cluster-policy": POLICY})
+    harness.begin()
+    output = harness.run_action("render")
+
+    results = output.results[MANIFEST]
+    objs = list(yaml.safe_load_all(results["resources"]))
+    assert {obj["kind"] for obj in objs} >= {"CustomResourceDefinition", "NicClusterPolicy"}
+    assert len(results["added"].splitlines()) == len(objs)
+    assert not results["changed"] and not results["removed"]
+    assert not lk_client.method_calls
+
+
+def test_render_action_diff(harness: Harness, lk_client):
+    harness.update_config({"nic-cluster-policy": POLICY})
+    harness.begin_with_initial_hooks()
+    lk_client.reset_mock()
+    config = "{image-registry: registry.local}"
+    output = harness.run_action("render", {"config": config, "format": "json"})
+
+    results = output.results[MANIFEST]
+    images = {
+        container["image"]
+        for obj in json.loads(results["resources"])
+        if obj["kind"] == "Deployment"
+        for container in obj["spec"]["template"]["spec"]["containers"]
+    }
+    assert images and all(image.startswith("registry.local/") for image in images)
+    assert "Deployment/default/nvidia-charm-network-operator" in results["changed"].splitlines()
+    assert not results["added"] and not results["removed"]
+    assert not lk_client.method_calls
+    assert harness.charm.config["image-registry"] != "registry.local"
+
+
+@pytest.mark.parametrize(
+    "config, message",
+    [
+        ("[]", "Invalid config: config must be a yaml mapping of options"),
+        ("{missing: 1}", "Invalid config: missing is not a config option"),
+        ("{apply-concurrency: two}", "Invalid config: apply-concurrency must be a int"),
+        ("{apply-concurrency: 0}", "apply-concurrency must be at least 1"),
+        (
+            "{nfd-worker-conf: 'sources: []'}",
+            "nfd-worker-conf is invalid: $.sources: [] is not of type 'object'",
+        ),
+        ("{release: v0.0.0}", "release v0.0.0 is not one of: v23.1.0"),
+    ],
+)
+def test_render_action_invalid(harness: Harness, config, message):
+    harness.update_config({"nic-cluster-policy": POLICY})
+    harness.begin()
+    with pytest.raises(ActionFailed) as failed:
+        harness.run_action("render", {"config": config})
+    assert failed.value.message == message
+
+
+def test_render_cli(capsys, tmp_path, lk_client):
+    config = tmp_path / "config.yaml"
+    config.write_text(yaml.safe_dump({"nic-cluster-policy": POLICY}))
+    assert (
+        main(["--config-file", str(config), "-c", "apply-concurrency=2", "--format", "json"]) == 0
+    )
+    objs = json.loads(capsys.readouterr().out)
+    assert objs[-1]["kind"] == "NicClusterPolicy"
+    assert not lk_client.method_calls
+
+
+def test_render_cli_without_test_framework(capsys, lk_client):
+    with mock.patch.dict(sys.modules, {"ops.testing": None}):
+        assert main(["--format", "json"]) == 0
+    assert json.loads(capsys.readouterr().out)
+
+
+def test_render_cli_diff(capsys, tmp_path):
+    applied = tmp_path / "applied.json"
+    applied.write_text(json.dumps({MANIFEST: {"Namespace/gone": "digest"}}))
+    assert main(["-c", f"nic-cluster-policy={POLICY}", "--applied", str(applied)]) == 0
+    diff = json.loads(capsys.readouterr().out)[MANIFEST]
+    assert diff["removed"] == ["Namespace/gone"]
+    assert diff["added"] and not diff["changed"]
+
+
+def test_render_cli_invalid(capsys):
+    assert main(["-c", "nfd-worker-conf=sources: []"]) == 1
+    assert "nfd-worker-conf is invalid" in capsys.readouterr().err
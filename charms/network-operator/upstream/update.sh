@@ -37,3 +37,6 @@ sed -i \
   -e '\|managed-by: Helm|d' \
   -e '\|app.kubernetes.io/instance:|d' \
   ${TEMPLATE_PATH}
+
+# Index the releases so hooks never need to parse them to list them
+python3 ${BASE_DIR}/../src/releases.py ${MANIFEST_DIR}/manifests